@@ -1,4 +1,7 @@
 \
+import argparse
+import time
+
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
@@ -6,10 +9,33 @@ from firebase_admin import firestore
 # Attempt to import the similarity calculation function
 # This assumes similarity_calculator.py is in the same directory or Python path
 try:
-    from .similarity_calculator import calculate_similarity_for_quest
+    from .similarity_calculator import (
+        calculate_similarity_for_quest,
+        build_text_stats,
+        compute_all_similarities,
+        save_text_stats,
+        store_similar_quests_bulk,
+    )
 except ImportError:
     # Fallback for direct execution if similarity_calculator is in the same dir
-    from similarity_calculator import calculate_similarity_for_quest
+    from similarity_calculator import (
+        calculate_similarity_for_quest,
+        build_text_stats,
+        compute_all_similarities,
+        save_text_stats,
+        store_similar_quests_bulk,
+    )
+
+try:
+    from .similarity_features import (
+        backfill_all as backfill_similarity_features,
+        stream_features,
+    )
+except ImportError:
+    from similarity_features import (
+        backfill_all as backfill_similarity_features,
+        stream_features,
+    )
 
 def initialize_firebase():
     """
@@ -88,7 +114,99 @@ def update_all_quests_similarity():
     print(f"Failed to update: {error_count}")
     print("----------------")
 
+def update_all_quests_similarity_bulk():
+    """
+    Recomputes every quest's similar quest list in one pass.
+
+    Reads the 'questCards' collection once, scores all pairs in memory-bounded
+    row blocks and writes all 'similarQuests' subcollections with batched writes.
+    Use this after changing FIELD_MATCH_WEIGHTS or the hybrid weighting.
+    """
+    if not initialize_firebase():
+        print("Exiting due to Firebase initialization failure.")
+        return
+
+    db = firestore.client()
+
+    print("Fetching all quests from 'questCards' collection...")
+    start_time = time.time()
+    try:
+        quests = []
+        for quest_doc in db.collection('questCards').stream():
+            quest_data = quest_doc.to_dict() or {}
+            quest_data["id"] = quest_doc.id
+            quests.append(quest_data)
+    except Exception as e:
+        print(f"Error fetching quests from Firestore: {e}")
+        print("Please check Firestore permissions and connectivity.")
+        return
+    print(f"Loaded {len(quests)} quests in {time.time() - start_time:.1f}s.")
+
+    scoring_start = time.time()
+    results = list(compute_all_similarities(quests))
+    print(f"Scored all pairs in {time.time() - scoring_start:.1f}s.")
+
+    # Refresh the document frequencies the per-quest streaming scorer uses.
+    save_text_stats(db, build_text_stats(quests))
+
+    # Writes are diffed against each quest's similarQuests subcollection; the
+    # neighbor maps recorded on the feature store (one stream) are compared too
+    # so maps that drifted from their subcollection get rewritten.
+    existing = {}
+    try:
+        for features in stream_features(db, ["neighbors"]):
+            if isinstance(features.get("neighbors"), dict):
+                existing[features["id"]] = features["neighbors"]
+    except Exception as e:
+        print(f"Could not read neighbor maps from the feature store: {e}")
+        existing = None
+
+    write_start = time.time()
+    stats = store_similar_quests_bulk(db, results, existing=existing)
+    print(f"Wrote similar quests for {stats.get('quests', 0)} quests in {time.time() - write_start:.1f}s.")
+
+    writes = stats.get("writes", 0)
+    full_rewrite = stats.get("fullRewriteWrites", 0)
+    saved = full_rewrite - writes
+    print("\n--- Summary ---")
+    print(f"Total quests processed: {len(quests)}")
+    print(f"Successfully updated: {stats.get('quests', 0)}")
+    print(
+        f"Neighbors inserted/updated/deleted/unchanged: {stats.get('inserted', 0)}/"
+        f"{stats.get('updated', 0)}/{stats.get('deleted', 0)}/{stats.get('unchanged', 0)}"
+    )
+    print(
+        f"Writes: {writes} (full rewrite would be {full_rewrite}; "
+        f"saved {saved}, {saved / full_rewrite:.0%})" if full_rewrite else f"Writes: {writes}"
+    )
+    print(f"Total time: {time.time() - start_time:.1f}s")
+    print("----------------")
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Update similar quest lists for all existing quests."
+    )
+    parser.add_argument(
+        "--per-quest",
+        action="store_true",
+        help="Recompute one quest at a time (legacy path) instead of the bulk engine.",
+    )
+    parser.add_argument(
+        "--backfill-features",
+        action="store_true",
+        help="Only (re)build the questSimilarityFeatures store for all quests.",
+    )
+    args = parser.parse_args()
+
+    if args.backfill_features:
+        if initialize_firebase():
+            processed = backfill_similarity_features(firestore.client())
+            print(f"Backfilled similarity features for {processed} quest(s).")
+        raise SystemExit(0)
+
     print("Starting admin tool to update similar quest lists for all existing quests...")
-    update_all_quests_similarity()
+    if args.per_quest:
+        update_all_quests_similarity()
+    else:
+        update_all_quests_similarity_bulk()
     print("Admin tool finished.")
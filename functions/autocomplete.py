@@ -0,0 +1,145 @@
+"""Prefix completions for the search box.
+
+PrefixIndex keeps the `tokens` and titles of questSearchIndex documents in
+sorted arrays, so a prefix lookup is a binary search plus a walk over the
+matching range. Token completions are ranked by document frequency (how many
+quests carry the token); title completions by title length, shortest first.
+
+The warm search corpus (search_corpus.py) owns one PrefixIndex and updates
+it from the same questSearchIndex snapshot changes that
+`maintain_search_index` writes.
+"""
+
+from __future__ import annotations
+
+import bisect
+import heapq
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Tuple
+
+AUTOCOMPLETE_LIMIT = 8
+# Titles matched per word position are capped so a one-letter prefix cannot
+# walk the whole title array.
+TITLE_SCAN_LIMIT = 200
+# Pending additions up to this many are insorted; more (e.g. the initial
+# snapshot) are appended and the arrays re-sorted once.
+INSORT_LIMIT = 64
+
+
+def _normalize(text: str) -> str:
+    return " ".join(str(text or "").lower().split())
+
+
+class PrefixIndex:
+    """Sorted token and title arrays over a mutable set of quests."""
+
+    def __init__(self):
+        self.df: Counter = Counter()
+        self._terms: List[str] = []
+        # (normalized title suffix starting at a word, quest id)
+        self._title_keys: List[Tuple[str, str]] = []
+        self._entries: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        self._pending_terms: List[str] = []
+        self._pending_titles: List[Tuple[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, quest_id: str, title: str, tokens: Iterable[str]) -> None:
+        """Insert or replace the quest's title and tokens."""
+        self.remove(quest_id)
+        title = str(title or "").strip()
+        terms = tuple(dict.fromkeys(str(t).lower() for t in tokens or () if t))
+        for term in terms:
+            if not self.df[term]:
+                self._pending_terms.append(term)
+            self.df[term] += 1
+        for key in self._title_keys_for(title):
+            self._pending_titles.append((key, quest_id))
+        self._entries[quest_id] = (title, terms)
+
+    def _flush(self) -> None:
+        """Merge pending additions into the sorted arrays."""
+        for pending, target in (
+            (self._pending_terms, self._terms),
+            (self._pending_titles, self._title_keys),
+        ):
+            if len(pending) > INSORT_LIMIT:
+                target.extend(pending)
+                target.sort()
+            else:
+                for item in pending:
+                    bisect.insort(target, item)
+            pending.clear()
+
+    def remove(self, quest_id: str) -> bool:
+        entry = self._entries.pop(quest_id, None)
+        if entry is None:
+            return False
+        self._flush()
+        title, terms = entry
+        for term in terms:
+            self.df[term] -= 1
+            if not self.df[term]:
+                del self.df[term]
+                i = bisect.bisect_left(self._terms, term)
+                del self._terms[i]
+        for key in self._title_keys_for(title):
+            i = bisect.bisect_left(self._title_keys, (key, quest_id))
+            del self._title_keys[i]
+        return True
+
+    @staticmethod
+    def _title_keys_for(title: str) -> List[str]:
+        """The normalized title from each word onwards, so any word can match."""
+        words = _normalize(title).split(" ")
+        return list(
+            dict.fromkeys(" ".join(words[i:]) for i in range(len(words)) if words[i])
+        )
+
+    def complete_tokens(
+        self, prefix: str, limit: int = AUTOCOMPLETE_LIMIT
+    ) -> List[Dict[str, Any]]:
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        self._flush()
+        lo = bisect.bisect_left(self._terms, prefix)
+        hi = bisect.bisect_left(self._terms, prefix + "\uffff", lo)
+        best = heapq.nsmallest(
+            limit, self._terms[lo:hi], key=lambda t: (-self.df[t], t)
+        )
+        return [{"token": term, "df": self.df[term]} for term in best]
+
+    def complete_titles(
+        self, prefix: str, limit: int = AUTOCOMPLETE_LIMIT
+    ) -> List[Dict[str, Any]]:
+        """Titles with a word sequence starting with `prefix`.
+
+        Titles whose beginning matches come first, then shorter titles.
+        """
+        prefix = _normalize(prefix)
+        if not prefix:
+            return []
+        self._flush()
+        lo = bisect.bisect_left(self._title_keys, (prefix,))
+        seen: Dict[str, Tuple[bool, int, str]] = {}
+        for key, quest_id in self._title_keys[lo : lo + TITLE_SCAN_LIMIT]:
+            if not key.startswith(prefix):
+                break
+            title = self._entries[quest_id][0]
+            at_start = _normalize(title) == key
+            rank = (not at_start, len(title), title.lower())
+            if quest_id not in seen or rank < seen[quest_id]:
+                seen[quest_id] = rank
+        best = heapq.nsmallest(limit, seen.items(), key=lambda item: (item[1], item[0]))
+        return [{"id": qid, "title": self._entries[qid][0]} for qid, _ in best]
+
+    def complete(self, prefix: str, limit: int = AUTOCOMPLETE_LIMIT) -> Dict[str, Any]:
+        """Token completions for the last word of `prefix`, title completions
+        for all of it."""
+        words = _normalize(prefix).split(" ")
+        return {
+            "tokens": self.complete_tokens(words[-1], limit),
+            "titles": self.complete_titles(prefix, limit),
+        }
@@ -0,0 +1,343 @@
+"""Local micro-benchmarks for the similarity and search code paths.
+
+These run against a synthetic, seeded quest corpus so results are repeatable
+and no Firestore access is needed. Run from the functions directory, e.g.:
+
+    python benchmarks.py text-similarity --sizes 500 2000
+"""
+
+import argparse
+import random
+import time
+
+WORDS = [
+    "dragon", "goblin", "cave", "forest", "castle", "tomb", "lich", "undead",
+    "heist", "city", "sewer", "cult", "ritual", "ancient", "ruins", "temple",
+    "swamp", "desert", "mountain", "pirate", "ship", "island", "giant", "orc",
+    "kobold", "mine", "treasure", "artifact", "curse", "vampire", "werewolf",
+    "village", "festival", "murder", "mystery", "noble", "court", "intrigue",
+    "portal", "demon", "devil", "fey", "wild", "hunt", "rescue", "prince",
+    "escort", "caravan", "bandit", "tower", "wizard", "library", "golem",
+]
+LEVELS = ["1", "2", "3", "4", "5", "1-4", "5-10", "11-16"]
+PLAYERS = ["1", "2-4", "3-5", "4-6"]
+DURATIONS = ["1 session", "2-3 sessions", "one-shot", "campaign"]
+ENVIRONMENTS = ["Forest", "Cave", "Dungeon", "Urban", "Wilderness", "Coastal"]
+TAGS = ["combat", "exploration", "social", "puzzle", "horror", "comedy"]
+
+
+def make_corpus(n: int, seed: int = 7) -> list:
+    """Returns `n` synthetic quest dicts with the fields the scorers read."""
+    rng = random.Random(seed)
+    # Quests cluster around themes (overlapping slices of WORDS) so that
+    # neighbourhoods exist, as they do in the real catalog.
+    themes = [WORDS[i : i + 10] for i in range(0, len(WORDS) - 5, 5)]
+    quests = []
+    for i in range(n):
+        theme = rng.choice(themes)
+
+        def word():
+            return rng.choice(theme) if rng.random() < 0.8 else rng.choice(WORDS)
+
+        title = " ".join(word().title() for _ in range(rng.randint(2, 4)))
+        summary = "The " + " the ".join(
+            word() for _ in range(rng.randint(12, 40))
+        ) + "."
+        quests.append(
+            {
+                "id": f"q{i:06d}",
+                "title": title,
+                "summary": summary,
+                "level": rng.choice(LEVELS),
+                "players": rng.choice(PLAYERS),
+                "duration": rng.choice(DURATIONS),
+                "common_monsters": rng.sample(WORDS[:12], rng.randint(0, 3)),
+                "environment": rng.sample(ENVIRONMENTS, rng.randint(0, 2)),
+                "tags": rng.sample(TAGS, rng.randint(0, 3)),
+            }
+        )
+    return quests
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_text_similarity(sizes: list) -> None:
+    """Per-pair TF-IDF fits versus one corpus-wide TF-IDF model for a single target."""
+    import similarity_calculator as sc
+
+    for n in sizes:
+        quests = make_corpus(n)
+        target, others = quests[0], quests[1:]
+
+        _, pairwise_s = _timed(lambda: [sc._pairwise_text_score(target, o) for o in others])
+        _, corpus_s = _timed(lambda: sc.CorpusTextModel(quests).scores_for(0))
+        print(
+            f"n={n:>6}  per-pair={pairwise_s * 1000:9.1f} ms  "
+            f"corpus={corpus_s * 1000:8.1f} ms  speedup={pairwise_s / corpus_s:6.1f}x"
+        )
+
+
+def bench_all_pairs(sizes: list) -> None:
+    """Full top-N recompute for every quest with the blocked all-pairs engine."""
+    import similarity_calculator as sc
+
+    for n in sizes:
+        quests = make_corpus(n)
+        _, elapsed = _timed(lambda: list(sc.compute_all_similarities(quests)))
+        print(f"n={n:>6}  all-pairs top-{sc.TOP_N_SIMILAR_QUESTS}={elapsed:8.2f} s")
+
+
+def bench_field_match(sizes: list) -> None:
+    """Per-pair _calculate_field_match_score versus columnar NumPy scoring."""
+    import similarity_calculator as sc
+
+    for n in sizes:
+        quests = make_corpus(n)
+        target = quests[0]
+        _, pairwise_s = _timed(
+            lambda: [
+                sc._calculate_field_match_score(target, q, sc.FIELD_MATCH_WEIGHTS)
+                for q in quests
+            ]
+        )
+        encoded, encode_s = _timed(sc._encode_match_fields, quests)
+        _, score_s = _timed(sc._field_match_scores, encoded, 0)
+        print(
+            f"n={n:>6}  per-pair={pairwise_s * 1000:8.1f} ms  "
+            f"encode={encode_s * 1000:8.1f} ms  score={score_s * 1000:6.2f} ms"
+        )
+
+
+def bench_lsh_recall(sizes: list) -> None:
+    """Recall@N of LSH candidates + exact scoring versus the exhaustive scan."""
+    import similarity_calculator as sc
+    from similarity_features import build_feature_doc, features_to_quest
+
+    for n in sizes:
+        quests = make_corpus(n)
+        features = [features_to_quest(q["id"], build_feature_doc(q)) for q in quests]
+        buckets = {}
+        for q in features:
+            for band in q["lshBands"]:
+                buckets.setdefault(band, []).append(q["id"])
+        by_id = {q["id"]: q for q in features}
+
+        targets = features[: min(100, n)]
+        hits = total = candidates_seen = fallbacks = 0
+        exact_s = lsh_s = 0.0
+        for target in targets:
+            others = [q for q in features if q["id"] != target["id"]]
+            exact, elapsed = _timed(sc._rank_similar_quests, target, others)
+            exact_s += elapsed
+
+            start = time.perf_counter()
+            # Firestore returns array_contains_any matches in document-id order.
+            ids = sorted(
+                {i for b in target["lshBands"] for i in buckets.get(b, [])}
+                - {target["id"]}
+            )[: sc.LSH_CANDIDATE_LIMIT]
+            candidates = [by_id[i] for i in ids]
+            if len(candidates) < sc.TOP_N_SIMILAR_QUESTS:
+                candidates, fallbacks = others, fallbacks + 1
+            approx = sc._rank_similar_quests(target, candidates)
+            lsh_s += time.perf_counter() - start
+
+            candidates_seen += len(candidates)
+            expected = {r["id"] for r in exact}
+            hits += len(expected & {r["id"] for r in approx})
+            total += len(expected)
+
+        k = len(targets)
+        print(
+            f"n={n:>6}  recall@{sc.TOP_N_SIMILAR_QUESTS}={hits / total:.3f}  "
+            f"candidates={candidates_seen / k:7.1f}  fallbacks={fallbacks}  "
+            f"exact={exact_s / k * 1000:7.1f} ms  lsh={lsh_s / k * 1000:6.1f} ms"
+        )
+
+
+def bench_streaming(sizes: list) -> None:
+    """Peak traced memory of in-memory ranking versus the streaming top-N scorer."""
+    import tracemalloc
+
+    import similarity_calculator as sc
+    from similarity_features import build_feature_doc, features_to_quest
+
+    for n in sizes:
+        quests = make_corpus(n)
+        docs = [(q["id"], build_feature_doc(q)) for q in quests]
+        stats = sc.build_text_stats(features_to_quest(*d) for d in docs)
+        target = features_to_quest(*docs[0])
+
+        def feature_stream():
+            # Stands in for the Firestore stream: each record is decoded as it
+            # arrives, so only the consumer decides how many stay alive.
+            for quest_id, doc in docs[1:]:
+                yield features_to_quest(quest_id, dict(doc))
+
+        for name, run in (
+            ("in-memory", lambda: sc._rank_similar_quests(target, list(feature_stream()))),
+            ("streaming", lambda: sc._stream_top_similar(target, feature_stream(), stats)),
+        ):
+            tracemalloc.start()
+            _, elapsed = _timed(run)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f"n={n:>6}  {name:<9}  peak={peak / 1024 / 1024:7.2f} MiB  "
+                f"time={elapsed * 1000:8.1f} ms"
+            )
+
+
+SEARCH_QUERIES = ["dragon", "goblin cave", "ancient ruins temple", "vampire curse village"]
+
+
+def bench_search(sizes: list) -> None:
+    """search_quests_core latency with the BM25 index, and the old per-pair scorer."""
+    import statistics
+
+    import similarity_calculator as sc
+    from search import search_quests_core
+    from search_index import SearchIndex
+
+    for n in sizes:
+        quests = make_corpus(n)
+        index, build_s = _timed(SearchIndex, quests)
+        latencies = []
+        for query in SEARCH_QUERIES:
+            _, elapsed = _timed(search_quests_core, query, {}, 1, 10, quests, index=index)
+            latencies.append(elapsed)
+        _, scoring_s = _timed(lambda: [index.text_scores(q) for q in SEARCH_QUERIES])
+
+        # The old path fit two TF-IDF models per quest; time it on a sample
+        # and scale, as a full run takes minutes at these sizes.
+        sample = quests[:200]
+        sc._calculate_text_similarity("dragon", sample[0]["title"])
+        _, pairwise_s = _timed(
+            lambda: [
+                (
+                    sc._calculate_text_similarity("dragon", q["title"]),
+                    sc._calculate_text_similarity("dragon", q["summary"]),
+                )
+                for q in sample
+            ]
+        )
+        print(
+            f"n={n:>6}  build={build_s * 1000:8.1f} ms  "
+            f"query p50={statistics.median(latencies) * 1000:7.1f} ms  "
+            f"bm25-only={scoring_s / len(SEARCH_QUERIES) * 1000:6.2f} ms  "
+            f"old~={pairwise_s * n / len(sample) * 1000:9.0f} ms"
+        )
+
+
+def bench_top_k(sizes: list) -> None:
+    """Ranking every hit vs. only the top 10, for broad and narrow queries."""
+    import statistics
+
+    from search import search_quests_core
+    from search_index import SearchIndex
+
+    for n in sizes:
+        quests = make_corpus(n)
+        index = SearchIndex(quests)
+        for query in ["dragon", "goblin cave"]:
+            row = []
+            for top_k in (None, 10):
+                latencies = [
+                    _timed(
+                        search_quests_core,
+                        query,
+                        {},
+                        1,
+                        10 if top_k else max(n, 1000),
+                        [],
+                        index=index,
+                        only_matching=True,
+                        top_k=top_k,
+                    )[1]
+                    for _ in range(5)
+                ]
+                row.append(statistics.median(latencies))
+            print(
+                f"n={n:>6}  {query!r:>14}  full={row[0] * 1000:8.1f} ms  "
+                f"top10={row[1] * 1000:7.1f} ms  speedup={row[0] / row[1]:5.1f}x"
+            )
+
+
+def bench_autocomplete(sizes: list) -> None:
+    """PrefixIndex build time and per-prefix completion latency."""
+    import statistics
+
+    from autocomplete import PrefixIndex
+    from indexer import build_index_doc
+
+    prefixes = ["d", "dr", "gob", "anc", "the lost", "v"]
+    for n in sizes:
+        docs = [(str(i), build_index_doc(q)) for i, q in enumerate(make_corpus(n))]
+        start = time.perf_counter()
+        prefix_index = PrefixIndex()
+        for quest_id, doc in docs:
+            prefix_index.add(quest_id, doc["title"], doc["tokens"])
+        prefix_index.complete("a")
+        build_s = time.perf_counter() - start
+        latencies = [_timed(prefix_index.complete, p)[1] for p in prefixes * 20]
+        print(
+            f"n={n:>6}  build={build_s * 1000:8.1f} ms  "
+            f"complete p50={statistics.median(latencies) * 1000:6.3f} ms  "
+            f"max={max(latencies) * 1000:6.3f} ms"
+        )
+
+
+def bench_tokenizer(sizes: list) -> None:
+    """NLTK word_tokenize preprocessing versus the regex tokenizer, cold and cached."""
+    import nltk
+    from nltk.tokenize import word_tokenize
+
+    import text_preprocessing as tp
+
+    nltk.data.path.insert(0, tp.NLTK_DATA_PATH)
+    stop_words = tp.load_stopwords()
+
+    def nltk_preprocess(text):
+        tokens = word_tokenize(text.lower())
+        return " ".join(t for t in tokens if t.isalnum() and t not in stop_words)
+
+    for n in sizes:
+        texts = [q["summary"] for q in make_corpus(n)]
+        nltk_preprocess(texts[0])
+        tp.clear_cache()
+        _, nltk_s = _timed(lambda: [nltk_preprocess(t) for t in texts])
+        _, cold_s = _timed(lambda: [tp.preprocess_text(t) for t in texts])
+        _, warm_s = _timed(lambda: [tp.preprocess_text(t) for t in texts])
+        print(
+            f"n={n:>6}  nltk={nltk_s * 1000:8.1f} ms  regex={cold_s * 1000:7.1f} ms  "
+            f"cached={warm_s * 1000:6.1f} ms  speedup={nltk_s / cold_s:5.1f}x"
+        )
+
+
+BENCHMARKS = {
+    "autocomplete": bench_autocomplete,
+    "all-pairs": bench_all_pairs,
+    "field-match": bench_field_match,
+    "lsh-recall": bench_lsh_recall,
+    "search": bench_search,
+    "streaming": bench_streaming,
+    "text-similarity": bench_text_similarity,
+    "tokenizer": bench_tokenizer,
+    "top-k": bench_top_k,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000])
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""Stable content hashes used to skip writes that would change nothing.
+
+Most questCards writes only touch bookkeeping fields (uploader email sync,
+standardization status, the similarity fingerprint itself). Triggers hash just
+the content they derive from and compare it with the hash stored from the last
+run, so those writes cause no re-indexing, re-scoring or rewrites.
+
+`content_hash` serialises a value canonically (sorted keys, compact
+separators, `str()` for anything JSON can't encode) and hashes it, so equal
+content always gives the same hash across instances and deploys. It backs the
+similarity fingerprint (similarity_features.py) and the search index
+`contentHash` (indexer.py).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Any
+
+
+def content_hash(value: Any) -> str:
+    """Hex SHA-256 (first 32 characters) of `value`'s canonical JSON."""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
@@ -0,0 +1,192 @@
+"""In-memory Firestore stand-in shared by the tests.
+
+`FakeFirestore` covers the parts of the client the search and similarity code
+use: document get/set, subcollections, `get_all`, batched writes, where/limit/
+select queries and snapshot listeners. Data lives in `db.data` as
+{collection_path: {doc_id: dict}}, where a subcollection's path is
+"collection/doc_id/name".
+
+Queries stream matching documents in document-id order and then apply the
+limit, like Firestore without an `order_by`. Listeners are not called on
+registration; `push` delivers changes to them, so tests control when the
+first snapshot arrives. Reads, writes, where() calls and get_all calls are
+recorded for assertions.
+"""
+
+from __future__ import annotations
+
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+class FakeSnapshot:
+    def __init__(self, id: str, data: Dict[str, Any] | None):
+        self.id = id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeWatch:
+    def __init__(self):
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+
+
+class FakeDocument:
+    def __init__(self, db: "FakeFirestore", collection: str, id: str):
+        self.db = db
+        self.collection_path = collection
+        self.id = id
+
+    def get(self, field_paths=None, transaction=None) -> FakeSnapshot:
+        self.db.reads += 1
+        return FakeSnapshot(self.id, self.db.docs(self.collection_path).get(self.id))
+
+    def set(self, data: Dict[str, Any], merge=False) -> None:
+        self.db.writes += 1
+        docs = self.db.docs(self.collection_path)
+        if merge and self.id in docs:
+            docs[self.id] = {**docs[self.id], **data}
+        else:
+            docs[self.id] = dict(data)
+
+    def delete(self) -> None:
+        self.db.writes += 1
+        self.db.docs(self.collection_path).pop(self.id, None)
+
+    def collection(self, name: str) -> "FakeQuery":
+        return FakeQuery(self.db, f"{self.collection_path}/{self.id}/{name}")
+
+    def on_snapshot(self, callback):
+        return self.db.listen((self.collection_path, self.id), callback)
+
+
+def _matches(data: Dict[str, Any], clauses: Iterable[Tuple[str, str, Any]]) -> bool:
+    for field, op, value in clauses:
+        actual = data.get(field)
+        if op == "==" and actual != value:
+            return False
+        if op == "in" and actual not in value:
+            return False
+        if op == "array_contains" and value not in (actual or []):
+            return False
+        if op == "array_contains_any" and not set(actual or []) & set(value):
+            return False
+    return True
+
+
+class FakeQuery:
+    def __init__(self, db: "FakeFirestore", collection: str, clauses=(), n=None):
+        self.db = db
+        self.collection_path = collection
+        self.clauses = tuple(clauses)
+        self.n = n
+
+    def document(self, id: str) -> FakeDocument:
+        return FakeDocument(self.db, self.collection_path, id)
+
+    def where(self, field: str, op: str, value: Any) -> "FakeQuery":
+        self.db.where_calls.append((field, op, value))
+        clauses = self.clauses + ((field, op, value),)
+        return FakeQuery(self.db, self.collection_path, clauses, self.n)
+
+    def limit(self, n: int) -> "FakeQuery":
+        return FakeQuery(self.db, self.collection_path, self.clauses, n)
+
+    def select(self, fields) -> "FakeQuery":
+        return self
+
+    def stream(self):
+        docs = sorted(self.db.docs(self.collection_path).items())
+        snaps = [FakeSnapshot(id, d) for id, d in docs if _matches(d, self.clauses)]
+        snaps = snaps[: self.n]
+        self.db.reads += len(snaps)
+        return iter(snaps)
+
+    def on_snapshot(self, callback):
+        return self.db.listen(self.collection_path, callback)
+
+
+class FakeBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self.db = db
+        self.ops: List[Tuple[str, FakeDocument, Any, Any]] = []
+
+    def set(self, ref: FakeDocument, data: Dict[str, Any], merge=False) -> None:
+        self.ops.append(("set", ref, data, merge))
+
+    def delete(self, ref: FakeDocument) -> None:
+        self.ops.append(("delete", ref, None, None))
+
+    def commit(self) -> None:
+        self.db.commits += 1
+        for op, ref, data, merge in self.ops:
+            if op == "delete":
+                ref.delete()
+            else:
+                ref.set(data, merge=merge)
+        self.ops = []
+
+
+class FakeFirestore:
+    def __init__(self, data: Dict[str, Dict[str, Dict[str, Any]]] | None = None):
+        self.data = {name: dict(docs) for name, docs in (data or {}).items()}
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+        self.where_calls: List[Tuple[str, str, Any]] = []
+        self.get_all_calls: List[Tuple[List[str], Any]] = []
+        self.listeners: Dict[Any, Any] = {}
+        self.watches: List[FakeWatch] = []
+
+    def docs(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        return self.data.setdefault(collection, {})
+
+    def collection(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    def get_all(self, refs, field_paths=None):
+        refs = list(refs)
+        self.get_all_calls.append(([r.id for r in refs], field_paths))
+        for ref in refs:
+            yield ref.get()
+
+    def listen(self, key, callback) -> FakeWatch:
+        """Registers a collection (path) or document ((path, id)) listener."""
+        watch = FakeWatch()
+        self.listeners[key] = callback
+        self.watches.append(watch)
+        return watch
+
+    def push(self, collection: str, *changes) -> None:
+        """Applies (type, id, data) changes and delivers them as one snapshot."""
+        docs = self.docs(collection)
+        for kind, doc_id, data in changes:
+            if kind == "REMOVED":
+                docs.pop(doc_id, None)
+            else:
+                docs[doc_id] = dict(data)
+        if collection in self.listeners:
+            self.listeners[collection](
+                [],
+                [
+                    SimpleNamespace(
+                        type=SimpleNamespace(name=kind),
+                        document=FakeSnapshot(doc_id, data),
+                    )
+                    for kind, doc_id, data in changes
+                ],
+                None,
+            )
+        for kind, doc_id, data in changes:
+            callback = self.listeners.get((collection, doc_id))
+            if callback is not None:
+                callback([FakeSnapshot(doc_id, data)], [], None)
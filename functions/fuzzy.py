@@ -0,0 +1,157 @@
+"""Character-trigram candidate lookup and edit-distance verification.
+
+Used to match misspelled query terms: a term's trigrams (with `$` boundary
+markers) select vocabulary terms sharing enough of them, and the survivors
+are verified with an optimal-string-alignment edit distance (so a swapped
+pair of letters counts as one edit).
+
+questSearchIndex documents carry the trigrams of their tokens so the same
+lookup can run as a Firestore `array_contains_any` query.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Fewer shared trigrams than this fraction of the query term's are not
+# verified at all.
+MIN_TRIGRAM_OVERLAP = 0.3
+# Expansions kept per misspelled term.
+MAX_EXPANSIONS = 3
+# Firestore array_contains_any accepts at most 10 values.
+MAX_QUERY_TRIGRAMS = 10
+# Trigrams stored per index document.
+MAX_DOC_TRIGRAMS = 300
+
+
+def trigrams(term: str) -> List[str]:
+    padded = f"${term}$"
+    return list(dict.fromkeys(padded[i : i + 3] for i in range(len(padded) - 2)))
+
+
+def max_edits(term: str) -> int:
+    """Edits allowed for a term: none for very short terms, then 1, then 2."""
+    if len(term) < 4:
+        return 0
+    return 1 if len(term) < 7 else 2
+
+
+def edit_distance(a: str, b: str, limit: int) -> Optional[int]:
+    """Optimal string alignment distance, or None if it exceeds `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if (
+                i > 1
+                and j > 1
+                and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]
+            ):
+                value = min(value, prev2[j - 2] + 1)
+            cur[j] = value
+            row_min = min(row_min, value)
+        if row_min > limit:
+            return None
+        prev2, prev = prev, cur
+    return prev[-1] if prev[-1] <= limit else None
+
+
+def query_trigrams(terms: Iterable[str], limit: int = MAX_QUERY_TRIGRAMS) -> List[str]:
+    """Up to `limit` trigrams spread across the fuzzy-matchable `terms`.
+
+    Boundary trigrams (`$be`, `on$`) are shared by every word starting or
+    ending the same way, so they are only used for terms with fewer than two
+    interior trigrams.
+    """
+    per_term = [_selective_trigrams(t) for t in terms if max_edits(t)]
+    picked: List[str] = []
+    depth = 0
+    while len(picked) < limit and any(depth < len(grams) for grams in per_term):
+        for grams in per_term:
+            if depth < len(grams) and grams[depth] not in picked:
+                picked.append(grams[depth])
+                if len(picked) == limit:
+                    break
+        depth += 1
+    return picked
+
+
+def _selective_trigrams(term: str) -> List[str]:
+    grams = trigrams(term)
+    interior = [gram for gram in grams if "$" not in gram]
+    return interior if len(interior) >= 2 else grams
+
+
+def doc_trigrams(tokens: Iterable[str], limit: int = MAX_DOC_TRIGRAMS) -> List[str]:
+    """Trigrams of an index document's tokens, in token order."""
+    out: Dict[str, None] = {}
+    for token in tokens:
+        for gram in trigrams(token):
+            out[gram] = None
+            if len(out) >= limit:
+                return list(out)
+    return list(out)
+
+
+def closest(term: str, candidates: Iterable[str]) -> Optional[Tuple[str, int]]:
+    """The candidate nearest to `term` within its edit budget, if any."""
+    limit = max_edits(term)
+    if not limit:
+        return None
+    best = None
+    for candidate in candidates:
+        dist = edit_distance(term, candidate, limit)
+        if dist is not None and (best is None or dist < best[1]):
+            best = (candidate, dist)
+            if dist == 0:
+                break
+    return best
+
+
+class TrigramIndex:
+    """Trigram -> vocabulary terms, for finding terms close to a misspelling."""
+
+    def __init__(self, terms: Iterable[str] = ()):
+        self._postings: Dict[str, Set[str]] = {}
+        for term in terms:
+            self.add(term)
+
+    def add(self, term: str) -> None:
+        for gram in trigrams(term):
+            self._postings.setdefault(gram, set()).add(term)
+
+    def remove(self, term: str) -> None:
+        for gram in trigrams(term):
+            terms = self._postings.get(gram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self._postings[gram]
+
+    def similar(self, term: str, limit: int = MAX_EXPANSIONS) -> List[Tuple[str, int]]:
+        """Up to `limit` (term, distance) pairs within the budget, nearest first."""
+        budget = max_edits(term)
+        if not budget:
+            return []
+        grams = trigrams(term)
+        shared: Dict[str, int] = {}
+        for gram in grams:
+            for candidate in self._postings.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        needed = max(1, int(MIN_TRIGRAM_OVERLAP * len(grams)))
+        matches = []
+        for candidate, count in shared.items():
+            if count < needed or candidate == term:
+                continue
+            dist = edit_distance(term, candidate, budget)
+            if dist is not None:
+                matches.append((dist, -count, candidate))
+        matches.sort()
+        return [(candidate, dist) for dist, _, candidate in matches[:limit]]
@@ -4,17 +4,36 @@ Creates/updates documents in collection `questSearchIndex` where each doc id
 matches the questCard id. The index document contains a concatenated `search_text`
 and a small list of `tokens` useful for suggestion/autocomplete.
 
+It also holds the character `trigrams` of those tokens for fuzzy lookups of
+misspelled queries (see fuzzy.py).
+
+Since schema version 2 it also carries every field search scores on or filters
+by (see INDEX_SCORING_FIELDS / INDEX_FILTER_FIELDS), so a candidate query on
+this collection can be ranked without reading questCards. Documents written
+by an older schema lack these fields; `index_doc_to_quest` returns None for
+them so callers can fall back to the quest document.
+
+Each document stores a `contentHash` of everything it indexes (all but
+`indexedAt`). `index_quest` reads the stored hash and skips the write when it
+matches (see content_hash.py).
+
 This uses a lightweight tokenization (regex) to avoid heavy NLP packages during
-indexing. The search core can still use NLTK/scikit for matching when executing
-queries.
+indexing. The search core ranks candidates with its own in-memory BM25 index
+(search_index.py) when executing queries.
 """
 
 from __future__ import annotations
 
 import datetime
+import logging
 import re
+from collections import Counter
 from typing import Dict, Any, Iterable
 
+from content_hash import content_hash
+from fuzzy import doc_trigrams
+from similarity_features import match_fields
+
 STOPWORDS = {
     # Small stopword list to avoid packaging heavy NLTK for basic indexing
     "the",
@@ -32,6 +51,34 @@ STOPWORDS = {
     "from",
 }
 
+SEARCH_INDEX_COLLECTION = "questSearchIndex"
+SEARCH_INDEX_SCHEMA_VERSION = 2
+# Fields used by the search field scorer, normalised like the similarity
+# features (scalars kept as-is, list fields only when they are lists).
+INDEX_SCORING_FIELDS = (
+    "level",
+    "players",
+    "duration",
+    "common_monsters",
+    "environment",
+    "tags",
+)
+# Additional quest fields search results can be filtered on.
+INDEX_FILTER_FIELDS = ("standardizedGameSystem", "genre", "classification")
+INDEX_HASH_FIELD = "contentHash"
+
+# Index writes made and skipped (stored hash unchanged) on this instance.
+index_write_counts: Counter = Counter()
+
+
+def index_write_stats() -> Dict[str, Any]:
+    total = sum(index_write_counts.values()) or 1
+    return {
+        "written": index_write_counts["written"],
+        "skipped": index_write_counts["skipped"],
+        "skipRate": round(index_write_counts["skipped"] / total, 4),
+    }
+
 TOKEN_RE = re.compile(r"\b[a-z0-9]{2,}\b", re.IGNORECASE)
 
 
@@ -68,29 +115,81 @@ def build_index_doc(quest: Dict[str, Any]) -> Dict[str, Any]:
 
     tokens = list(dict.fromkeys(_tokenize(combined)))  # preserve order, unique
 
-    return {
+    doc = {
         "title": title,
         "summary": summary,
         "search_text": combined,
         "tokens": tokens[:50],
+        # Character trigrams of the tokens, for fuzzy (misspelled) lookups.
+        "trigrams": doc_trigrams(tokens[:50]),
+        "schemaVersion": SEARCH_INDEX_SCHEMA_VERSION,
         "indexedAt": datetime.datetime.utcnow(),
     }
+    doc.update(match_fields(quest))
+    for name in INDEX_FILTER_FIELDS:
+        if quest.get(name) is not None:
+            doc[name] = quest[name]
+    doc[INDEX_HASH_FIELD] = index_content_hash(doc)
+    return doc
+
+
+def index_content_hash(doc: Dict[str, Any]) -> str:
+    """Stable hash of an index document's content (all but `indexedAt`)."""
+    content = {
+        k: v for k, v in doc.items() if k not in ("indexedAt", INDEX_HASH_FIELD)
+    }
+    return content_hash(content)
+
+
+def index_doc_to_quest(doc_id: str, data: Dict[str, Any]) -> Dict[str, Any] | None:
+    """The quest dict search scores for an index document.
+
+    Returns None for documents from an older schema, which lack the scoring
+    and filter fields.
+    """
+    if (data.get("schemaVersion") or 0) < SEARCH_INDEX_SCHEMA_VERSION:
+        return None
+    quest = {
+        name: data[name]
+        for name in ("title", "summary") + INDEX_SCORING_FIELDS + INDEX_FILTER_FIELDS
+        if name in data
+    }
+    quest["id"] = doc_id
+    return quest
 
 
-def index_quest(db, quest_id: str, quest_data: Dict[str, Any]) -> None:
+def index_quest(db, quest_id: str, quest_data: Dict[str, Any]) -> bool:
     """Write the index document for a single quest into `questSearchIndex`.
 
+    The write is skipped when the stored document has the same content hash.
+
     Args:
         db: Firestore client
         quest_id: id of quest document
         quest_data: dictionary of quest fields
+
+    Returns:
+        Whether the document was written.
     """
     idx_doc = build_index_doc(quest_data)
-    db.collection("questSearchIndex").document(quest_id).set(idx_doc)
+    ref = db.collection(SEARCH_INDEX_COLLECTION).document(quest_id)
+    stored_hash = None
+    try:
+        stored = ref.get(field_paths=[INDEX_HASH_FIELD])
+        if stored.exists:
+            stored_hash = (stored.to_dict() or {}).get(INDEX_HASH_FIELD)
+    except Exception as e:
+        logging.warning(f"Could not read stored index hash for {quest_id}: {e}")
+    if stored_hash == idx_doc[INDEX_HASH_FIELD]:
+        index_write_counts["skipped"] += 1
+        return False
+    ref.set(idx_doc)
+    index_write_counts["written"] += 1
+    return True
 
 
 def delete_index(db, quest_id: str) -> None:
-    db.collection("questSearchIndex").document(quest_id).delete()
+    db.collection(SEARCH_INDEX_COLLECTION).document(quest_id).delete()
 
 
 def backfill_all(db, batch_size: int = 500) -> int:
@@ -106,7 +205,7 @@ def backfill_all(db, batch_size: int = 500) -> int:
     for doc in quests_ref.stream():
         q = doc.to_dict() or {}
         idx_doc = build_index_doc(q)
-        dest = db.collection("questSearchIndex").document(doc.id)
+        dest = db.collection(SEARCH_INDEX_COLLECTION).document(doc.id)
         batch.set(dest, idx_doc)
         count_in_batch += 1
 
@@ -38,8 +38,8 @@ from game_system_standardization import (
 )
 from user_management import on_user_delete
 from social_media import select_quest_and_post_to_social_media
-from indexer import index_quest, delete_index, backfill_all
-import time
+from indexer import index_quest, delete_index, backfill_all, index_write_stats
+from search_cache import bump_generation
 from indexer import _tokenize
 
 # Set root logger level to INFO for better visibility in Cloud Run if default is higher
@@ -84,6 +84,16 @@ def _get_change_before_after(change) -> tuple[object | None, object | None]:
     return (before, after)
 
 
+def _snapshot_to_dict(snapshot) -> dict | None:
+    """A change snapshot's data as a dict, or None when there is no snapshot."""
+    if snapshot is None:
+        return None
+    try:
+        return snapshot.to_dict() if hasattr(snapshot, "to_dict") else dict(snapshot)
+    except Exception:
+        return dict(snapshot)
+
+
 def _get_default_storage_bucket_name() -> str | None:
     """Returns the Firebase Storage bucket name from FIREBASE_CONFIG if present."""
     try:
@@ -111,7 +121,8 @@ def _job_paths(job_id: str) -> tuple[str, str]:
 def on_new_quest_card_created(event: firestore_fn.Event[firestore_fn.Change]) -> None:
     """
     Triggered when a new quest card is created.
-    Calculates and stores similarity scores for the new quest.
+    Calculates and stores similarity scores for the new quest, and adds it to
+    the similar quests of existing quests whose top N it now enters.
     """
     from similarity_calculator import calculate_similarity_for_quest  # LAZY IMPORT
 
@@ -126,6 +137,78 @@ def on_new_quest_card_created(event: firestore_fn.Event[firestore_fn.Change]) ->
         logging.error(f"Error calculating similarity for quest {quest_id}: {e}")
         # Optionally, re-raise the exception if you want the function to be marked as failed
         # raise e
+        return
+
+    # Stamp the scored content so later unrelated updates don't recompute.
+    try:
+        from similarity_features import (  # LAZY IMPORT
+            SIMILARITY_FINGERPRINT_FIELD,
+            similarity_fingerprint,
+        )
+
+        data = event.data.to_dict() if event.data is not None else None
+        if data is not None:
+            firestore.client().collection("questCards").document(quest_id).update(
+                {SIMILARITY_FINGERPRINT_FIELD: similarity_fingerprint(data)}
+            )
+    except Exception as e:
+        logging.warning(f"Could not store similarity fingerprint for {quest_id}: {e}")
+
+
+@firestore_fn.on_document_updated(
+    document="questCards/{questId}", memory=options.MemoryOption.MB_512
+)
+def on_quest_card_updated_similarity(
+    event: firestore_fn.Event[firestore_fn.Change],
+) -> None:
+    """
+    Triggered when a quest card is updated.
+    Recomputes similarity only when a field that affects scoring changed, as
+    detected by comparing the content fingerprint with the one stored on the
+    quest. Writes that leave the fingerprint unchanged return without any
+    reads or scoring. Quests that already list the edited quest get its new
+    score (or drop it when it falls below their list's floor) from the
+    reciprocal pass of the recalculation.
+    """
+    from similarity_features import (  # LAZY IMPORT
+        SIMILARITY_FINGERPRINT_FIELD,
+        feature_source,
+        similarity_fingerprint,
+    )
+
+    quest_id = event.params["questId"]
+    try:
+        before, after = _get_change_before_after(event.data)
+        if after is None:
+            return
+
+        new_data = _snapshot_to_dict(after) or {}
+        fingerprint = similarity_fingerprint(new_data)
+        if new_data.get(SIMILARITY_FINGERPRINT_FIELD) == fingerprint:
+            return
+
+        old_data = _snapshot_to_dict(before)
+        quest_ref = firestore.client().collection("questCards").document(quest_id)
+
+        if (
+            not new_data.get(SIMILARITY_FINGERPRINT_FIELD)
+            and old_data is not None
+            and feature_source(old_data) == feature_source(new_data)
+        ):
+            # Quest predates fingerprints and this write didn't touch scored
+            # fields: record the fingerprint without recomputing.
+            quest_ref.update({SIMILARITY_FINGERPRINT_FIELD: fingerprint})
+            return
+
+        from similarity_calculator import calculate_similarity_for_quest  # LAZY IMPORT
+
+        logging.info(f"Scored fields changed for {quest_id}. Recalculating similarity.")
+        # Raises if the results weren't stored; the fingerprint is then left
+        # alone so the next write recomputes.
+        calculate_similarity_for_quest(quest_id)
+        quest_ref.update({SIMILARITY_FINGERPRINT_FIELD: fingerprint})
+    except Exception as e:
+        logging.error(f"Error recalculating similarity for quest {quest_id}: {e}")
 
 
 @https_fn.on_call(memory=options.MemoryOption.MB_256)
@@ -652,33 +735,61 @@ def report_client_error_http(req: https_fn.Request) -> https_fn.Response:
 def search_quests(req: https_fn.CallableRequest) -> https_fn.Response | dict:
     """Callable function that performs text+field search across questCards.
 
-    Accepts data: { query: str, filters: dict (optional), page: int, pageSize: int }
-    Returns: { total, page, pageSize, hits: [ {id,title,snippet,score} ] }
+    Accepts data: { query: str, filters: dict (optional), page: int, pageSize: int,
+                    cursor: str (optional, replaces page), facets: bool (optional) }
+    Returns: { total, page, pageSize, hits: [ {id,title,snippet,score} ], nextCursor,
+               facets (if requested): { field: [ {value, count} ] }, facetsPartial }
+
+    `nextCursor` (None on the last page) continues the same ranked result:
+    the instance's cached ranking is sliced without re-ranking, and if it is
+    gone the recomputed ranking resumes after the previous page's last hit.
+
+    Facets count all hits per standardizedGameSystem, level, genre and
+    classification value. On the Firestore query path (cold instances) they
+    cover the scored candidates only, and `facetsPartial` is true.
+
+    Each request emits one structured log record of per-stage timings and
+    counters (see search_trace.py), also returned as `_timings` when
+    SEARCH_DEBUG_TIMINGS=1.
     """
+    from search_trace import SearchTrace, debug_timings_enabled  # LAZY IMPORT
+
+    trace = SearchTrace()
     try:
         data = req.data or {}
         query_text = data.get("query", "")
         filters = data.get("filters", {})
-        page = int(data.get("page", 1))
-        page_size = int(data.get("pageSize", 10))
+        page = max(1, int(data.get("page", 1)))
+        page_size = max(1, int(data.get("pageSize", 10)))
+        want_facets = bool(data.get("facets"))
 
         # Lazy import of the core search logic
-        from search import search_quests_core
+        from search import (
+            SEARCH_INDEX_READ_FIELDS,
+            SEARCH_PREFETCH_HITS,
+            apply_filter_clauses,
+            cursor_offset,
+            decode_cursor,
+            encode_cursor,
+            fetch_fuzzy_candidates,
+            fetch_token_candidates,
+            plan_filter_pushdown,
+            quests_from_index_docs,
+            record_search_path,
+            search_quests_core,
+        )
 
         # Initialize Firestore client (app already initialized at module level)
         db = firestore.client()
 
         # Use a candidate-based approach via questSearchIndex to avoid streaming
-        # every quest on each search. Also use a small in-memory TTL cache to
-        # reduce repeated work when the same query is being executed quickly.
+        # every quest on each search. Only the top hits needed for the first
+        # pages are ranked; they are cached per instance (LRU + TTL, bounded in
+        # bytes) and invalidated by index writes through the search index
+        # generation counter.
+        from search_cache import current_generation, estimate_bytes, get_cache
 
-        # Simple in-function cache (helps warm instances keep recent results)
-        # key -> {expires_at: float, hits: [..], total: int}
-        global _search_cache
-        try:
-            _search_cache
-        except NameError:
-            _search_cache = {}
+        result_cache = get_cache()
 
         # Canonicalize filters into a stable string for cache key
         def _filters_key(flt):
@@ -694,97 +805,252 @@ def search_quests(req: https_fn.CallableRequest) -> https_fn.Response | dict:
             return "|".join(parts)
 
         cache_key = (query_text or "").strip().lower() + "|" + _filters_key(filters)
-        CACHE_TTL = 30
         candidate_limit = 200
 
-        now = time.time()
-        cached = _search_cache.get(cache_key)
-        if cached and cached.get("expires_at", 0) > now:
-            # We have full cached hits; slice for pagination and return
-            all_hits = cached["hits"]
-            total = cached.get("total", len(all_hits))
-            start = (page - 1) * page_size
-            end = start + page_size
-            return {
+        # An opaque cursor from a previous response continues that result
+        # instead of a page number (see search.encode_cursor).
+        cursor = None
+        if data.get("cursor"):
+            try:
+                cursor = decode_cursor(str(data["cursor"]))
+            except ValueError as e:
+                raise https_fn.HttpsError(
+                    code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+                    message=str(e),
+                )
+            if cursor["k"] != cache_key:
+                raise https_fn.HttpsError(
+                    code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+                    message="Search cursor does not match the query and filters.",
+                )
+
+        # Hits to rank: at least through the requested page.
+        needed = (cursor["o"] if cursor else (page - 1) * page_size) + page_size
+        top_k = max(SEARCH_PREFETCH_HITS, needed)
+
+        def _page(all_hits, total, facets=None, facets_partial=False):
+            start = (
+                cursor_offset(all_hits, cursor)
+                if cursor is not None
+                else (page - 1) * page_size
+            )
+            page_hits = all_hits[start : start + page_size]
+            end = start + len(page_hits)
+            next_cursor = None
+            if page_hits and end < total:
+                next_cursor = encode_cursor(cache_key, generation, end, page_hits[-1])
+            result = {
                 "total": total,
-                "page": page,
+                "page": start // page_size + 1,
                 "pageSize": page_size,
-                "hits": all_hits[start:end],
+                "hits": page_hits,
+                "nextCursor": next_cursor,
             }
+            if want_facets:
+                result["facets"] = facets or {}
+                result["facetsPartial"] = facets_partial
+            trace.set(total=total, cacheStats=result_cache.stats())
+            trace.count("hits", len(page_hits))
+            record = trace.emit()
+            if debug_timings_enabled():
+                result["_timings"] = record
+            return result
+
+        try:
+            with trace.stage("generation"):
+                generation = current_generation(db)
+        except Exception as e:
+            logging.warning(f"search_quests: could not read index generation: {e}")
+            generation = None
+        cached = None
+        if generation is not None:
+            cached = result_cache.get(cache_key, generation)
+        if cached is not None and len(cached["hits"]) < min(needed, cached["total"]):
+            # Cached hits stop before the requested page: rank further.
+            cached = None
+        if cached is not None and want_facets and "facets" not in cached:
+            cached = None
+        trace.set(cache="off" if generation is None else "miss")
+        if cached is not None:
+            # We have the cached top hits; slice for pagination and return
+            trace.set(cache="hit", source="cache")
+            return _page(
+                cached["hits"],
+                cached["total"],
+                cached.get("facets"),
+                cached.get("facetsPartial", False),
+            )
+
+        def _cache_result(unpaginated, facets_partial=False):
+            if generation is None:
+                return
+            hits = unpaginated.get("hits", [])
+            entry = {"hits": hits, "total": unpaginated.get("total", len(hits))}
+            if "facets" in unpaginated:
+                entry["facets"] = unpaginated["facets"]
+                entry["facetsPartial"] = facets_partial
+            result_cache.put(cache_key, generation, entry, estimate_bytes(hits))
+
+        # Warm instances answer from the in-memory corpus kept current by
+        # snapshot listeners (no Firestore reads). Until it is primed, or if
+        # it is stale or disabled, fall through to the Firestore query path.
+        from search_corpus import get_corpus
+
+        corpus = get_corpus(db)
+        unpaginated = None
+        if corpus is not None and corpus.supports_filters(filters):
+            with corpus.lock:
+                if corpus.ready():
+                    unpaginated, path = corpus.search(
+                        query_text,
+                        filters,
+                        top_k=top_k,
+                        trace=trace,
+                        facets=want_facets,
+                    )
+            if unpaginated is None:
+                trace.set(corpus=corpus.status())
+            else:
+                trace.set(source="memory", path=path, paths=record_search_path(path))
+
+        if unpaginated is not None:
+            all_hits = unpaginated.get("hits", [])
+            _cache_result(unpaginated)
+            return _page(
+                all_hits,
+                unpaginated.get("total", len(all_hits)),
+                unpaginated.get("facets"),
+            )
+
+        trace.set(source="firestore")
 
         # Tokenize the query for candidate selection using indexer._tokenize
-        tokens = list(_tokenize(query_text or ""))
+        with trace.stage("tokenize"):
+            tokens = list(_tokenize(query_text or ""))
+
+        # The candidate query returns the index documents themselves; current
+        # schema documents carry every scoring/filter field, so only outdated
+        # ones (or unindexed filter fields) need a questCards read.
+        # Filters on indexed fields are pushed into the queries as `where`
+        # clauses, so the candidate limit is not used up by quests they
+        # exclude; the rest are applied in Python by search_quests_core.
+        clauses, residual = plan_filter_pushdown(filters)
+        query_plan = {
+            "where": [f"{field} {op} {value!r}" for field, op, value in clauses],
+            "python": sorted(residual),
+        }
+        candidate_snaps = []
+        query_failed = False
+        path = "exact"
+
+        def _candidates(clauses):
+            # One array_contains_any query per 10 tokens, run concurrently;
+            # candidates matching the most query tokens are kept.
+            with trace.stage("candidates"):
+                snaps = fetch_token_candidates(
+                    db, tokens, candidate_limit, clauses, trace=trace
+                )
+            if snaps:
+                return snaps, "exact"
+            # Likely a misspelling: look up tokens with close spellings.
+            with trace.stage("fuzzyCandidates"):
+                snaps = fetch_fuzzy_candidates(
+                    db, tokens, candidate_limit, clauses, trace=trace
+                )
+            return snaps, "fuzzy"
 
-        candidate_ids = []
         if tokens:
-            # Firestore supports up to 10 elements for array-contains-any
-            tokens_for_query = tokens[:10]
             try:
-                idx_coll = db.collection("questSearchIndex")
-                q = idx_coll.where(
-                    "tokens", "array_contains_any", tokens_for_query
-                ).limit(candidate_limit)
-                for doc in q.stream():
-                    candidate_ids.append(doc.id)
-            except Exception:
-                # In case index queries fail, fall back to scanning the full quests set
-                candidate_ids = []
-
-        quests = []
-
-        # Fetch full quest documents for found candidate IDs (preserves fields used in scoring)
-        if candidate_ids:
-            for cid in candidate_ids:
                 try:
-                    d = db.collection("questCards").document(cid).get()
-                    if d.exists:
-                        qd = d.to_dict() or {}
-                        qd["id"] = d.id
-                        quests.append(qd)
-                except Exception:
-                    continue
+                    candidate_snaps, path = _candidates(clauses)
+                except Exception as e:
+                    if not clauses:
+                        raise
+                    # E.g. a composite index not deployed yet.
+                    logging.warning(
+                        f"search_quests: filter pushdown failed, "
+                        f"filtering in Python: {e}"
+                    )
+                    clauses = []
+                    query_plan["fallback"] = "python"
+                    candidate_snaps, path = _candidates(clauses)
+            except Exception as e:
+                logging.warning(f"search_quests: candidate query failed: {e}")
+                candidate_snaps = []
+                query_failed = True
+        trace.count("candidates", len(candidate_snaps))
 
-        # If we didn't find any candidates (or tokenization produced nothing),
-        # fall back to scanning quests (safe but slower for small datasets)
-        if not quests:
-            docs = db.collection("questCards").stream()
-            for d in docs:
-                q = d.to_dict() or {}
-                q["id"] = d.id
-                quests.append(q)
-
-        # Run the existing core search over this smaller candidate set.
-        # Request a large page size to compute full sorted results, then cache
-        # the hits so pagination can be served from cache.
+        quests = []
+        fetched = 0
+        if candidate_snaps:
+            try:
+                with trace.stage("fetch"):
+                    quests, fetched = quests_from_index_docs(
+                        db, candidate_snaps, filters
+                    )
+            except Exception as e:
+                logging.warning(f"search_quests: candidate fetch failed: {e}")
+                quests = []
+                query_failed = True
+        trace.count("questCardReads", fetched)
+
+        if not quests and (not tokens or query_failed):
+            # Nothing to look up by (or the lookups failed): scan the whole
+            # index, narrowed by any pushed-down filters. Counted in the path
+            # metrics; should be rare.
+            path = "fullScan"
+            with trace.stage("fullScan"):
+                docs = apply_filter_clauses(db.collection("questSearchIndex"), clauses)
+                docs = list(docs.select(SEARCH_INDEX_READ_FIELDS).stream())
+                quests, fetched = quests_from_index_docs(db, docs, filters)
+            trace.count("indexQueries")
+            trace.count("indexReads", len(docs))
+            trace.count("questCardReads", fetched)
+        elif not quests:
+            # Neither exact nor fuzzy matches: an empty result.
+            path = "none"
+
+        # Run the existing core search over this smaller candidate set,
+        # ranking the top hits as one page, then cache them so later pages
+        # are served from cache.
         unpaginated = search_quests_core(
-            query_text, filters, 1, max(len(quests), 1000), quests
+            query_text,
+            filters,
+            1,
+            top_k,
+            quests,
+            fuzzy=path == "fuzzy",
+            top_k=top_k,
+            trace=trace,
+            facets=want_facets,
+        )
+        trace.set(
+            path=path,
+            plan=query_plan,
+            fallback=path == "fullScan",
+            paths=record_search_path(path),
         )
         all_hits = unpaginated.get("hits", [])
 
-        # Cache the full result for short TTL
-        _search_cache[cache_key] = {
-            "expires_at": now + CACHE_TTL,
-            "hits": all_hits,
-            "total": unpaginated.get("total", len(all_hits)),
-        }
-
-        # Slice for the requested page
-        start = (page - 1) * page_size
-        end = start + page_size
-        page_hits = all_hits[start:end]
+        # Cache the ranked hits so later pages are served from memory. Facets
+        # here count only the candidates fetched, not every matching quest.
+        _cache_result(unpaginated, facets_partial=True)
 
-        result = {
-            "total": len(all_hits),
-            "page": page,
-            "pageSize": page_size,
-            "hits": page_hits,
-        }
-        return result
+        return _page(
+            all_hits,
+            unpaginated.get("total", len(all_hits)),
+            unpaginated.get("facets"),
+            facets_partial=True,
+        )
 
     except https_fn.HttpsError as e:
+        trace.set(error=e.message)
+        trace.emit()
         raise e
     except Exception as e:
         logging.error(f"search_quests error: {e}")
+        trace.set(error=str(e))
+        trace.emit()
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.INTERNAL,
             message="An error occurred while performing search.",
@@ -792,6 +1058,60 @@ def search_quests(req: https_fn.CallableRequest) -> https_fn.Response | dict:
         )
 
 
+@https_fn.on_call(memory=options.MemoryOption.MB_512)
+def autocomplete_quests(req: https_fn.CallableRequest) -> https_fn.Response | dict:
+    """Callable returning completions for a search-box prefix.
+
+    Accepts data: { prefix: str, limit: int (optional) }
+    Returns: { tokens: [ {token, df} ], titles: [ {id, title} ], source }
+
+    Warm instances answer from the search corpus's prefix index (tokens
+    ranked by document frequency). Until it is primed, titles starting with
+    the prefix are looked up with a range query on questSearchIndex.
+    """
+    try:
+        data = req.data or {}
+        prefix = str(data.get("prefix", "") or "").strip()
+        limit = max(1, min(int(data.get("limit", 8)), 20))
+        if not prefix:
+            return {"tokens": [], "titles": [], "source": "none"}
+
+        from search_corpus import get_corpus
+
+        db = firestore.client()
+        corpus = get_corpus(db)
+        if corpus is not None:
+            with corpus.lock:
+                if corpus.can_complete():
+                    result = corpus.prefixes.complete(prefix, limit)
+                    return {**result, "source": "memory"}
+
+        titles = {}
+        for variant in dict.fromkeys([prefix, prefix.capitalize(), prefix.title()]):
+            q = (
+                db.collection("questSearchIndex")
+                .where("title", ">=", variant)
+                .where("title", "<", variant + "\uf8ff")
+                .select(["title"])
+                .limit(limit)
+            )
+            for doc in q.stream():
+                titles.setdefault(doc.id, (doc.to_dict() or {}).get("title", ""))
+        shortest = sorted(titles.items(), key=lambda kv: len(kv[1]))[:limit]
+        return {
+            "tokens": [],
+            "titles": [{"id": qid, "title": title} for qid, title in shortest],
+            "source": "firestore",
+        }
+    except Exception as e:
+        logging.error(f"autocomplete_quests error: {e}")
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INTERNAL,
+            message="An error occurred while fetching suggestions.",
+            details=str(e),
+        )
+
+
 # Firestore trigger to maintain the questSearchIndex entry when a quest is written (create/update/delete)
 @firestore_fn.on_document_written(
     document="questCards/{questId}", memory=options.MemoryOption.MB_512
@@ -805,32 +1125,68 @@ def maintain_search_index(event: firestore_fn.Event[firestore_fn.Change]) -> Non
         if before is not None and after is None:
             # deleted
             delete_index(firestore.client(), quest_id)
+            bump_generation(firestore.client())
             logging.info(f"Deleted search index for {quest_id}")
             return
 
         # For create or update, build index
         if after is not None:
-            # `after` is a firestore.DocumentSnapshot-like object
-            new_data = after
-            # Convert to dict safely
-            try:
-                # If the event object exposes to_dict(), use it
-                qdata = (
-                    new_data.to_dict()
-                    if hasattr(new_data, "to_dict")
-                    else dict(new_data)
-                )
-            except Exception:
-                # Fallback: use raw map
-                qdata = dict(new_data)
+            qdata = _snapshot_to_dict(after)
 
-            index_quest(firestore.client(), quest_id, qdata)
-            logging.info(f"Indexed search for {quest_id}")
+            if not index_quest(firestore.client(), quest_id, qdata):
+                # Nothing indexed changed: cached results stay valid.
+                logging.info(
+                    f"Search index for {quest_id} unchanged, write skipped; "
+                    f"writes={index_write_stats()}"
+                )
+                return
+            # Cached search results on every instance are now stale.
+            bump_generation(firestore.client())
+            logging.info(
+                f"Indexed search for {quest_id}; writes={index_write_stats()}"
+            )
 
     except Exception as e:
         logging.error(f"Error maintaining search index for {quest_id}: {e}")
 
 
+# Firestore trigger to keep the questSimilarityFeatures record in sync with its quest
+@firestore_fn.on_document_written(
+    document="questCards/{questId}", memory=options.MemoryOption.MB_512
+)
+def maintain_similarity_features(event: firestore_fn.Event[firestore_fn.Change]) -> None:
+    from similarity_features import (  # LAZY IMPORT
+        delete_features,
+        feature_source,
+        write_features,
+    )
+
+    quest_id = event.params["questId"]
+    try:
+        before, after = _get_change_before_after(event.data)
+
+        if before is not None and after is None:
+            delete_features(firestore.client(), quest_id)
+            logging.info(f"Deleted similarity features for {quest_id}")
+            return
+
+        if after is None:
+            return
+
+        new_data = _snapshot_to_dict(after) or {}
+        old_data = _snapshot_to_dict(before)
+
+        # Scored fields unchanged: skip re-tokenizing and rewriting.
+        if old_data is not None and feature_source(old_data) == feature_source(new_data):
+            return
+
+        write_features(firestore.client(), quest_id, new_data)
+        logging.info(f"Updated similarity features for {quest_id}")
+
+    except Exception as e:
+        logging.error(f"Error maintaining similarity features for {quest_id}: {e}")
+
+
 @https_fn.on_call(memory=options.MemoryOption.MB_512)
 def backfill_search_index(req: https_fn.CallableRequest) -> https_fn.Response | dict:
     """Callable to backfill search index for all questCards. Returns count processed."""
@@ -863,6 +1219,7 @@ def backfill_search_index(req: https_fn.CallableRequest) -> https_fn.Response |
             logging.warning(f"Could not write backfill run start log: {e}")
 
         processed = backfill_all(db)
+        bump_generation(db)
 
         # Update log entry with results
         try:
@@ -1,22 +1,434 @@
+from __future__ import annotations
+
+import heapq
 import logging
 import os
-from typing import List, Dict, Any
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Tuple
+
+from fuzzy import MAX_QUERY_TRIGRAMS, closest, max_edits, query_trigrams
+from indexer import (
+    INDEX_FILTER_FIELDS,
+    INDEX_SCORING_FIELDS,
+    SEARCH_INDEX_COLLECTION,
+    _tokenize,
+    index_doc_to_quest,
+)
+from search_trace import SearchTrace
+
+if TYPE_CHECKING:
+    from search_index import SearchIndex
 
 # Lightweight server-side search that reuses similarity helpers.
 # Designed to be callable from functions/main.py via https_fn.on_call.
 
+# questCards fields that search_quests_core reads (text, filters and field
+# scoring). Candidate fetches project onto these.
+SEARCH_QUEST_FIELDS = [
+    "title",
+    "summary",
+    *INDEX_SCORING_FIELDS,
+    *INDEX_FILTER_FIELDS,
+]
+# questSearchIndex fields read by the candidate query (schema v2+ documents
+# carry everything search_quests_core needs).
+SEARCH_INDEX_READ_FIELDS = SEARCH_QUEST_FIELDS + ["schemaVersion"]
+# How each search found its candidates: "exact" token match, "fuzzy"
+# trigram match, "none" (no match, empty result) or "fullScan" (every quest
+# scored). Counted per instance and logged with each search.
+search_path_counts: Counter = Counter()
 
-def _snippet_for_query(text: str, query: str, radius: int = 80) -> str:
-    if not text or not query:
+
+def record_search_path(path: str) -> Dict[str, Any]:
+    """Count a search's candidate path; returns the counts and full-scan rate."""
+    search_path_counts[path] += 1
+    total = sum(search_path_counts.values())
+    return {
+        **search_path_counts,
+        "fullScanRate": round(search_path_counts["fullScan"] / total, 4),
+    }
+
+
+# Candidates per get_all call, and how many calls run at once.
+FETCH_CHUNK_SIZE = int(os.environ.get("SEARCH_FETCH_CHUNK_SIZE", "50"))
+FETCH_MAX_WORKERS = int(os.environ.get("SEARCH_FETCH_MAX_WORKERS", "4"))
+# Hits ranked (and cached) per search: enough for the first pages. Requests
+# for later pages rank further.
+SEARCH_PREFETCH_HITS = int(os.environ.get("SEARCH_PREFETCH_HITS", "100"))
+
+
+def fetch_search_quests(
+    db,
+    quest_ids: List[str],
+    chunk_size: int = FETCH_CHUNK_SIZE,
+    max_workers: int = FETCH_MAX_WORKERS,
+    field_paths: List[str] | None = SEARCH_QUEST_FIELDS,
+) -> List[Dict[str, Any]]:
+    """Fetch quest dicts for `quest_ids` with batched, field-masked reads.
+
+    Ids are split into chunks of `chunk_size`, each read with one `get_all`
+    call limited to `field_paths` (None reads whole documents); chunks are
+    fetched concurrently.
+    Missing quests are skipped and the result keeps the order of `quest_ids`.
+    """
+    from concurrent.futures import ThreadPoolExecutor  # LAZY IMPORT
+
+    if not quest_ids:
+        return []
+    coll = db.collection("questCards")
+    chunk_size = max(1, chunk_size)
+    chunks = [
+        quest_ids[i : i + chunk_size] for i in range(0, len(quest_ids), chunk_size)
+    ]
+
+    def fetch(chunk: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        refs = [coll.document(cid) for cid in chunk]
+        for snap in db.get_all(refs, field_paths=field_paths):
+            if snap.exists:
+                quest = snap.to_dict() or {}
+                quest["id"] = snap.id
+                found[snap.id] = quest
+        return found
+
+    if len(chunks) == 1:
+        found = fetch(chunks[0])
+    else:
+        found = {}
+        workers = max(1, min(max_workers, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for part in pool.map(fetch, chunks):
+                found.update(part)
+    return [found[cid] for cid in quest_ids if cid in found]
+
+
+def quests_from_index_docs(
+    db, snaps: Iterable[Any], filters: Dict[str, Any] | None = None
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Quest dicts for questSearchIndex snapshots, plus how many came from questCards.
+
+    Current-schema index documents are used as they are. Documents from an
+    older schema, and every candidate when a filter names a field the index
+    does not carry, are read from questCards with fetch_search_quests.
+    """
+    extra_filters = [
+        k for k, v in (filters or {}).items()
+        if v is not None and k not in SEARCH_QUEST_FIELDS
+    ]
+    quests: List[Dict[str, Any]] = []
+    order: List[str] = []
+    fetch_ids: List[str] = []
+    for snap in snaps:
+        order.append(snap.id)
+        quest = None if extra_filters else index_doc_to_quest(
+            snap.id, snap.to_dict() or {}
+        )
+        if quest is None:
+            fetch_ids.append(snap.id)
+        else:
+            quests.append(quest)
+    if fetch_ids:
+        field_paths = None if extra_filters else SEARCH_QUEST_FIELDS
+        quests.extend(fetch_search_quests(db, fetch_ids, field_paths=field_paths))
+        rank = {qid: i for i, qid in enumerate(order)}
+        quests.sort(key=lambda q: rank[q["id"]])
+    return quests, len(fetch_ids)
+
+
+# Filters on these questSearchIndex fields are applied by the candidate
+# queries themselves; firestore.indexes.json declares a composite index of
+# each with `tokens` and with `trigrams`.
+PUSHDOWN_FIELDS = ("level", "players", "duration") + INDEX_FILTER_FIELDS
+# Firestore allows at most 30 disjunctions per query: array_contains_any
+# values times the values of an `in` clause.
+MAX_QUERY_DISJUNCTIONS = 30
+
+
+def plan_filter_pushdown(
+    filters: Dict[str, Any] | None, array_values: int = MAX_QUERY_TRIGRAMS
+) -> Tuple[List[Tuple[str, str, Any]], Dict[str, Any]]:
+    """Split `filters` into `where` clauses and filters left to Python.
+
+    Scalar values on PUSHDOWN_FIELDS become `==` clauses. One list value
+    becomes an `in` clause if, with `array_values` array_contains_any
+    values, the query stays within Firestore's disjunction limit. The rest
+    (other fields, further or larger lists, empty lists) is returned as the
+    residual; search_quests_core applies every filter either way.
+    """
+    clauses: List[Tuple[str, str, Any]] = []
+    residual: Dict[str, Any] = {}
+    has_in = False
+    for name in sorted(filters or {}):
+        value = filters[name]
+        if value is None:
+            continue
+        if name not in PUSHDOWN_FIELDS:
+            residual[name] = value
+        elif isinstance(value, list):
+            if (
+                has_in
+                or not value
+                or array_values * len(value) > MAX_QUERY_DISJUNCTIONS
+            ):
+                residual[name] = value
+            else:
+                clauses.append((name, "in", value))
+                has_in = True
+        else:
+            clauses.append((name, "==", value))
+    return clauses, residual
+
+
+def apply_filter_clauses(query, clauses: Iterable[Tuple[str, str, Any]]):
+    for field, op, value in clauses:
+        query = query.where(field, op, value)
+    return query
+
+
+# Query tokens per array_contains_any query (Firestore accepts at most 10),
+# and the most such queries one search runs.
+TOKENS_PER_QUERY = 10
+MAX_CANDIDATE_QUERIES = int(os.environ.get("SEARCH_MAX_CANDIDATE_QUERIES", "4"))
+
+
+def fetch_token_candidates(
+    db,
+    tokens: List[str],
+    limit: int,
+    clauses: Iterable[Tuple[str, str, Any]] = (),
+    max_workers: int = FETCH_MAX_WORKERS,
+    trace: SearchTrace | None = None,
+) -> List[Any]:
+    """questSearchIndex snapshots containing a query token, most matched first.
+
+    Tokens are split into groups of TOKENS_PER_QUERY, one `array_contains_any`
+    query each (narrowed by the filter `clauses`, up to `limit` documents),
+    run concurrently. Tokens beyond MAX_CANDIDATE_QUERIES groups are dropped.
+    The merged, deduplicated candidates are ordered by how many distinct
+    query tokens they contain and cut to `limit`. Queries and documents
+    read are counted on `trace`.
+    """
+    from concurrent.futures import ThreadPoolExecutor  # LAZY IMPORT
+
+    tokens = list(dict.fromkeys(tokens))[: TOKENS_PER_QUERY * MAX_CANDIDATE_QUERIES]
+    if not tokens:
+        return []
+    groups = [
+        tokens[i : i + TOKENS_PER_QUERY]
+        for i in range(0, len(tokens), TOKENS_PER_QUERY)
+    ]
+    coll = db.collection(SEARCH_INDEX_COLLECTION)
+
+    def fetch(group: List[str]) -> List[Any]:
+        q = apply_filter_clauses(
+            coll.where("tokens", "array_contains_any", group), clauses
+        ).limit(limit)
+        return list(q.select(SEARCH_INDEX_READ_FIELDS + ["tokens"]).stream())
+
+    if len(groups) == 1:
+        results = [fetch(groups[0])]
+    else:
+        workers = max(1, min(max_workers, len(groups)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(fetch, groups))
+    if trace is not None:
+        trace.count("indexQueries", len(groups))
+        trace.count("indexReads", sum(len(snaps) for snaps in results))
+
+    merged: Dict[str, Any] = {}
+    for snaps in results:
+        for snap in snaps:
+            merged.setdefault(snap.id, snap)
+    query_tokens = set(tokens)
+
+    def matched(snap) -> int:
+        doc_tokens = (snap.to_dict() or {}).get("tokens") or []
+        return len(query_tokens.intersection(doc_tokens))
+
+    # Stable: equally matched candidates keep query order.
+    return sorted(merged.values(), key=matched, reverse=True)[:limit]
+
+
+def fetch_fuzzy_candidates(
+    db,
+    tokens: List[str],
+    limit: int,
+    clauses: Iterable[Tuple[str, str, Any]] = (),
+    max_workers: int = FETCH_MAX_WORKERS,
+    trace: SearchTrace | None = None,
+) -> List[Any]:
+    """questSearchIndex snapshots whose tokens are close to a query token.
+
+    Each of the query tokens' trigrams (see fuzzy.query_trigrams) gets its own
+    `array_contains` query, narrowed by the filter `clauses` and limited to
+    `limit` documents, run concurrently. One query over all trigrams would
+    return the first `limit` documents (by id) sharing any of them, which
+    common trigrams fill with unrelated quests. The merged candidates are
+    ranked by how many of the trigrams they share, and up to `limit` are kept
+    if one of their tokens is within the edit budget of a query token.
+    Queries and documents read are counted on `trace`.
+    """
+    from concurrent.futures import ThreadPoolExecutor  # LAZY IMPORT
+
+    grams = query_trigrams(tokens)
+    if not grams:
+        return []
+    coll = db.collection(SEARCH_INDEX_COLLECTION)
+
+    def fetch(gram: str) -> List[Any]:
+        q = apply_filter_clauses(
+            coll.where("trigrams", "array_contains", gram), clauses
+        ).limit(limit)
+        return list(q.select(SEARCH_INDEX_READ_FIELDS + ["tokens"]).stream())
+
+    workers = max(1, min(max_workers, len(grams)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(fetch, grams))
+    if trace is not None:
+        trace.count("indexQueries", len(grams))
+        trace.count("indexReads", sum(len(snaps) for snaps in results))
+
+    merged: Dict[str, Any] = {}
+    shared: Dict[str, int] = {}
+    for snaps in results:
+        for snap in snaps:
+            merged.setdefault(snap.id, snap)
+            shared[snap.id] = shared.get(snap.id, 0) + 1
+
+    fuzzy_tokens = [t for t in tokens if max_edits(t)]
+    verified = []
+    # Stable: equally shared candidates keep query order.
+    for snap in sorted(merged.values(), key=lambda s: shared[s.id], reverse=True):
+        doc_tokens = (snap.to_dict() or {}).get("tokens") or []
+        if any(closest(t, doc_tokens) for t in fuzzy_tokens):
+            verified.append(snap)
+            if len(verified) == limit:
+                break
+    return verified
+
+
+def encode_cursor(
+    cache_key: str, generation, offset: int, last_hit: Dict[str, Any]
+) -> str:
+    """Opaque cursor for the page after `offset` hits of a ranked result.
+
+    It names the result (cache key and index generation) and the last hit
+    returned, so the next page can be sliced from the instance's cached
+    ranking or, if that is gone, located again in a recomputed one.
+    """
+    import base64  # LAZY IMPORT
+    import json  # LAZY IMPORT
+
+    payload = {
+        "k": cache_key,
+        "g": generation,
+        "o": offset,
+        "i": last_hit.get("id"),
+        "s": last_hit.get("score"),
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor."""
+    import base64  # LAZY IMPORT
+    import json  # LAZY IMPORT
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw.decode("utf-8"))
+        # Store coerced values: callers do arithmetic and comparisons on them.
+        payload["o"] = max(0, int(payload["o"]))
+        if not isinstance(payload["k"], str):
+            raise TypeError("k must be a string")
+        if payload.get("s") is not None:
+            payload["s"] = float(payload["s"])
+    except Exception as e:
+        raise ValueError(f"Invalid search cursor: {e}") from None
+    return payload
+
+
+def cursor_offset(hits: List[Dict[str, Any]], cursor: Dict[str, Any]) -> int:
+    """Where the page after `cursor` starts in `hits`.
+
+    The stored offset is used while the hit before it is still the cursor's
+    last hit (the same ranking). Otherwise the ranking changed: resume after
+    the last hit's id, or failing that, at the first hit scoring below it.
+    """
+    offset = max(0, int(cursor["o"]))
+    if 0 < offset <= len(hits) and hits[offset - 1].get("id") == cursor.get("i"):
+        return offset
+    for i, hit in enumerate(hits):
+        if hit.get("id") == cursor.get("i"):
+            return i + 1
+    last_score = cursor.get("s")
+    if last_score is None:
+        return min(offset, len(hits))
+    for i, hit in enumerate(hits):
+        if hit.get("score", 0.0) < last_score:
+            return i
+    return len(hits)
+
+
+# Occurrences of each query term considered when placing a snippet.
+SNIPPET_MAX_OCCURRENCES = 50
+
+
+def _snippet_terms(query: str) -> List[str]:
+    """Distinct query words to highlight (stopwords and 1-letter words dropped)."""
+    return list(dict.fromkeys(_tokenize(query)))
+
+
+def _term_window(lowered: str, terms: List[str], span: int) -> Tuple[int, int]:
+    """(position, length) of the densest cluster of query-term occurrences.
+
+    A cluster starts at an occurrence and takes in those starting within
+    `span` characters; the one with the most distinct `terms` wins (the
+    earliest on ties). (-1, 0) if no term occurs.
+    """
+    hits: List[Tuple[int, str]] = []
+    for term in terms:
+        pos = lowered.find(term)
+        for _ in range(SNIPPET_MAX_OCCURRENCES):
+            if pos == -1:
+                break
+            hits.append((pos, term))
+            pos = lowered.find(term, pos + 1)
+    if not hits:
+        return -1, 0
+    hits.sort()
+    best, best_count = (-1, 0), 0
+    for i, (pos, _) in enumerate(hits):
+        covered = set()
+        end = pos
+        for p, t in hits[i:]:
+            if p > pos + span:
+                break
+            covered.add(t)
+            end = max(end, p + len(t))
+        if len(covered) > best_count:
+            best, best_count = (pos, end - pos), len(covered)
+    return best
+
+
+def _snippet(
+    text: str, lowered: str, phrase: str, terms: List[str], radius: int = 80
+) -> str:
+    """Excerpt of `text` around the query `phrase`, else around query `terms`.
+
+    `lowered` is `text` lowercased (held by the SearchIndex).
+    """
+    if not text or not phrase:
         return ""
-    q = query.lower()
-    t = text.lower()
-    idx = t.find(q)
+    idx, length = lowered.find(phrase), len(phrase)
+    if idx == -1:
+        idx, length = _term_window(lowered, terms, radius // 2)
     if idx == -1:
         # fallback to start
         return text[:radius].strip()
     start = max(0, idx - radius // 4)
-    end = min(len(text), idx + len(q) + radius // 2)
+    end = min(len(text), idx + length + radius // 2)
     return (
         ("..." if start > 0 else "")
         + text[start:end].strip()
@@ -24,26 +436,53 @@ def _snippet_for_query(text: str, query: str, radius: int = 80) -> str:
     )
 
 
+def _snippet_for_query(text: str, query: str, radius: int = 80) -> str:
+    if not text or not query:
+        return ""
+    return _snippet(text, text.lower(), query.lower(), _snippet_terms(query), radius)
+
+
 def search_quests_core(
     query: str,
     filters: Dict[str, Any],
     page: int,
     page_size: int,
     quests: List[Dict[str, Any]],
+    index: "SearchIndex | None" = None,
+    only_matching: bool = False,
+    fuzzy: bool = False,
+    top_k: int | None = None,
+    trace: SearchTrace | None = None,
+    facets: bool = False,
 ) -> Dict[str, Any]:
     """Pure function for searching over an in-memory list of quest dicts.
 
     Each quest dict should at minimum contain: id, title, summary and various
     fields (level, players, duration, tags, environment, common_monsters).
     Returns a paginated dict with hits sorted by score.
+
+    Text relevance is BM25 from a SearchIndex over `quests`. Pass a prebuilt
+    `index` (whose quests are then searched) to avoid re-indexing per call.
+    With `only_matching`, quests containing none of the query terms are left
+    out, like the candidate query in main.search_quests. With `fuzzy`,
+    misspelled query terms also match close vocabulary terms.
+
+    With `top_k`, only the best `top_k` hits are ranked and materialized
+    (quests that cannot reach them are skipped using score upper bounds);
+    pages beyond them are empty, while `total` still counts every hit.
+
+    With `facets`, the result also has `facets`: per FACET_FIELDS field, the
+    hit count of each value (see SearchIndex.facet_counts).
+
+    Ranking and snippet building are timed as stages of `trace`.
     """
     # Lazy imports that can be expensive in cloud functions.
     try:
         from similarity_calculator import (
-            _calculate_text_similarity,
             _calculate_field_match_score,
             HYBRID_APPROACH_WEIGHTING,
         )
+        from search_index import FACET_FIELDS, SearchIndex
     except Exception as e:
         logging.error("Failed to import similarity helpers: %s", e)
         raise
@@ -55,7 +494,10 @@ def search_quests_core(
     # Suggestions only: return short title suggestions matching the query
     if not query:
         # No query; return empty results or all depending on client.
-        return {"total": 0, "page": page, "pageSize": page_size, "hits": []}
+        out = {"total": 0, "page": page, "pageSize": page_size, "hits": []}
+        if facets:
+            out["facets"] = {field: [] for field in FACET_FIELDS}
+        return out
 
     # Basic filtering: apply equality filters for level/players/duration if provided
     def passes_filters(quest: Dict[str, Any]) -> bool:
@@ -73,78 +515,185 @@ def search_quests_core(
                     return False
         return True
 
-    candidates = [q for q in quests if passes_filters(q)]
-
-    results = []
-
-    for q in candidates:
-        title = q.get("title", "")
-        summary = q.get("summary", "")
+    if index is None:
+        index = SearchIndex(quests)
+    if trace is None:
+        trace = SearchTrace()
 
-        title_sim = _calculate_text_similarity(query, title)
-        summary_sim = _calculate_text_similarity(query, summary)
-        combined_text_score = (title_sim + summary_sim) / 2
+    # For field match we supply the query as an empty target object and use
+    # the quest fields directly — field score will be low for free text queries
+    # but this keeps hybrid approach consistent.
+    # We construct a dummy target that may include filters to boost matches
+    target = {}
+    for f in [
+        "level",
+        "players",
+        "duration",
+        "common_monsters",
+        "environment",
+        "tags",
+    ]:
+        if filters and f in filters:
+            target[f] = filters[f]
+    field_weights = {
+        "level": 0.3,
+        "players": 0.2,
+        "duration": 0.1,
+        "common_monsters": 0.2,
+        "environment": 0.1,
+        "tags": 0.1,
+    }
+    field_weight = HYBRID_APPROACH_WEIGHTING["field_matching_score"]
+    text_weight = HYBRID_APPROACH_WEIGHTING["text_similarity_score"]
 
-        # For field match we supply the query as an empty target object and use
-        # the quest fields directly — field score will be low for free text queries
-        # but this keeps hybrid approach consistent.
+    def hybrid_score(q: Dict[str, Any], text_score: float) -> float:
         field_score = 0.0
         try:
-            # We construct a dummy target that may include filters to boost matches
-            target = {}
-            for f in [
-                "level",
-                "players",
-                "duration",
-                "common_monsters",
-                "environment",
-                "tags",
-            ]:
-                if filters and f in filters:
-                    target[f] = filters[f]
-            field_score = _calculate_field_match_score(
-                target,
-                q,
-                {
-                    "level": 0.3,
-                    "players": 0.2,
-                    "duration": 0.1,
-                    "common_monsters": 0.2,
-                    "environment": 0.1,
-                    "tags": 0.1,
-                },
-            )
+            field_score = _calculate_field_match_score(target, q, field_weights)
         except Exception:
             field_score = 0.0
+        return float(field_score * field_weight + text_score * text_weight)
 
-        hybrid_score = (
-            field_score * HYBRID_APPROACH_WEIGHTING["field_matching_score"]
-            + combined_text_score * HYBRID_APPROACH_WEIGHTING["text_similarity_score"]
-        )
+    phrase = query.lower()
+    snippet_terms = _snippet_terms(query)
 
-        results.append(
-            {
-                "id": q.get("id"),
-                "title": title,
-                "snippet": _snippet_for_query(summary or title, query),
-                "score": float(hybrid_score),
-            }
-        )
+    def make_hit(doc: int, score: float) -> Dict[str, Any]:
+        q = index.quests[doc]
+        field = "summary" if q.get("summary") else "title"
+        text = str(q.get(field, "") or "")
+        if field in index.fields:
+            lowered = index.lowered(doc, field)
+        else:
+            lowered = text.lower()
+        return {
+            "id": q.get("id"),
+            "title": q.get("title", ""),
+            "snippet": _snippet(text, lowered, phrase, snippet_terms),
+            "score": score,
+        }
+
+    with trace.stage("rank"):
+        if top_k is not None:
+            hit_docs, ranked = _rank_top_k(
+                index,
+                query,
+                max(1, int(top_k)),
+                passes_filters,
+                hybrid_score,
+                # Upper bound of the field part of the hybrid score.
+                field_weight if target else 0.0,
+                text_weight,
+                only_matching,
+                fuzzy,
+            )
+            total = len(hit_docs)
+        else:
+            # Only documents in the query terms' posting lists have text
+            # relevance.
+            text_scores = index.text_scores(query, fuzzy=fuzzy)
+
+            ranked = []
 
-    # Sort by score descending
-    results.sort(key=lambda x: x["score"], reverse=True)
+            for doc, q in index.live_quests():
+                if only_matching and doc not in text_scores:
+                    continue
+                if not passes_filters(q):
+                    continue
+                combined_text_score = text_scores.get(doc, 0.0)
+                ranked.append((hybrid_score(q, combined_text_score), doc))
 
-    total = len(results)
+            # Sort by score descending
+            ranked.sort(key=lambda x: x[0], reverse=True)
+            total = len(ranked)
+            hit_docs = [doc for _, doc in ranked]
+    trace.count("scored", len(ranked))
+
+    # Hits (and their snippets) are built for the returned page only.
     start = (page - 1) * page_size
     end = start + page_size
-    page_hits = results[start:end]
+    with trace.stage("snippets"):
+        page_hits = [make_hit(doc, score) for score, doc in ranked[start:end]]
 
-    return {
+    out = {
         "total": total,
         "page": page,
         "pageSize": page_size,
         "hits": page_hits,
     }
+    if facets:
+        with trace.stage("facets"):
+            out["facets"] = index.facet_counts(index.doc_mask(hit_docs))
+    return out
+
+
+def _rank_top_k(
+    index: "SearchIndex",
+    query: str,
+    k: int,
+    passes_filters: Callable[[Dict[str, Any]], bool],
+    hybrid_score: Callable[[Dict[str, Any], float], float],
+    field_bound: float,
+    text_weight: float,
+    only_matching: bool,
+    fuzzy: bool,
+) -> Tuple[List[int], List[Tuple[float, int]]]:
+    """(every hit's doc, top `k` (score, doc) pairs in full-ranking order).
+
+    Quests are visited in descending text score, and the visit stops once
+    `field_bound + text_weight * text` cannot reach the k-th best hybrid score
+    so far. Without field scoring (`field_bound` 0) the text scores are also
+    computed with MaxScore pruning. Ties keep index order, as the stable full
+    sort does.
+    """
+    accepted: Dict[int, bool] = {}
+
+    def accept(doc: int) -> bool:
+        ok = accepted.get(doc)
+        if ok is None:
+            ok = accepted[doc] = passes_filters(index.quests[doc])
+        return ok
+
+    text_scores = index.text_scores(
+        query, fuzzy=fuzzy, top_k=None if field_bound else k, accept=accept
+    )
+    # Every quest with a text match, including any pruned from text_scores.
+    matching = index.matching_docs(query, fuzzy)
+    if only_matching:
+        hit_docs = [doc for doc in matching if accept(doc)]
+    else:
+        hit_docs = [doc for doc, _ in index.live_quests() if accept(doc)]
+
+    # Min-heap of the best k as (score, -doc): the root is the entry the
+    # full ranking would place last.
+    best: List[Tuple[float, int]] = []
+    by_text = [(-score, doc) for doc, score in text_scores.items()]
+    heapq.heapify(by_text)
+    while by_text:
+        neg_text, doc = heapq.heappop(by_text)
+        bound = field_bound + text_weight * -neg_text
+        if len(best) == k and bound < best[0][0]:
+            break
+        if not accept(doc):
+            continue
+        entry = (hybrid_score(index.quests[doc], -neg_text), -doc)
+        if len(best) < k:
+            heapq.heappush(best, entry)
+        elif entry > best[0]:
+            heapq.heapreplace(best, entry)
+
+    if not only_matching and (len(best) < k or best[0][0] <= field_bound):
+        # Quests without text matches score on their fields alone.
+        for doc, q in index.live_quests():
+            if doc in matching or not accept(doc):
+                continue
+            entry = (hybrid_score(q, 0.0), -doc)
+            if len(best) < k:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+
+    ranked = sorted(best, reverse=True)
+    return hit_docs, [(score, -neg_doc) for score, neg_doc in ranked]
 
 
 if __name__ == "__main__":
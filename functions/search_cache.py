@@ -0,0 +1,176 @@
+"""Bounded, invalidation-aware cache of search results.
+
+SearchResultCache is an LRU with a TTL and a byte budget. Each entry is
+stored with the search index generation it was computed at, and a lookup
+under a different generation is a miss, so a quest write invalidates every
+cached result at once.
+
+The generation is a counter in `searchIndexMeta/state` that
+`maintain_search_index` increments after each index write. Instances follow
+it with a document listener (no reads per search); until the listener has
+delivered a value, the document is read directly.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+SEARCH_META_COLLECTION = "searchIndexMeta"
+SEARCH_META_DOC = "state"
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "30"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "512"))
+SEARCH_CACHE_MAX_BYTES = int(
+    os.environ.get("SEARCH_CACHE_MAX_BYTES", str(16 * 1024 * 1024))
+)
+# Rough per-hit and per-entry overhead on top of the strings themselves.
+HIT_OVERHEAD_BYTES = 200
+ENTRY_OVERHEAD_BYTES = 500
+
+
+def estimate_bytes(hits) -> int:
+    size = ENTRY_OVERHEAD_BYTES
+    for hit in hits:
+        size += HIT_OVERHEAD_BYTES
+        size += len(str(hit.get("id", ""))) + len(hit.get("title", "") or "")
+        size += len(hit.get("snippet", "") or "")
+    return size
+
+
+class SearchResultCache:
+    """LRU + TTL cache with byte accounting, keyed by query and generation."""
+
+    def __init__(
+        self,
+        max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+        max_bytes: int = SEARCH_CACHE_MAX_BYTES,
+        ttl: float = SEARCH_CACHE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (generation, expires_at, bytes, value)
+        self._entries: "OrderedDict[str, Tuple[Any, float, int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "invalidated": 0,
+            "evictions": 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str, generation) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            entry_generation, expires_at, _, value = entry
+            if entry_generation != generation or expires_at <= time.time():
+                reason = "invalidated" if entry_generation != generation else "expired"
+                self.counters[reason] += 1
+                self.counters["misses"] += 1
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return value
+
+    def put(self, key: str, generation, value: Any, size: int) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (generation, time.time() + self.ttl, size, value)
+            self.bytes += size
+            now = time.time()
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                oldest, (_, expires_at, _, _) = next(iter(self._entries.items()))
+                if expires_at > now:
+                    self.counters["evictions"] += 1
+                self._drop(oldest)
+
+    def _drop(self, key: str) -> None:
+        _, _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "entries": len(self._entries), "bytes": self.bytes}
+
+
+class GenerationTracker:
+    """Follows the search index generation counter with a document listener."""
+
+    def __init__(self, db):
+        self._db = db
+        self._watch = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _ref(self):
+        return self._db.collection(SEARCH_META_COLLECTION).document(SEARCH_META_DOC)
+
+    def _on_snapshot(self, docs, changes, read_time) -> None:
+        for doc in docs:
+            data = doc.to_dict() or {}
+            self._generation = data.get("generation", 0)
+
+    def current(self):
+        """The current generation (0 before the first index write)."""
+        with self._lock:
+            if self._watch is None or not getattr(self._watch, "is_active", True):
+                self._generation = None
+                try:
+                    self._watch = self._ref().on_snapshot(self._on_snapshot)
+                except Exception as e:
+                    logging.warning(f"Search cache: generation listener failed: {e}")
+                    self._watch = None
+        generation = self._generation
+        if generation is None:
+            # Listener not delivered yet: read the counter directly.
+            snap = self._ref().get()
+            data = (snap.to_dict() or {}) if snap.exists else {}
+            generation = data.get("generation", 0)
+        return generation
+
+
+def bump_generation(db) -> None:
+    """Invalidate cached search results on every instance."""
+    from firebase_admin import firestore  # LAZY IMPORT
+
+    db.collection(SEARCH_META_COLLECTION).document(SEARCH_META_DOC).set(
+        {"generation": firestore.Increment(1), "updatedAt": firestore.SERVER_TIMESTAMP},
+        merge=True,
+    )
+
+
+_cache = SearchResultCache()
+_tracker: Optional[GenerationTracker] = None
+_tracker_lock = threading.Lock()
+
+
+def get_cache() -> SearchResultCache:
+    return _cache
+
+
+def current_generation(db):
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = GenerationTracker(db)
+    return _tracker.current()
@@ -0,0 +1,293 @@
+"""Warm-instance search corpus kept current by Firestore snapshot listeners.
+
+The first search on an instance starts a listener on `questSearchIndex`,
+whose documents carry each quest's text and every scoring and filter field.
+The initial snapshot primes an in-memory SearchIndex; later snapshots apply
+only the documents that changed. Once primed, searches are answered from
+memory with no Firestore reads. Until then, and whenever the corpus cannot be
+trusted (including while any index document predates the current schema),
+`ready()` is False and callers keep using the Firestore query path.
+
+The same changes maintain a PrefixIndex over titles and index tokens for
+autocomplete (see autocomplete.py).
+
+The corpus is dropped (and stays disabled on this instance) if its estimated
+size exceeds SEARCH_CORPUS_MAX_BYTES. If a listener stops, the corpus is
+marked stale and the listener is restarted on the next request.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from indexer import (
+    INDEX_FILTER_FIELDS,
+    INDEX_SCORING_FIELDS,
+    SEARCH_INDEX_COLLECTION,
+    index_doc_to_quest,
+)
+from autocomplete import PrefixIndex
+from search_index import SearchIndex
+
+SEARCH_CORPUS_ENABLED = os.environ.get("SEARCH_CORPUS_ENABLED", "1") != "0"
+SEARCH_CORPUS_MAX_BYTES = int(
+    os.environ.get("SEARCH_CORPUS_MAX_BYTES", str(96 * 1024 * 1024))
+)
+# Rough per-quest cost of the entry dict, index slots and posting entries, on
+# top of the text itself (which is held in the entry, lowercased for snippets
+# and, as terms, in the postings).
+ENTRY_OVERHEAD_BYTES = 1024
+TEXT_BYTES_FACTOR = 4
+
+FILTERABLE_FIELDS = INDEX_SCORING_FIELDS + INDEX_FILTER_FIELDS
+
+
+def _estimate_bytes(entry: Dict[str, Any], tokens) -> int:
+    text = len(entry.get("title", "")) + len(entry.get("summary", ""))
+    fields = sum(len(str(entry.get(name, ""))) for name in FILTERABLE_FIELDS)
+    # Autocomplete keeps each token plus every word-suffix of the title.
+    prefixes = sum(len(str(t)) for t in tokens) + len(entry.get("title", "")) * 2
+    return ENTRY_OVERHEAD_BYTES + TEXT_BYTES_FACTOR * text + fields + prefixes
+
+
+class SearchCorpus:
+    """Quest search corpus for one instance, kept current by a snapshot listener."""
+
+    def __init__(self, db, max_bytes: int = SEARCH_CORPUS_MAX_BYTES):
+        self._db = db
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.index = SearchIndex()
+        self.prefixes = PrefixIndex()
+        self._bytes: Dict[str, int] = {}
+        self.total_bytes = 0
+        # Ids of index documents from an older schema (no scoring fields).
+        self._outdated: set = set()
+        self._watch = None
+        self.disabled_reason: Optional[str] = None
+        self.primed_at: Optional[float] = None
+        self.last_change_at: Optional[float] = None
+
+    # --- lifecycle ---
+
+    def start(self) -> None:
+        """Start (or restart) the listeners; the corpus re-primes from scratch."""
+        with self.lock:
+            self._stop_watch()
+            self._clear()
+            self.primed_at = None
+            self._watch = self._db.collection(SEARCH_INDEX_COLLECTION).on_snapshot(
+                self._on_snapshot
+            )
+
+    def _clear(self) -> None:
+        self.index = SearchIndex()
+        self.prefixes = PrefixIndex()
+        self._bytes = {}
+        self.total_bytes = 0
+        self._outdated = set()
+
+    def _stop_watch(self) -> None:
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception as e:
+                logging.warning(f"Search corpus: error stopping listener: {e}")
+        self._watch = None
+
+    def _disable(self, reason: str) -> None:
+        logging.warning(f"Search corpus disabled: {reason}")
+        self.disabled_reason = reason
+        self._stop_watch()
+        self._clear()
+
+    def listening(self) -> bool:
+        return self._watch is not None and getattr(self._watch, "is_active", True)
+
+    def stale(self) -> bool:
+        """True once primed if a listener has stopped delivering changes."""
+        return self.primed_at is not None and not self.listening()
+
+    def ready(self) -> bool:
+        return (
+            self.disabled_reason is None
+            and self.primed_at is not None
+            and not self.stale()
+            and not self._outdated
+        )
+
+    def can_complete(self) -> bool:
+        """Autocomplete needs only titles and tokens, which every schema has."""
+        return (
+            self.disabled_reason is None
+            and self.primed_at is not None
+            and not self.stale()
+        )
+
+    def ensure_started(self) -> None:
+        """Start the listeners if they are not running (first use or stale)."""
+        if self.disabled_reason is not None:
+            return
+        if self._watch is None or self.stale():
+            if self._watch is not None:
+                logging.warning("Search corpus listener stopped; restarting.")
+            self.start()
+
+    def status(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "ready": self.ready(),
+            "stale": self.stale(),
+            "disabledReason": self.disabled_reason,
+            "quests": len(self.index),
+            "outdatedDocs": len(self._outdated),
+            "bytes": self.total_bytes,
+            "primedSecondsAgo": (
+                round(now - self.primed_at, 1) if self.primed_at else None
+            ),
+            "lastChangeSecondsAgo": (
+                round(now - self.last_change_at, 1) if self.last_change_at else None
+            ),
+        }
+
+    def supports_filters(self, filters: Optional[Dict[str, Any]]) -> bool:
+        """Whether every active filter is on a field the corpus holds."""
+        return all(
+            key in FILTERABLE_FIELDS
+            for key, value in (filters or {}).items()
+            if value is not None
+        )
+
+    def search(
+        self,
+        query: str,
+        filters,
+        top_k: Optional[int] = None,
+        trace=None,
+        facets: bool = False,
+    ) -> Tuple[Dict[str, Any], str]:
+        """Hits for `query` from memory, plus the candidate path taken.
+
+        Call with `lock` held and only when `ready()`. Quests matching a query
+        term (or, for misspelled terms, a close vocabulary term) are ranked;
+        only a query without any index terms scores every quest ("fullScan").
+        With `top_k`, only the best `top_k` hits are returned (`total` still
+        counts all of them). With `facets`, per-value facet counts of all hits
+        are included. Ranking is timed on `trace`.
+        """
+        from search import search_quests_core  # LAZY IMPORT
+
+        n = top_k or max(len(self.index), 1000)
+        terms = self.index.query_terms(query)
+        if not terms:
+            result = search_quests_core(
+                query,
+                filters,
+                1,
+                n,
+                [],
+                index=self.index,
+                top_k=top_k,
+                trace=trace,
+                facets=facets,
+            )
+            return result, "fullScan"
+        result = search_quests_core(
+            query,
+            filters,
+            1,
+            n,
+            [],
+            index=self.index,
+            only_matching=True,
+            fuzzy=True,
+            top_k=top_k,
+            trace=trace,
+            facets=facets,
+        )
+        if all(term in self.index.postings for term in terms):
+            path = "exact"
+        else:
+            path = "fuzzy" if result.get("hits") else "none"
+        return result, path
+
+    # --- snapshot handling ---
+
+    def _on_snapshot(self, docs, changes, read_time) -> None:
+        try:
+            self._apply_changes(changes)
+        except Exception as e:
+            logging.error(f"Search corpus: error applying changes: {e}")
+            with self.lock:
+                # Never serve from a partially applied snapshot.
+                self.primed_at = None
+                self._stop_watch()
+
+    def _apply_changes(self, changes) -> None:
+        with self.lock:
+            if self.disabled_reason is not None:
+                return
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._set_entry(doc.id, None)
+                else:
+                    self._set_entry(doc.id, doc.to_dict() or {})
+            if self.total_bytes > self.max_bytes:
+                self._disable(
+                    f"estimated {self.total_bytes} bytes exceeds "
+                    f"budget {self.max_bytes}"
+                )
+                return
+            self.last_change_at = time.time()
+            if self.primed_at is None:
+                self.primed_at = time.time()
+                logging.info(
+                    f"Search corpus primed: {len(self.index)} quests, "
+                    f"~{self.total_bytes} bytes, {len(self._outdated)} outdated"
+                )
+
+    def _set_entry(self, quest_id: str, data) -> None:
+        self.total_bytes -= self._bytes.pop(quest_id, 0)
+        self._outdated.discard(quest_id)
+        if data is None:
+            self.index.remove(quest_id)
+            self.prefixes.remove(quest_id)
+            return
+        tokens = data.get("tokens") or []
+        self.prefixes.add(quest_id, data.get("title", ""), tokens)
+        entry = index_doc_to_quest(quest_id, data)
+        if entry is None:
+            self.index.remove(quest_id)
+            self._outdated.add(quest_id)
+            entry = {"title": str(data.get("title", ""))}
+        else:
+            self.index.add(entry)
+        self._bytes[quest_id] = _estimate_bytes(entry, tokens)
+        self.total_bytes += self._bytes[quest_id]
+
+
+_corpus: Optional[SearchCorpus] = None
+_corpus_lock = threading.Lock()
+
+
+def get_corpus(db) -> Optional[SearchCorpus]:
+    """The instance's corpus, starting its listeners on first use.
+
+    Returns None when the corpus is turned off via SEARCH_CORPUS_ENABLED=0.
+    """
+    global _corpus
+    if not SEARCH_CORPUS_ENABLED:
+        return None
+    with _corpus_lock:
+        if _corpus is None:
+            _corpus = SearchCorpus(db)
+        try:
+            _corpus.ensure_started()
+        except Exception as e:
+            logging.error(f"Search corpus: failed to start listeners: {e}")
+    return _corpus
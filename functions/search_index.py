@@ -0,0 +1,419 @@
+"""In-memory inverted index with per-field BM25 scoring for quest search.
+
+The index holds a set of quest dicts and answers text queries by walking only
+the posting lists of the query's terms, instead of fitting a TF-IDF model per
+(query, quest) pair. Quests can be added, replaced and removed one at a time,
+so a long-lived index can follow Firestore changes.
+
+Text is tokenized with text_preprocessing.preprocess_text, the same
+preprocessing the similarity scorer uses, so a term matches here exactly
+when it would have contributed to the old TF-IDF score.
+
+Scoring is BM25 summed over the indexed fields with per-field weights (title
+above summary). Term IDF is corpus-wide: a quest contains a term if any of
+its fields does.
+
+With `fuzzy`, query terms missing from the vocabulary are replaced by nearby
+vocabulary terms (trigram lookup plus edit distance, see fuzzy.py), weighted
+down by their distance.
+
+Facet counts per value of a few quest fields (FACET_FIELDS) are computed by
+intersecting per-value document bitsets with a query's match set.
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+from collections import Counter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from fuzzy import TrigramIndex
+from text_preprocessing import preprocess_text
+
+# Field -> weight in the summed BM25 score.
+SEARCH_FIELD_WEIGHTS = {"title": 2.0, "summary": 1.0}
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Quest fields counted per value by `facet_counts`.
+FACET_FIELDS = ("standardizedGameSystem", "level", "genre", "classification")
+# Slots freed by removals are compacted away once they make up this fraction
+# of the index.
+COMPACT_RATIO = 0.25
+
+
+class SearchIndex:
+    """Posting lists, field lengths and IDF over a mutable set of quests.
+
+    Each quest occupies a document slot; `quests[doc]` is the quest dict (or
+    None for a removed quest) and postings refer to documents by slot.
+    Quests are keyed by their `id` for `add`/`remove`.
+    """
+
+    def __init__(
+        self,
+        quests: Sequence[Dict[str, Any]] = (),
+        field_weights: Dict[str, float] | None = None,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+        facet_fields: Sequence[str] = FACET_FIELDS,
+    ):
+        self.field_weights = dict(field_weights or SEARCH_FIELD_WEIGHTS)
+        self.fields = tuple(self.field_weights)
+        self.facet_fields = tuple(facet_fields)
+        self.k1 = k1
+        self.b = b
+        self._reset()
+        for quest in quests:
+            self._insert(quest)
+
+    def _reset(self) -> None:
+        self.quests: List[Optional[Dict[str, Any]]] = []
+        # term -> {doc: (tf per field...)}
+        self.postings: Dict[str, Dict[int, Tuple[int, ...]]] = {}
+        self._doc_terms: List[Tuple[str, ...]] = []
+        # Lowercased field text per document, for snippets.
+        self._lowered: List[Tuple[str, ...]] = []
+        # facet field -> value -> documents with that value, and the same as
+        # bitsets (bit `doc` set), built on the first facet count after a
+        # change.
+        self._facet_docs: Dict[str, Dict[Any, set]] = {
+            field: {} for field in self.facet_fields
+        }
+        self._facet_bits: Dict[str, Dict[Any, int]] | None = None
+        self._lengths: List[List[int]] = [[] for _ in self.fields]
+        self._slots: Dict[Any, int] = {}
+        self._live = 0
+        self._norms: List[List[float]] | None = None
+        # term -> largest score contribution to any document (for top-k pruning)
+        self._term_bounds: Dict[str, float] = {}
+        # Built on the first fuzzy query, then kept in step with the postings.
+        self._trigrams: TrigramIndex | None = None
+
+    def __len__(self) -> int:
+        return self._live
+
+    def __contains__(self, quest_id) -> bool:
+        return quest_id in self._slots
+
+    def live_quests(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """(doc, quest) for every quest currently in the index, in slot order."""
+        for doc, quest in enumerate(self.quests):
+            if quest is not None:
+                yield doc, quest
+
+    def add(self, quest: Dict[str, Any]) -> None:
+        """Insert `quest`, replacing any quest with the same `id`."""
+        self.remove(quest.get("id"))
+        self._insert(quest)
+
+    def remove(self, quest_id) -> bool:
+        doc = self._slots.pop(quest_id, None)
+        if doc is None:
+            return False
+        for term in self._doc_terms[doc]:
+            plist = self.postings[term]
+            del plist[doc]
+            if not plist:
+                del self.postings[term]
+                if self._trigrams is not None:
+                    self._trigrams.remove(term)
+        for field, value in self._facet_values(self.quests[doc]):
+            docs = self._facet_docs[field][value]
+            docs.discard(doc)
+            if not docs:
+                del self._facet_docs[field][value]
+        self._facet_bits = None
+        self.quests[doc] = None
+        self._doc_terms[doc] = ()
+        self._lowered[doc] = ()
+        for field_lengths in self._lengths:
+            field_lengths[doc] = 0
+        self._live -= 1
+        self._norms = None
+        self._term_bounds = {}
+        if len(self.quests) - self._live > COMPACT_RATIO * len(self.quests):
+            self._compact()
+        return True
+
+    def _compact(self) -> None:
+        live = [quest for _, quest in self.live_quests()]
+        trigrams = self._trigrams
+        self._reset()
+        for quest in live:
+            self._insert(quest)
+        # Compaction does not change the vocabulary.
+        self._trigrams = trigrams
+
+    def _insert(self, quest: Dict[str, Any]) -> None:
+        doc = len(self.quests)
+        texts = [str(quest.get(field, "") or "") for field in self.fields]
+        per_field = [Counter(preprocess_text(text).split()) for text in texts]
+        terms = tuple(set().union(*per_field))
+        for term in terms:
+            tfs = tuple(counts.get(term, 0) for counts in per_field)
+            plist = self.postings.get(term)
+            if plist is None:
+                plist = self.postings[term] = {}
+                if self._trigrams is not None:
+                    self._trigrams.add(term)
+            plist[doc] = tfs
+        for f, counts in enumerate(per_field):
+            self._lengths[f].append(sum(counts.values()))
+        self.quests.append(quest)
+        self._doc_terms.append(terms)
+        self._lowered.append(tuple(text.lower() for text in texts))
+        for field, value in self._facet_values(quest):
+            self._facet_docs[field].setdefault(value, set()).add(doc)
+        self._facet_bits = None
+        if "id" in quest:
+            self._slots[quest["id"]] = doc
+        self._live += 1
+        self._norms = None
+        self._term_bounds = {}
+
+    def lowered(self, doc: int, field: str) -> str:
+        """Lowercased text of an indexed `field` of document `doc`."""
+        return self._lowered[doc][self.fields.index(field)]
+
+    def _length_norms(self) -> List[List[float]]:
+        """k1 * (1 - b + b * len / avg_len) per field and document."""
+        if self._norms is None:
+            norms = []
+            for field_lengths in self._lengths:
+                avg = sum(field_lengths) / self._live if self._live else 0.0
+                scale = self.k1 * self.b / avg if avg else 0.0
+                base = self.k1 * (1 - self.b)
+                norms.append([base + scale * length for length in field_lengths])
+            self._norms = norms
+        return self._norms
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        if not df:
+            return 0.0
+        return math.log(1 + (self._live - df + 0.5) / (df + 0.5))
+
+    def query_terms(self, query: str) -> Counter:
+        return Counter(preprocess_text(query or "").split())
+
+    def expand_terms(
+        self, terms: Counter
+    ) -> Tuple[Dict[str, float], Dict[str, float]]:
+        """Query term weights with misspelled terms replaced by close terms.
+
+        Terms absent from the vocabulary are swapped for up to
+        fuzzy.MAX_EXPANSIONS vocabulary terms within their edit budget, each
+        weighted qtf / (1 + distance). Also returns the weights `max_score`
+        should bound with: a misspelled term counts once, at the idf of its
+        rarest expansion, so fuzzy matches score below exact ones.
+        """
+        weights: Dict[str, float] = {}
+        bound: Dict[str, float] = {}
+        for term, qtf in terms.items():
+            if term in self.postings:
+                weights[term] = weights.get(term, 0.0) + qtf
+                bound[term] = bound.get(term, 0.0) + qtf
+                continue
+            if self._trigrams is None:
+                self._trigrams = TrigramIndex(self.postings)
+            similar = self._trigrams.similar(term)
+            for candidate, dist in similar:
+                weights[candidate] = weights.get(candidate, 0.0) + qtf / (1 + dist)
+            if similar:
+                rarest = max((c for c, _ in similar), key=self.idf)
+                bound[rarest] = bound.get(rarest, 0.0) + qtf
+        return weights, bound
+
+    def max_score(self, terms: Dict[str, float]) -> float:
+        """Upper bound of `score` for these terms (every tf -> infinity)."""
+        weight_sum = sum(self.field_weights.values())
+        return sum(
+            qtf * self.idf(term) * (self.k1 + 1) * weight_sum
+            for term, qtf in terms.items()
+        )
+
+    def term_bound(self, term: str) -> float:
+        """The largest score contribution one occurrence-weight of `term` makes
+        to any document; cached until the index changes."""
+        bound = self._term_bounds.get(term)
+        if bound is None:
+            bound = 0.0
+            plist = self.postings.get(term)
+            if plist:
+                weights = [self.field_weights[field] for field in self.fields]
+                norms = self._length_norms()
+                k1_plus_1 = self.k1 + 1
+                for doc, tfs in plist.items():
+                    total = 0.0
+                    for f, tf in enumerate(tfs):
+                        if tf:
+                            total += weights[f] * tf * k1_plus_1 / (tf + norms[f][doc])
+                    if total > bound:
+                        bound = total
+                bound *= self.idf(term)
+            self._term_bounds[term] = bound
+        return bound
+
+    def _term_order(self, terms: Dict[str, float]) -> List[str]:
+        """Indexed `terms` by descending weighted idf.
+
+        `score` and `score_top_k` accumulate in this order so that both
+        produce bit-identical sums.
+        """
+        return sorted(
+            (t for t in terms if t in self.postings),
+            key=lambda t: (-terms[t] * self.idf(t), t),
+        )
+
+    def score(self, terms: Dict[str, float]) -> Dict[int, float]:
+        """BM25 score of every document containing at least one of `terms`."""
+        weights = [self.field_weights[field] for field in self.fields]
+        norms = self._length_norms()
+        k1_plus_1 = self.k1 + 1
+        scores: Dict[int, float] = {}
+        for term in self._term_order(terms):
+            plist = self.postings[term]
+            idf = terms[term] * self.idf(term)
+            for doc, tfs in plist.items():
+                total = 0.0
+                for f, tf in enumerate(tfs):
+                    if tf:
+                        total += weights[f] * tf * k1_plus_1 / (tf + norms[f][doc])
+                scores[doc] = scores.get(doc, 0.0) + idf * total
+        return scores
+
+    def score_top_k(
+        self, terms: Dict[str, float], k: int, accept: Callable[[int], bool]
+    ) -> Dict[int, float]:
+        """Exact scores for a set of documents containing the top `k` accepted ones.
+
+        MaxScore-style term-at-a-time evaluation: terms are processed roughly
+        by descending impact (see _term_order). Once the bounds of the terms
+        left cannot lift a new document to the current k-th best accepted
+        score, remaining posting lists only update documents already seen.
+        Documents left out cannot rank in the top `k`.
+        """
+        order = self._term_order(terms)
+        remaining = [terms[t] * self.term_bound(t) for t in order]
+        for i in range(len(remaining) - 2, -1, -1):
+            remaining[i] += remaining[i + 1]
+
+        weights = [self.field_weights[field] for field in self.fields]
+        norms = self._length_norms()
+        k1_plus_1 = self.k1 + 1
+        scores: Dict[int, float] = {}
+        accepted: Dict[int, bool] = {}
+        for i, term in enumerate(order):
+            plist = self.postings[term]
+            add_new = True
+            if i and len(scores) >= k:
+                for doc in scores:
+                    if doc not in accepted:
+                        accepted[doc] = accept(doc)
+                kept = [s for doc, s in scores.items() if accepted[doc]]
+                if len(kept) >= k:
+                    add_new = remaining[i] >= heapq.nlargest(k, kept)[-1]
+            if add_new:
+                docs: Iterable[int] = plist
+            elif len(scores) < len(plist):
+                docs = [doc for doc in scores if doc in plist]
+            else:
+                docs = [doc for doc in plist if doc in scores]
+            idf = terms[term] * self.idf(term)
+            for doc in docs:
+                total = 0.0
+                for f, tf in enumerate(plist[doc]):
+                    if tf:
+                        total += weights[f] * tf * k1_plus_1 / (tf + norms[f][doc])
+                scores[doc] = scores.get(doc, 0.0) + idf * total
+        return scores
+
+    def weighted_terms(
+        self, query: str, fuzzy: bool = False
+    ) -> Tuple[Dict[str, float], float]:
+        """Query term weights and the `max_score` bound they are scaled by."""
+        terms = self.query_terms(query)
+        bound_terms: Dict[str, float] = terms
+        if fuzzy:
+            terms, bound_terms = self.expand_terms(terms)
+        return terms, self.max_score(bound_terms)
+
+    def text_scores(
+        self,
+        query: str,
+        fuzzy: bool = False,
+        top_k: int | None = None,
+        accept: Callable[[int], bool] | None = None,
+    ) -> Dict[int, float]:
+        """Per-document BM25 for `query`, scaled into [0, 1) by `max_score`.
+
+        With `top_k`, only documents that can rank in the top `top_k` among
+        those `accept` allows are guaranteed to be present (see score_top_k).
+        """
+        terms, bound = self.weighted_terms(query, fuzzy)
+        if not bound:
+            return {}
+        if top_k is None:
+            raw = self.score(terms)
+        else:
+            raw = self.score_top_k(terms, top_k, accept or (lambda doc: True))
+        return {doc: s / bound for doc, s in raw.items()}
+
+    def matching_docs(self, query: str, fuzzy: bool = False) -> set:
+        """Every document containing a (possibly fuzzy-expanded) query term."""
+        terms, _ = self.weighted_terms(query, fuzzy)
+        return set().union(*(self.postings[t] for t in terms if t in self.postings))
+
+    # --- facets ---
+
+    def _facet_values(self, quest: Dict[str, Any]) -> Iterator[Tuple[str, Any]]:
+        """(field, value) for each facet value of `quest` (list fields: each)."""
+        for field in self.facet_fields:
+            value = quest.get(field)
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for v in dict.fromkeys(v for v in values if v is not None and v != ""):
+                try:
+                    hash(v)
+                except TypeError:
+                    v = str(v)
+                yield field, v
+
+    def doc_mask(self, docs: Iterable[int]) -> int:
+        """Bitset with the bit of each document in `docs` set."""
+        bits = bytearray((len(self.quests) + 7) // 8)
+        for doc in docs:
+            bits[doc >> 3] |= 1 << (doc & 7)
+        return int.from_bytes(bits, "little")
+
+    def facet_counts(self, mask: int) -> Dict[str, List[Dict[str, Any]]]:
+        """Per facet field, {value, count} of the documents in `mask`.
+
+        Values are ordered by count, then value; values with no documents in
+        `mask` are left out.
+        """
+        if self._facet_bits is None:
+            self._facet_bits = {
+                field: {value: self.doc_mask(docs) for value, docs in values.items()}
+                for field, values in self._facet_docs.items()
+            }
+        out = {}
+        for field, values in self._facet_bits.items():
+            counts = [
+                {"value": value, "count": (bits & mask).bit_count()}
+                for value, bits in values.items()
+            ]
+            counts = [c for c in counts if c["count"]]
+            counts.sort(key=lambda c: (-c["count"], str(c["value"])))
+            out[field] = counts
+        return out
@@ -0,0 +1,69 @@
+"""Per-request stage timings and counters for search_quests.
+
+A SearchTrace records how long each stage of a request took (tokenizing,
+candidate queries, questCards reads, the full-scan fallback, ranking,
+snippets), counters such as Firestore documents read and candidates scored,
+and request-level fields (cache hit or miss, candidate path, fallbacks).
+
+`emit()` writes the whole record as one JSON line on stdout, which Cloud
+Functions (Cloud Run) ingests as a structured log entry (`jsonPayload`), so
+stages can be aggregated per request in Logs Explorer. With
+SEARCH_DEBUG_TIMINGS=1 the search also returns the record as `_timings`.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+
+def debug_timings_enabled() -> bool:
+    return os.environ.get("SEARCH_DEBUG_TIMINGS", "0") == "1"
+
+
+class SearchTrace:
+    """Stage durations (ms), counters and fields for one search request."""
+
+    def __init__(self, event: str = "search_quests"):
+        self.event = event
+        self.stages: Dict[str, float] = {}
+        self.counts: Counter = Counter()
+        self.fields: Dict[str, Any] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the block as stage `name` (repeated stages add up)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counts[name] += n
+
+    def set(self, **fields: Any) -> None:
+        self.fields.update(fields)
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "event": self.event,
+            **self.fields,
+            "totalMs": round((time.perf_counter() - self._start) * 1000, 2),
+            "stagesMs": {name: round(ms, 2) for name, ms in self.stages.items()},
+            "counts": dict(self.counts),
+        }
+
+    def emit(self) -> Dict[str, Any]:
+        """Write the record as one structured log line and return it."""
+        record = self.record()
+        entry = {"severity": "INFO", "message": f"{self.event} trace", **record}
+        print(json.dumps(entry, default=str), file=sys.stdout, flush=True)
+        return record
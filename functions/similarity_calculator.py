@@ -1,13 +1,27 @@
 # functions/similarity_calculator.py
 # Likely imports:
-import nltk  # Keep for nltk.data.path
-
-# All other NLTK/sklearn imports moved to be lazy loaded
+# NLTK/sklearn imports are lazy loaded; NLTK is only needed to package nltk_data
+import heapq
+import logging
+import math
 import os
+import re
+import time
+from collections import Counter
+
 import firebase_admin
 from firebase_admin import credentials, firestore
 import glob  # For debugging deployed nltk_data contents
 
+from similarity_features import (
+    FEATURES_COLLECTION,
+    build_feature_doc,
+    features_to_quest,
+    query_lsh_candidates,
+    stream_features,
+)
+from text_preprocessing import load_stopwords, preprocess_text
+
 # Global variable to hold the Firestore client
 fb_db = None
 
@@ -28,18 +42,14 @@ NLTK_DATA_DIR_NAME = "nltk_data"
 # So, NLTK_DATA_PATH should become /workspace/nltk_data
 NLTK_DATA_PATH = os.path.join(os.path.dirname(__file__), NLTK_DATA_DIR_NAME)
 
-if NLTK_DATA_PATH not in nltk.data.path:
-    nltk.data.path.insert(0, NLTK_DATA_PATH)
-
-_stopwords_cache = None
-_punkt_initialized = False
-
-# Module-level references so tests can monkeypatch them easily
+# Optional tokenizer override (e.g. nltk.word_tokenize), mainly for tests. When
+# unset, _preprocess_text uses the memoized regex tokenizer in
+# text_preprocessing, which matches word_tokenize's alphanumeric output
+# without loading NLTK.
 word_tokenize = None
-stopwords = None
 
 # Removed NLTK pre-loading from global scope to prevent deployment timeouts.
-# These will be loaded on-demand by _ensure_nltk_resources().
+# Runtime preprocessing now reads the packaged data directly (text_preprocessing).
 # print("--- Attempting NLTK Punkt Pre-load ---")
 # try:
 #     print(f"Attempting word_tokenize with a test sentence to pre-load Punkt...")
@@ -73,6 +83,7 @@ def _setup_nltk_data_for_packaging():
     nltk_data directory. This directory MUST then be packaged and deployed.
     This function is intended to be run locally BEFORE deployment.
     """
+    import nltk  # LAZY IMPORT for this function
     from nltk.tokenize import word_tokenize  # LAZY IMPORT for this function
     from nltk.corpus import stopwords  # LAZY IMPORT for this function
 
@@ -180,6 +191,23 @@ HYBRID_APPROACH_WEIGHTING = {
 SIMILAR_QUESTS_SUBCOLLECTION = "similarQuests"  # Define subcollection name
 
 
+# When True, a target is scored against the whole corpus at once: text with a
+# single TF-IDF model (one sparse matrix-vector product) and fields with a
+# columnar encoding and NumPy comparisons. When False, the legacy per-pair path
+# fits a two-document vectorizer and calls _calculate_field_match_score per pair.
+VECTORIZED_SCORING = True
+
+TOP_N_SIMILAR_QUESTS = 10
+
+# Candidate generation for calculate_similarity_for_quest: "exact" scans every
+# quest; "lsh" scores only the quests that share a MinHash LSH band with the
+# target (bounded by LSH_CANDIDATE_LIMIT) and falls back to the exact scan when
+# it yields fewer than TOP_N_SIMILAR_QUESTS candidates. Check
+# `python benchmarks.py lsh-recall` before switching the default.
+SIMILARITY_CANDIDATE_MODE = os.environ.get("SIMILARITY_CANDIDATE_MODE", "exact")
+LSH_CANDIDATE_LIMIT = 300
+
+
 def calculate_similarity_for_quest(quest_id: str) -> list:
     """
     Calculates similarity scores for a given quest against all other quests.
@@ -192,13 +220,18 @@ def calculate_similarity_for_quest(quest_id: str) -> list:
     Returns:
         A list of tuples, where each tuple contains (similar_quest_id, hybrid_score),
         sorted by hybrid_score in descending order. Limited to top N results.
+
+    Raises:
+        RuntimeError: if the results (or the reciprocal updates) could not be
+            stored, so callers don't record the quest as up to date.
     """
     global fb_db
     _initialize_firebase()  # Ensure Firebase is initialized
 
     print(f"Calculating similarity for quest: {quest_id}")
 
-    # 1. Retrieve target quest details from Firestore
+    # 1. Retrieve target quest details from Firestore. The target is built from
+    # the quest itself because its feature record may not have been written yet.
     target_quest_ref = fb_db.collection("questCards").document(quest_id)
     target_quest_doc = target_quest_ref.get()
     if not target_quest_doc.exists:
@@ -206,112 +239,901 @@ def calculate_similarity_for_quest(quest_id: str) -> list:
         return []
     target_quest_data = target_quest_doc.to_dict()
     target_quest_data["id"] = quest_id  # Ensure id is part of the dict
+    if VECTORIZED_SCORING:
+        target_quest_data = features_to_quest(
+            quest_id, build_feature_doc(target_quest_data)
+        )
 
-    # 2. Retrieve all other quests from Firestore
-    all_quests_ref = fb_db.collection("questCards")
-    all_quest_docs = all_quests_ref.stream()
-    other_quests_data = []
-    for doc in all_quest_docs:
-        if doc.id != quest_id:
-            quest_data = doc.to_dict()
-            quest_data["id"] = doc.id  # Ensure id is part of the dict
-            other_quests_data.append(quest_data)
-
-    if not other_quests_data:
-        print("No other quests found to compare against.")
-        return []
+    # 2.-5. Score the other quests and keep the top N. The feature store is
+    # preferred over full quest documents (no re-tokenization, fewer bytes).
+    top_n_similarities, reciprocal_updates = None, []
+    if VECTORIZED_SCORING and SIMILARITY_CANDIDATE_MODE == "lsh":
+        # Approximate path: only quests sharing an LSH band with the target.
+        candidates = [
+            q
+            for q in query_lsh_candidates(
+                fb_db, target_quest_data.get("lshBands", []), LSH_CANDIDATE_LIMIT
+            )
+            if q["id"] != quest_id
+        ]
+        if len(candidates) >= TOP_N_SIMILAR_QUESTS:
+            scores = _score_against(target_quest_data, candidates)
+            top_n_similarities = _top_similarities(
+                candidates, scores, TOP_N_SIMILAR_QUESTS
+            )
+            reciprocal_updates = _reciprocal_updates(quest_id, candidates, scores)
+        else:
+            print(f"LSH returned {len(candidates)} candidates; using exact scan.")
+
+    if VECTORIZED_SCORING and top_n_similarities is None:
+        # Exact path: stream the feature store, scoring each quest as it
+        # arrives so peak memory doesn't grow with the catalog.
+        text_stats = _load_text_stats(fb_db)
+        top_n_similarities, reciprocal_updates, scanned = _stream_top_similar(
+            target_quest_data,
+            stream_features(fb_db, STREAM_FEATURE_FIELDS),
+            text_stats,
+        )
+        if not scanned:
+            top_n_similarities = None
+
+    if top_n_similarities is None:
+        # Feature store not backfilled yet (or legacy scoring): fall back to
+        # scoring the full quest documents in memory.
+        other_quests_data = []
+        all_quests_ref = fb_db.collection("questCards")
+        all_quest_docs = all_quests_ref.stream()
+        for doc in all_quest_docs:
+            if doc.id != quest_id:
+                quest_data = doc.to_dict()
+                quest_data["id"] = doc.id  # Ensure id is part of the dict
+                other_quests_data.append(quest_data)
+
+        if not other_quests_data:
+            print("No other quests found to compare against.")
+            return []
+
+        scores = _score_against(target_quest_data, other_quests_data)
+        top_n_similarities = _top_similarities(
+            other_quests_data, scores, TOP_N_SIMILAR_QUESTS
+        )
 
-    similarities = []
+    # 6. Store these top N similarities in Firestore, writing only what changed
+    # relative to the quest's current list (inserts, deletes, moved scores).
+    print(
+        f"Storing top {len(top_n_similarities)} similar quests for {quest_id} in subcollection '{SIMILAR_QUESTS_SUBCOLLECTION}'..."
+    )
+    failures = []
+    try:
+        ops, write_stats = _similar_quests_diff_ops(
+            fb_db,
+            quest_id,
+            _subcollection_neighbors(fb_db, quest_id),
+            top_n_similarities,
+            recorded=_recorded_neighbors(fb_db, quest_id),
+        )
+        if ops:
+            _commit_ops(fb_db, ops)
+        print(
+            f"Successfully stored/updated similar quests for {quest_id}: "
+            f"{write_stats['writes']} write(s) instead of {write_stats['fullRewriteWrites']}."
+        )
+    except Exception as e:
+        print(f"Error storing similar quests for {quest_id}: {e}")
+        failures.append(f"similar quests: {e}")
 
-    for other_quest in other_quests_data:
-        # 3.1. Calculate field matching score
-        field_score = _calculate_field_match_score(
-            target_quest_data, other_quest, FIELD_MATCH_WEIGHTS
+    # 7. Offer the new quest to the existing quests it now out-scores
+    if reciprocal_updates:
+        try:
+            updated = _store_reciprocal_updates(fb_db, quest_id, reciprocal_updates)
+            print(
+                f"Added or rescored {quest_id} in the similar quests of {updated} existing quest(s)."
+            )
+        except Exception as e:
+            print(f"Error updating reciprocal similar quests for {quest_id}: {e}")
+            failures.append(f"reciprocal updates: {e}")
+
+    if failures:
+        raise RuntimeError(
+            f"Similarity for {quest_id} not fully stored: {'; '.join(failures)}"
         )
+    print(f"Calculated similarities: {top_n_similarities}")
+    return top_n_similarities
+
+
+def _rank_similar_quests(
+    target_quest: dict, other_quests: list, top_n: int = TOP_N_SIMILAR_QUESTS
+) -> list:
+    """
+    Scores `target_quest` against every quest in `other_quests` and returns the
+    top N as [{"id", "score"}] sorted by hybrid score (descending).
+    """
+    scores = _score_against(target_quest, other_quests)
+    return _top_similarities(other_quests, scores, top_n)
+
+
+def _score_against(target_quest: dict, other_quests: list) -> list:
+    """Hybrid score of `target_quest` against each of `other_quests`, in order."""
+    if VECTORIZED_SCORING:
+        corpus = [target_quest] + list(other_quests)
+        text_scores = CorpusTextModel(corpus).scores_for(0)[1:]
+        field_scores = _field_match_scores(_encode_match_fields(corpus), 0)[1:]
+    else:
+        text_scores = [
+            _pairwise_text_score(target_quest, other_quest)
+            for other_quest in other_quests
+        ]
+        field_scores = [
+            _calculate_field_match_score(target_quest, other_quest, FIELD_MATCH_WEIGHTS)
+            for other_quest in other_quests
+        ]
+
+    return [
+        float(_hybrid_score(field_score, combined_text_score))
+        for field_score, combined_text_score in zip(field_scores, text_scores)
+    ]
+
+
+def _top_similarities(quests: list, scores: list, top_n: int) -> list:
+    similarities = [
+        {"id": quest["id"], "score": score} for quest, score in zip(quests, scores)
+    ]
+    similarities.sort(key=lambda x: x["score"], reverse=True)
+    return similarities[:top_n]
+
+
+# Upper bound on how many existing quests one new quest may update, which keeps
+# the trigger's write volume (<= 3 writes per update) predictable.
+MAX_RECIPROCAL_UPDATES = 150
+
+
+def _reciprocal_updates(
+    new_quest_id: str,
+    other_quests: list,
+    scores: list,
+    top_n: int = TOP_N_SIMILAR_QUESTS,
+    limit: int = MAX_RECIPROCAL_UPDATES,
+) -> list:
+    """
+    Finds existing quests whose top N the new quest enters.
+
+    Hybrid scores are symmetric, so the score of the new quest against each
+    other quest is also that quest's score for the new one. Quests without a
+    recorded `neighbors` map (similarity never computed) are skipped. When an
+    edited quest is already listed, its stored score is rewritten (or the entry
+    evicted), and those quests are updated before new entries.
+
+    Returns:
+        [(quest_id, score, neighbors, evicted_id_or_None)] for the best-scoring
+        `limit` quests, where `neighbors` is the updated {id: score} map as of
+        the read. _store_reciprocal_updates recomputes it before writing.
+    """
+    updates = []
+    for quest, score in zip(other_quests, scores):
+        update = _reciprocal_update(new_quest_id, quest, score, top_n)
+        if update is not None:
+            updates.append((quest["id"], score) + update)
+
+    updates.sort(key=lambda u: (new_quest_id in u[2], u[1]), reverse=True)
+    return updates[:limit]
 
-        # 3.2. Calculate text similarity score (titles & summaries)
-        # For simplicity, let\'s assume titles and summaries are weighted equally for the text score.
-        # A more sophisticated approach might weight them differently or combine them before TF-IDF.
-        title_similarity = _calculate_text_similarity(
-            target_quest_data.get("title", ""), other_quest.get("title", "")
+
+def _reciprocal_update(new_quest_id: str, quest: dict, score: float, top_n: int):
+    """
+    (new_neighbors, evicted_id_or_None) if `quest`'s top N changes for the new
+    quest: it enters the list, or (already listed, i.e. it was edited) its score
+    moved. An edited quest that drops below the list's previous floor while the
+    list is full is evicted itself (evicted == new_quest_id).
+    """
+    neighbors = quest.get("neighbors")
+    if not isinstance(neighbors, dict):
+        return None
+    if new_quest_id in neighbors:
+        old_score = neighbors[new_quest_id]
+        if (
+            isinstance(old_score, (int, float))
+            and abs(old_score - score) <= SCORE_UPDATE_TOLERANCE
+        ):
+            return None
+        new_neighbors = dict(neighbors)
+        if len(neighbors) >= top_n and score < min(neighbors.values()):
+            del new_neighbors[new_quest_id]
+            return new_neighbors, new_quest_id
+        new_neighbors[new_quest_id] = score
+        return new_neighbors, None
+    evicted = None
+    if len(neighbors) >= top_n:
+        evicted = min(neighbors, key=neighbors.get)
+        if score <= neighbors[evicted]:
+            return None
+    new_neighbors = {k: v for k, v in neighbors.items() if k != evicted}
+    new_neighbors[new_quest_id] = score
+    return new_neighbors, evicted
+
+
+# Reciprocal updates run as one transaction per existing quest, this many at a
+# time.
+RECIPROCAL_UPDATE_WORKERS = 8
+
+
+def _store_reciprocal_updates(
+    db, new_quest_id: str, updates: list, top_n: int = TOP_N_SIMILAR_QUESTS
+) -> int:
+    """
+    Applies reciprocal neighbor updates, one Firestore transaction per quest.
+
+    Each transaction re-reads the quest's `neighbors` map and recomputes the
+    update from it, so concurrent triggers offering different quests to the
+    same quest retry instead of overwriting each other's map entries, and the
+    map stays in step with the similarQuests subcollection.
+
+    Returns:
+        The number of quests actually updated.
+    """
+    from concurrent.futures import ThreadPoolExecutor  # LAZY IMPORT
+
+    def apply(update):
+        quest_id, score = update[0], update[1]
+        return _apply_reciprocal_update(
+            db.transaction(), db, new_quest_id, quest_id, score, top_n
         )
-        summary_similarity = _calculate_text_similarity(
-            target_quest_data.get("summary", ""), other_quest.get("summary", "")
+
+    with ThreadPoolExecutor(max_workers=RECIPROCAL_UPDATE_WORKERS) as pool:
+        return sum(pool.map(apply, updates))
+
+
+@firestore.transactional
+def _apply_reciprocal_update(
+    transaction, db, new_quest_id: str, quest_id: str, score: float, top_n: int
+) -> bool:
+    """Offers (or rescores) `new_quest_id` in `quest_id`'s top N in `transaction`."""
+    features_ref = db.collection(FEATURES_COLLECTION).document(quest_id)
+    snapshot = features_ref.get(field_paths=["neighbors"], transaction=transaction)
+    quest = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    update = _reciprocal_update(new_quest_id, quest, score, top_n)
+    if update is None:
+        return False
+
+    neighbors, evicted = update
+    subcollection_ref = (
+        db.collection("questCards")
+        .document(quest_id)
+        .collection(SIMILAR_QUESTS_SUBCOLLECTION)
+    )
+    if evicted != new_quest_id:
+        transaction.set(
+            subcollection_ref.document(new_quest_id),
+            {"score": score, "calculatedAt": firestore.SERVER_TIMESTAMP},
         )
+    if evicted is not None:
+        transaction.delete(subcollection_ref.document(evicted))
+    _apply_op(transaction, *_neighbors_op(db, quest_id, neighbors))
+    return True
+
+
+def _neighbors_op(db, quest_id: str, neighbors: dict) -> tuple:
+    """Operation recording a quest's {id: score} neighbor map on its feature record."""
+    ref = db.collection(FEATURES_COLLECTION).document(quest_id)
+    return ("merge", ref, {"neighbors": neighbors})
+
+
+def _commit_ops(db, ops: list, batch_size: int = 500) -> None:
+    """Commits ("set" | "merge" | "delete", ref, payload) operations in batches."""
+    for start in range(0, len(ops), batch_size):
+        batch = db.batch()
+        for op, ref, payload in ops[start : start + batch_size]:
+            _apply_op(batch, op, ref, payload)
+        batch.commit()
+
+
+def _apply_op(batch, op: str, ref, payload) -> None:
+    if op == "delete":
+        batch.delete(ref)
+    elif op == "merge":
+        # merge=[fields] replaces those fields wholesale (merge=True would keep
+        # stale keys inside maps) and doesn't require the document to exist.
+        batch.set(ref, payload, merge=list(payload))
+    else:
+        batch.set(ref, payload)
 
-        # Average similarity for title and summary
-        combined_text_score = (title_similarity + summary_similarity) / 2
 
-        # 3.3. Calculate overall hybrid score
-        hybrid_score = (
-            field_score * HYBRID_APPROACH_WEIGHTING["field_matching_score"]
-        ) + (combined_text_score * HYBRID_APPROACH_WEIGHTING["text_similarity_score"])
+def _hybrid_score(field_score, text_score):
+    """Combines field and text scores (scalars or NumPy arrays) using the hybrid weights."""
+    return (field_score * HYBRID_APPROACH_WEIGHTING["field_matching_score"]) + (
+        text_score * HYBRID_APPROACH_WEIGHTING["text_similarity_score"]
+    )
 
-        similarities.append({"id": other_quest["id"], "score": hybrid_score})
 
-    # 4. Sort results by hybrid_score (descending)
-    similarities.sort(key=lambda x: x["score"], reverse=True)
+def _pairwise_text_score(quest1: dict, quest2: dict) -> float:
+    """Legacy text score: the average of per-pair title and summary TF-IDF similarity."""
+    title_similarity = _calculate_text_similarity(
+        quest1.get("title", ""), quest2.get("title", "")
+    )
+    summary_similarity = _calculate_text_similarity(
+        quest1.get("summary", ""), quest2.get("summary", "")
+    )
+    return (title_similarity + summary_similarity) / 2
 
-    # 5. Get top N (e.g., 10) similar quests
-    top_n_similarities = similarities[:10]
 
-    # 6. Store these top N similarities in Firestore
-    if top_n_similarities:
-        print(
-            f"Storing top {len(top_n_similarities)} similar quests for {quest_id} in subcollection '{SIMILAR_QUESTS_SUBCOLLECTION}'..."
+class CorpusTextModel:
+    """
+    A TF-IDF model fitted once over every title and summary in a quest corpus.
+
+    Titles and summaries share one vocabulary, so IDF weights reflect the whole
+    catalog rather than a two-document pair. Rows are L2-normalised by the
+    vectorizer, which makes a sparse dot product equal to cosine similarity.
+    Pairs whose preprocessed texts are both empty score 1.0 and pairs where only
+    one side is empty score 0.0, matching `_calculate_text_similarity`.
+
+    Quests loaded from the feature store carry `titleText`/`summaryText`
+    (already preprocessed) and are not tokenized again.
+    """
+
+    def __init__(self, quests: list):
+        import numpy as np  # LAZY IMPORT
+        from scipy import sparse  # LAZY IMPORT
+        from sklearn.feature_extraction.text import TfidfVectorizer  # LAZY IMPORT
+
+        titles = [_processed_text(q, "title") for q in quests]
+        summaries = [_processed_text(q, "summary") for q in quests]
+        n = len(quests)
+
+        self.size = n
+        self.title_empty = np.array([not t for t in titles], dtype=bool)
+        self.summary_empty = np.array([not t for t in summaries], dtype=bool)
+
+        try:
+            matrix = TfidfVectorizer().fit_transform(titles + summaries).tocsr()
+        except ValueError:
+            # Empty vocabulary: no document contains a usable term.
+            matrix = sparse.csr_matrix((2 * n, 1))
+        self.title_matrix = matrix[:n]
+        self.summary_matrix = matrix[n:]
+
+    def scores_for(self, index: int):
+        """Combined text score of quest `index` against every quest in the corpus."""
+        return self.block_scores(index, index + 1)[0]
+
+    def block_scores(self, start: int, stop: int):
+        """Dense (stop - start) x N array of combined text scores for a row block."""
+        title = self._field_block(
+            self.title_matrix, self.title_empty, start, stop
+        )
+        summary = self._field_block(
+            self.summary_matrix, self.summary_empty, start, stop
         )
-        target_quest_ref = fb_db.collection("questCards").document(quest_id)
-        subcollection_ref = target_quest_ref.collection(SIMILAR_QUESTS_SUBCOLLECTION)
-
-        # Atomically delete all existing documents in the subcollection and add new ones
-        batch = fb_db.batch()
-
-        # Delete existing documents
-        # Note: Listing and deleting in a loop can be less efficient for very large subcollections,
-        # but for a small number (e.g., <100) of similar quests, it\'s generally acceptable.
-        # For Cloud Functions, consider time limits.
-        # A more robust way for larger subcollections might involve a recursive delete helper if needed.
-        existing_similar_docs = subcollection_ref.stream()
-        for doc in existing_similar_docs:
-            batch.delete(doc.reference)
-
-        # Add new similar quest documents
-        for similar_quest_info in top_n_similarities:
-            similar_quest_id = similar_quest_info["id"]
-            score = similar_quest_info["score"]
-            similar_quest_doc_ref = subcollection_ref.document(similar_quest_id)
-            batch.set(
-                similar_quest_doc_ref,
-                {"score": score, "calculatedAt": firestore.SERVER_TIMESTAMP},
+        return (title + summary) / 2
+
+    @staticmethod
+    def _field_block(matrix, empty, start, stop):
+        import numpy as np  # LAZY IMPORT
+
+        block = (matrix[start:stop] @ matrix.T).toarray()
+        # Both sides empty after preprocessing counts as identical content.
+        both_empty = np.outer(empty[start:stop], empty)
+        block[both_empty] = 1.0
+        return block
+
+
+# Corpus text statistics (document frequencies) used by the streaming scorer,
+# which cannot fit a TF-IDF model up front without holding the whole corpus.
+TEXT_STATS_COLLECTION = "similarityModel"
+TEXT_STATS_DOC = "textStats"
+TEXT_STATS_MAX_AGE_SECONDS = 24 * 60 * 60
+# `df` is split across documents of this subcollection (under TEXT_STATS_DOC),
+# TEXT_STATS_TERMS_PER_SHARD terms each, so the vocabulary can grow past
+# Firestore's per-document limits (20k fields, 1 MiB). `df` is also exempted
+# from indexing in firestore.indexes.json (40k index entries per document).
+TEXT_STATS_SHARDS_SUBCOLLECTION = "dfShards"
+TEXT_STATS_TERMS_PER_SHARD = 5000
+
+# Last text stats loaded or rebuilt by this instance, reused while fresh. This
+# also keeps a rebuild from repeating on every call when it can't be stored.
+_text_stats_cache = None
+
+# Feature fields read by the streaming scan (lshBands etc. are not needed).
+STREAM_FEATURE_FIELDS = ["titleText", "summaryText", "fields", "neighbors"]
+
+# TfidfVectorizer's default token pattern; the streaming scorer must tokenize
+# exactly like the corpus model so both paths produce the same scores.
+_SKLEARN_TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")
+
+
+def build_text_stats(quests) -> dict:
+    """
+    Document frequencies over every title and summary, mirroring the 2N-document
+    corpus CorpusTextModel is fitted on. Terms seen once are omitted: a missing
+    term is treated as df=1, so pruning them is lossless and keeps the stats
+    document small.
+    """
+    df = Counter()
+    document_count = 0
+    for quest in quests:
+        for field in ("title", "summary"):
+            df.update(set(_SKLEARN_TOKEN_RE.findall(_processed_text(quest, field))))
+            document_count += 1
+    return {
+        "documentCount": document_count,
+        "df": {term: count for term, count in df.items() if count > 1},
+        "computedAt": time.time(),
+    }
+
+
+def _load_text_stats(db) -> dict:
+    """
+    Text stats for the streaming scorer: this instance's copy while fresh, else
+    the stored stats, rebuilt when missing or stale.
+    """
+    global _text_stats_cache
+    if _text_stats_fresh(_text_stats_cache):
+        return _text_stats_cache
+
+    stats = _read_text_stats(db)
+    if not _text_stats_fresh(stats):
+        # One extra pass over just the token strings; memory is O(vocabulary).
+        stats = build_text_stats(stream_features(db, ["titleText", "summaryText"]))
+        if not save_text_stats(db, stats):
+            logging.error(
+                "Rebuilt text stats could not be stored; this instance keeps "
+                "its own copy until it goes stale."
             )
+    _text_stats_cache = stats
+    return stats
 
-        try:
+
+def _text_stats_fresh(stats) -> bool:
+    return (
+        isinstance(stats, dict)
+        and isinstance(stats.get("df"), dict)
+        and time.time() - stats.get("computedAt", 0) < TEXT_STATS_MAX_AGE_SECONDS
+    )
+
+
+def _read_text_stats(db) -> dict | None:
+    """
+    The stored text stats with `df` joined from its shards (documents written
+    before sharding keep `df` inline), or None if missing or incomplete.
+    """
+    ref = db.collection(TEXT_STATS_COLLECTION).document(TEXT_STATS_DOC)
+    try:
+        snapshot = ref.get()
+        stats = snapshot.to_dict() if snapshot.exists else None
+        if not isinstance(stats, dict) or isinstance(stats.get("df"), dict):
+            return stats
+        if not isinstance(stats.get("shardCount"), int):
+            return None
+
+        shards_ref = ref.collection(TEXT_STATS_SHARDS_SUBCOLLECTION)
+        refs = [shards_ref.document(str(i)) for i in range(stats["shardCount"])]
+        df = {}
+        for shard in db.get_all(refs):
+            data = shard.to_dict() if shard.exists else None
+            # Shards missing or left by a different build: treat as stale.
+            if not data or data.get("computedAt") != stats.get("computedAt"):
+                return None
+            df.update(data.get("df") or {})
+        stats["df"] = df
+        return stats
+    except Exception as e:
+        print(f"Error loading text stats: {e}")
+        return None
+
+
+def save_text_stats(db, stats: dict) -> bool:
+    """
+    Stores text stats as a meta document (documentCount, computedAt,
+    shardCount) plus `df` split across TEXT_STATS_SHARDS_SUBCOLLECTION. The
+    shards are written first and carry computedAt, so readers never join shards
+    from different builds.
+
+    Returns:
+        False (after logging the error) if the stats could not be stored.
+    """
+    ref = db.collection(TEXT_STATS_COLLECTION).document(TEXT_STATS_DOC)
+    terms = sorted(stats.get("df", {}).items())
+    shards = [
+        dict(terms[start : start + TEXT_STATS_TERMS_PER_SHARD])
+        for start in range(0, len(terms), TEXT_STATS_TERMS_PER_SHARD)
+    ]
+    try:
+        shards_ref = ref.collection(TEXT_STATS_SHARDS_SUBCOLLECTION)
+        ops = [
+            (
+                "set",
+                shards_ref.document(str(i)),
+                {"df": shard, "computedAt": stats["computedAt"]},
+            )
+            for i, shard in enumerate(shards)
+        ]
+        # Few shards per commit keeps each request well under the 10 MiB limit.
+        _commit_ops(db, ops, batch_size=20)
+        ref.set(
+            {
+                "documentCount": stats["documentCount"],
+                "computedAt": stats["computedAt"],
+                "shardCount": len(shards),
+            }
+        )
+    except Exception as e:
+        logging.error(f"Error saving text stats: {e}")
+        return False
+    return True
+
+
+def _tfidf_vector(text: str, stats: dict) -> dict:
+    """L2-normalised {term: weight} using TfidfVectorizer's smoothed IDF."""
+    counts = Counter(_SKLEARN_TOKEN_RE.findall(text))
+    n = stats.get("documentCount", 0)
+    df = stats.get("df", {})
+    vector = {
+        term: count * (math.log((1 + n) / (1 + df.get(term, 1))) + 1)
+        for term, count in counts.items()
+    }
+    norm = math.sqrt(sum(w * w for w in vector.values()))
+    return {term: w / norm for term, w in vector.items()} if norm else {}
+
+
+def _stream_text_score(target_vec: dict, target_empty: bool, text: str, stats: dict) -> float:
+    """Cosine score for one field with the same empty-text rules as CorpusTextModel."""
+    if not text:
+        return 1.0 if target_empty else 0.0
+    if target_empty:
+        return 0.0
+    other_vec = _tfidf_vector(text, stats)
+    if len(other_vec) > len(target_vec):
+        target_vec, other_vec = other_vec, target_vec
+    return sum(w * target_vec.get(term, 0.0) for term, w in other_vec.items())
+
+
+def _stream_top_similar(
+    target_quest: dict,
+    quests,
+    stats: dict,
+    top_n: int = TOP_N_SIMILAR_QUESTS,
+    reciprocal_limit: int = MAX_RECIPROCAL_UPDATES,
+):
+    """
+    Scores quests one at a time as they arrive and keeps the top N in a heap.
+
+    Peak memory is bounded by `top_n`, `reciprocal_limit` and the text stats,
+    independent of how many quests `quests` yields.
+
+    Returns:
+        (top_similarities, reciprocal_updates, scanned_count)
+    """
+    target_id = target_quest["id"]
+    target_title = _processed_text(target_quest, "title")
+    target_summary = _processed_text(target_quest, "summary")
+    title_vec = _tfidf_vector(target_title, stats)
+    summary_vec = _tfidf_vector(target_summary, stats)
+
+    top_heap = []  # (score, id) min-heap
+    reciprocal_heap = []  # (listed, score, id, neighbors, evicted) min-heap
+    scanned = 0
+    for quest in quests:
+        if quest["id"] == target_id:
+            continue
+        scanned += 1
+        text_score = (
+            _stream_text_score(
+                title_vec, not target_title, _processed_text(quest, "title"), stats
+            )
+            + _stream_text_score(
+                summary_vec, not target_summary, _processed_text(quest, "summary"), stats
+            )
+        ) / 2
+        field_score = _calculate_field_match_score(
+            target_quest, quest, FIELD_MATCH_WEIGHTS
+        )
+        score = float(_hybrid_score(field_score, text_score))
+
+        entry = (score, quest["id"])
+        if len(top_heap) < top_n:
+            heapq.heappush(top_heap, entry)
+        elif entry > top_heap[0]:
+            heapq.heapreplace(top_heap, entry)
+
+        update = _reciprocal_update(target_id, quest, score, top_n)
+        if update is not None:
+            listed = target_id in quest["neighbors"]
+            entry = (listed, score, quest["id"]) + update
+            if len(reciprocal_heap) < reciprocal_limit:
+                heapq.heappush(reciprocal_heap, entry)
+            elif entry[:3] > reciprocal_heap[0][:3]:
+                heapq.heapreplace(reciprocal_heap, entry)
+
+    top = [
+        {"id": quest_id, "score": score}
+        for score, quest_id in sorted(top_heap, reverse=True)
+    ]
+    reciprocal = [
+        (quest_id, score, neighbors, evicted)
+        for _, score, quest_id, neighbors, evicted in sorted(
+            reciprocal_heap, key=lambda e: e[:3], reverse=True
+        )
+    ]
+    return top, reciprocal, scanned
+
+
+# Memory budget for one row block of the all-pairs computation. Each block holds
+# a handful of dense (rows x N) float64 temporaries, so the row count is derived
+# from this budget and the corpus size.
+SIMILARITY_BLOCK_BYTES = 64 * 1024 * 1024
+_BLOCK_TEMPORARIES = 4
+
+SCALAR_MATCH_FIELDS = ["level", "players", "duration"]
+LIST_MATCH_FIELDS = ["common_monsters", "environment", "tags"]
+
+
+def compute_all_similarities(
+    quests: list,
+    top_n: int = TOP_N_SIMILAR_QUESTS,
+    block_rows: int | None = None,
+):
+    """
+    Computes the top N similar quests for every quest in `quests` in one pass.
+
+    The N x N hybrid score matrix is never materialised: rows are processed in
+    blocks whose size is bounded by SIMILARITY_BLOCK_BYTES, text scores come
+    from one corpus TF-IDF model and field scores from the columnar field
+    encoding, and the top N of each row is selected with argpartition.
+
+    Yields:
+        (quest_id, [{"id", "score"}, ...]) for each quest, in input order.
+    """
+    import numpy as np  # LAZY IMPORT
+
+    n = len(quests)
+    if n == 0:
+        return
+    ids = [q["id"] for q in quests]
+    text_model = CorpusTextModel(quests)
+    match_fields = _encode_match_fields(quests)
+
+    if block_rows is None:
+        block_rows = SIMILARITY_BLOCK_BYTES // (n * 8 * _BLOCK_TEMPORARIES)
+    block_rows = max(1, min(int(block_rows), n))
+    k = min(top_n, n - 1)
+
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        scores = _hybrid_score(
+            _field_match_block(match_fields, start, stop),
+            text_model.block_scores(start, stop),
+        )
+        # Never list a quest as similar to itself.
+        rows = np.arange(stop - start)
+        scores[rows, rows + start] = -np.inf
+
+        if k <= 0:
+            for i in range(start, stop):
+                yield ids[i], []
+            continue
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for r in range(stop - start):
+            yield ids[start + r], [
+                {"id": ids[j], "score": float(score)}
+                for j, score in zip(top[r], top_scores[r])
+            ]
+
+
+def _encode_match_fields(quests: list) -> dict:
+    """
+    Columnar encoding of the fields used by `_calculate_field_match_score`.
+
+    Scalar fields become an int32 array of category codes (-1 when the key is
+    missing, so it never matches). List fields become a sparse multi-hot CSR
+    matrix (quests x distinct values); non-list values encode as an empty row.
+    Values are compared with the same equality/hashing rules as the per-pair
+    function, so `1`, `1.0` and `True` share a code while `"1"` does not.
+    """
+    import numpy as np  # LAZY IMPORT
+    from scipy import sparse  # LAZY IMPORT
+
+    encoded = {}
+    for field in SCALAR_MATCH_FIELDS:
+        vocabulary = {}
+        codes = np.full(len(quests), -1, dtype=np.int32)
+        for i, quest in enumerate(quests):
+            if field in quest:
+                codes[i] = vocabulary.setdefault(_freeze(quest[field]), len(vocabulary))
+        encoded[field] = codes
+
+    for field in LIST_MATCH_FIELDS:
+        vocabulary = {}
+        rows, cols = [], []
+        for i, quest in enumerate(quests):
+            values = quest.get(field, [])
+            if not isinstance(values, (list, set)):
+                continue
+            for value in set(_freeze(v) for v in values):
+                rows.append(i)
+                cols.append(vocabulary.setdefault(value, len(vocabulary)))
+        encoded[field] = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(quests), max(len(vocabulary), 1)),
+        )
+    return encoded
+
+
+def _field_match_scores(
+    encoded: dict, target_index: int, field_weights: dict = FIELD_MATCH_WEIGHTS
+):
+    """Field match score of quest `target_index` against every encoded quest."""
+    return _field_match_block(encoded, target_index, target_index + 1, field_weights)[0]
+
+
+def _field_match_block(
+    encoded: dict, start: int, stop: int, field_weights: dict = FIELD_MATCH_WEIGHTS
+):
+    """Dense (stop - start) x N array of field match scores for a row block."""
+    import numpy as np  # LAZY IMPORT
+
+    n = len(encoded[SCALAR_MATCH_FIELDS[0]])
+    block = np.zeros((stop - start, n))
+    for field in SCALAR_MATCH_FIELDS:
+        codes = encoded[field]
+        rows = codes[start:stop, None]
+        block += ((rows == codes[None, :]) & (rows >= 0)) * field_weights[field]
+    for field in LIST_MATCH_FIELDS:
+        matrix = encoded[field]
+        # Non-zero dot product <=> at least one shared element
+        shares = (matrix[start:stop] @ matrix.T).toarray() > 0
+        block += shares * field_weights[field]
+    return block
+
+
+def _freeze(value):
+    """Makes Firestore values hashable (lists/maps) while preserving equality."""
+    if isinstance(value, list):
+        return ("__list__", tuple(_freeze(v) for v in value))
+    if isinstance(value, dict):
+        return ("__map__", tuple(sorted((k, _freeze(v)) for k, v in value.items())))
+    return value
+
+
+def store_similar_quests_bulk(
+    db, results, batch_size: int = 500, existing: dict | None = None
+) -> dict:
+    """
+    Writes `similarQuests` subcollections for many quests using batched writes.
+
+    Only differences from each quest's current list are written (see
+    `_similar_quests_diff_ops`). The current list is always read from the
+    quest's subcollection, so documents missing from the recorded neighbor map
+    (orphans) are deleted too.
+
+    Args:
+        db: Firestore client
+        results: iterable of (quest_id, [{"id", "score"}, ...])
+        batch_size: maximum operations per batch commit
+        existing: optional {quest_id: {neighbor_id: score}} of the neighbor
+            maps recorded on the feature store; a quest's map is rewritten when
+            it disagrees with the new list (quests missing here get one).
+
+    Returns:
+        Write statistics summed over all quests, plus "quests" processed.
+    """
+    totals = Counter()
+    batch = db.batch()
+    ops_in_batch = 0
+
+    for quest_id, top in results:
+        recorded = existing.get(quest_id, {}) if existing is not None else None
+        ops, stats = _similar_quests_diff_ops(
+            db, quest_id, _subcollection_neighbors(db, quest_id), top, recorded=recorded
+        )
+        totals.update(stats)
+        totals["quests"] += 1
+
+        # Keep one quest's operations in a single batch where possible.
+        if ops_in_batch and ops_in_batch + len(ops) > batch_size:
             batch.commit()
-            print(f"Successfully stored/updated similar quests for {quest_id}.")
-        except Exception as e:
-            print(f"Error storing similar quests for {quest_id}: {e}")
-    else:
-        print(f"No similar quests to store for {quest_id}.")
-        # Optionally, clear the subcollection if no similarities are found
-        target_quest_ref = fb_db.collection("questCards").document(quest_id)
-        subcollection_ref = target_quest_ref.collection(SIMILAR_QUESTS_SUBCOLLECTION)
-        existing_similar_docs = subcollection_ref.stream()
-        # Check if subcollection is not empty before starting a batch
-        docs_to_delete = [doc.reference for doc in existing_similar_docs]
-        if docs_to_delete:
-            batch = fb_db.batch()
-            for doc_ref in docs_to_delete:
-                batch.delete(doc_ref)
-            try:
-                batch.commit()
-                print(
-                    f"Cleared existing similar quests for {quest_id} as no new similarities were found."
-                )
-            except Exception as e:
-                print(f"Error clearing similar quests for {quest_id}: {e}")
+            batch = db.batch()
+            ops_in_batch = 0
+        for op, ref, payload in ops:
+            _apply_op(batch, op, ref, payload)
+            ops_in_batch += 1
+
+    if ops_in_batch:
+        batch.commit()
+    return dict(totals)
 
-    print(f"Calculated similarities: {top_n_similarities}")
-    return top_n_similarities
+
+# Score changes at or below this are not rewritten; the stored score is kept.
+SCORE_UPDATE_TOLERANCE = 1e-3
+
+
+def _similar_quests_diff_ops(
+    db,
+    quest_id: str,
+    old: dict,
+    top: list,
+    tolerance: float = SCORE_UPDATE_TOLERANCE,
+    recorded: dict | None = None,
+):
+    """
+    Operations that turn a quest's stored neighbor list `old` ({id: score})
+    into `top`, touching only documents that changed.
+
+    `old` should come from the similarQuests subcollection itself. When the
+    feature record's `neighbors` map is passed as `recorded`, the map is also
+    rewritten if it disagrees with the new list even though no document did.
+
+    Returns:
+        (ops, stats) where stats counts inserted/updated/deleted/unchanged
+        neighbors, the writes issued, and the writes a delete-all-then-set
+        rewrite would have issued ("fullRewriteWrites").
+    """
+    subcollection_ref = (
+        db.collection("questCards")
+        .document(quest_id)
+        .collection(SIMILAR_QUESTS_SUBCOLLECTION)
+    )
+    stats = Counter(inserted=0, updated=0, deleted=0, unchanged=0)
+    ops = []
+    neighbors = {}
+    for item in top:
+        old_score = old.get(item["id"])
+        if (
+            isinstance(old_score, (int, float))
+            and abs(item["score"] - old_score) <= tolerance
+        ):
+            stats["unchanged"] += 1
+            neighbors[item["id"]] = old_score
+            continue
+        stats["inserted" if item["id"] not in old else "updated"] += 1
+        neighbors[item["id"]] = item["score"]
+        ops.append(
+            (
+                "set",
+                subcollection_ref.document(item["id"]),
+                {"score": item["score"], "calculatedAt": firestore.SERVER_TIMESTAMP},
+            )
+        )
+    for stale_id in old.keys() - neighbors.keys():
+        stats["deleted"] += 1
+        ops.append(("delete", subcollection_ref.document(stale_id), None))
+
+    if ops or (recorded is not None and recorded != neighbors):
+        # Record the neighbor list on the feature record so later quests can
+        # decide whether they belong in this quest's top N without reading it.
+        ops.append(_neighbors_op(db, quest_id, neighbors))
+    stats["writes"] = len(ops)
+    stats["fullRewriteWrites"] = len(old) + len(top) + 1
+    return ops, dict(stats)
+
+
+def _recorded_neighbors(db, quest_id: str) -> dict | None:
+    """
+    The {neighbor_id: score} map recorded on a quest's feature record ({} if
+    there is none), or None if it couldn't be read.
+    """
+    try:
+        snapshot = db.collection(FEATURES_COLLECTION).document(quest_id).get()
+        neighbors = (snapshot.to_dict() or {}).get("neighbors") if snapshot.exists else None
+        return neighbors if isinstance(neighbors, dict) else {}
+    except Exception as e:
+        print(f"Error reading neighbor map for {quest_id}: {e}")
+        return None
+
+
+def _subcollection_neighbors(db, quest_id: str) -> dict:
+    subcollection_ref = (
+        db.collection("questCards")
+        .document(quest_id)
+        .collection(SIMILAR_QUESTS_SUBCOLLECTION)
+    )
+    return {
+        doc.id: (doc.to_dict() or {}).get("score")
+        for doc in subcollection_ref.stream()
+    }
 
 
 def _calculate_field_match_score(
@@ -365,33 +1187,17 @@ def _calculate_field_match_score(
 def _calculate_text_similarity(text1: str, text2: str) -> float:
     """
     Calculates cosine similarity between two texts using TF-IDF.
-    Uses nltk for tokenization/stopwords and scikit-learn for TF-IDF.
+    Uses _preprocess_text for tokenization/stopwords and scikit-learn for TF-IDF.
     """
-    # Prefer a module-level word_tokenize (makes testing/mocking easier).
-    # Fall back to importing on-demand if it isn't set.
     from sklearn.feature_extraction.text import TfidfVectorizer  # LAZY IMPORT
     from sklearn.metrics.pairwise import cosine_similarity  # LAZY IMPORT
 
-    _ensure_nltk_resources()  # Ensure NLTK resources are loaded
-
     # Explicitly check for two empty strings at the beginning
     if not text1 and not text2:
         return 1.0
 
-    stop_words_set = _stopwords_cache if _stopwords_cache is not None else set()
-
-    def preprocess(text_content):
-        wt = word_tokenize
-        if wt is None:
-            from nltk.tokenize import word_tokenize as wt
-        tokens = wt(text_content.lower())
-        # Keep only alphanumeric words and remove stopwords
-        return " ".join(
-            [word for word in tokens if word.isalnum() and word not in stop_words_set]
-        )
-
-    processed_text1 = preprocess(text1)
-    processed_text2 = preprocess(text2)
+    processed_text1 = _preprocess_text(text1)
+    processed_text2 = _preprocess_text(text2)
 
     # If after preprocessing, both texts are empty (e.g., only stopwords or special chars),
     # they can be considered identical in terms of meaningful content.
@@ -419,48 +1225,28 @@ def _calculate_text_similarity(text1: str, text2: str) -> float:
     return float(similarity_matrix[0][0])
 
 
-def _ensure_nltk_resources():
-    """
-    Ensures NLTK\'s Punkt tokenizer and stopwords are loaded.
-    This function is called before NLTK operations that depend on these resources.
-    """
-    global _stopwords_cache, _punkt_initialized
-
-    global word_tokenize, stopwords
-
-    if not _punkt_initialized:
-        try:
-            from nltk.tokenize import word_tokenize as _wt
-
-            word_tokenize = _wt
-        except Exception:
-            word_tokenize = None
-        try:
-            # print("Ensuring NLTK Punkt tokenizer is ready (first-time use)...")
-            # A light operation to trigger NLTK\'s internal loading of Punkt if needed.
-            # NLTK\'s word_tokenize handles its own lazy loading of \'punkt\'.
-            # This call ensures it happens before we rely on it in loops.
-            word_tokenize("test")
-            # print("NLTK Punkt tokenizer should be ready.")
-            _punkt_initialized = True
-        except Exception as e:
-            print(f"ERROR initializing NLTK Punkt tokenizer: {e}")
-            # Depending on severity, you might re-raise or handle (e.g., proceed without tokenization)
+def _processed_text(quest: dict, field: str) -> str:
+    """Preprocessed `title`/`summary`, using the stored `<field>Text` when present."""
+    stored = quest.get(f"{field}Text")
+    if stored is not None:
+        return stored
+    return _preprocess_text(str(quest.get(field, "") or ""))
 
-    if _stopwords_cache is None:
-        try:
-            from nltk.corpus import stopwords as _sw  # LAZY IMPORT
 
-            stopwords = _sw
-        except Exception:
-            stopwords = None
-        try:
-            # print("Loading NLTK stopwords (first-time use)...")
-            _stopwords_cache = set(stopwords.words("english"))
-            # print(f"NLTK stopwords loaded. Count: {len(_stopwords_cache)}")
-        except Exception as e:
-            print(f"ERROR loading NLTK stopwords: {e}")
-            _stopwords_cache = set()  # Fallback to empty set if loading fails
+def _preprocess_text(text_content: str) -> str:
+    """
+    Lowercases and tokenizes text, keeping only alphanumeric non-stopword tokens.
+    Returns the surviving tokens joined by single spaces.
+    """
+    if word_tokenize is None:
+        return preprocess_text(text_content)  # memoized, NLTK-free
+
+    stop_words_set = load_stopwords()
+    tokens = word_tokenize(text_content.lower())
+    # Keep only alphanumeric words and remove stopwords
+    return " ".join(
+        [word for word in tokens if word.isalnum() and word not in stop_words_set]
+    )
 
 
 # Example usage (for testing locally)
@@ -0,0 +1,231 @@
+"""Precomputed per-quest features for similarity scoring.
+
+Each document in `questSimilarityFeatures` (doc id == questCard id) holds what
+the similarity scorer needs and nothing else:
+
+- `titleText` / `summaryText`: the preprocessed token strings, so a
+  similarity run never re-tokenizes the corpus.
+- `fields`: the raw match-field values (`level`, `players`, `duration`,
+  `common_monsters`, `environment`, `tags`), normalised so list fields are
+  lists.
+- `lshBands`: MinHash LSH band keys over the quest's text tokens and field
+  values. Quests sharing any band key are likely near neighbours, so an
+  `array_contains_any` query on this field returns a small candidate set for
+  exact scoring instead of a full collection scan.
+- `neighbors`: the quest's current top-N similar quests as {id: score}, written
+  by the similarity calculator so a new quest can tell whether it belongs in
+  an existing quest's list without reading that quest's subcollection.
+
+TF-IDF weights and field category codes depend on the whole corpus, so they
+are derived from these stored values when a corpus model is built rather than
+being persisted per quest (a stored IDF would go stale on every new quest).
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import random
+from typing import Any, Dict, Iterable, List
+
+from content_hash import content_hash
+
+FEATURES_COLLECTION = "questSimilarityFeatures"
+# Field on the questCards document holding the fingerprint of the content the
+# stored similarity results were computed from.
+SIMILARITY_FINGERPRINT_FIELD = "similarityFingerprint"
+FEATURES_SCHEMA_VERSION = 2
+
+# MinHash LSH layout: LSH_BANDS bands of LSH_ROWS hashes each. Ten bands keep
+# the band keys within a single Firestore `array_contains_any` query.
+LSH_BANDS = 10
+LSH_ROWS = 2
+# Shingle copies per unit of field weight (see _shingles).
+LSH_FIELD_SHINGLE_SCALE = 50
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240611)  # fixed seed: band keys must be stable across deploys
+_MINHASH_PARAMS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(LSH_BANDS * LSH_ROWS)
+]
+
+SCALAR_FIELDS = ("level", "players", "duration")
+LIST_FIELDS = ("common_monsters", "environment", "tags")
+
+
+def match_fields(quest: Dict[str, Any]) -> Dict[str, Any]:
+    """Extracts match fields with the same presence rules as the field scorer."""
+    fields: Dict[str, Any] = {}
+    for name in SCALAR_FIELDS:
+        if name in quest:
+            fields[name] = quest[name]
+    for name in LIST_FIELDS:
+        values = quest.get(name)
+        if isinstance(values, (list, set)):
+            fields[name] = list(values)
+    return fields
+
+
+def feature_source(quest: Dict[str, Any]) -> Dict[str, Any]:
+    """The subset of a quest document that the feature record is derived from."""
+    return {
+        "title": str(quest.get("title", "") or ""),
+        "summary": str(quest.get("summary", "") or ""),
+        "fields": match_fields(quest),
+    }
+
+
+def similarity_fingerprint(quest: Dict[str, Any]) -> str:
+    """Stable hash of every quest field that affects similarity scoring.
+
+    Writes that leave it unchanged can never change a quest's similarity
+    results (see content_hash.py).
+    """
+    return content_hash(feature_source(quest))
+
+
+def build_feature_doc(quest: Dict[str, Any]) -> Dict[str, Any]:
+    """Create a feature document payload from a quest document dict."""
+    from similarity_calculator import _preprocess_text  # LAZY IMPORT
+
+    source = feature_source(quest)
+    title_text = _preprocess_text(source["title"])
+    summary_text = _preprocess_text(source["summary"])
+    return {
+        "titleText": title_text,
+        "summaryText": summary_text,
+        "fields": source["fields"],
+        "lshBands": lsh_bands(
+            _shingles(title_text, summary_text, source["fields"])
+        ),
+        "schemaVersion": FEATURES_SCHEMA_VERSION,
+        "updatedAt": datetime.datetime.utcnow(),
+    }
+
+
+def _shingles(title_text: str, summary_text: str, fields: Dict[str, Any]) -> set:
+    """The token set MinHash is computed over: text terms plus field values.
+
+    Field values carry most of the hybrid score, so each one is repeated
+    (as distinct shingles) in proportion to its FIELD_MATCH_WEIGHTS entry.
+    That makes the set's Jaccard similarity track the hybrid score instead of
+    being dominated by summary vocabulary.
+    """
+    from similarity_calculator import FIELD_MATCH_WEIGHTS  # LAZY IMPORT
+
+    shingles = set(title_text.split()) | set(summary_text.split())
+    for name in SCALAR_FIELDS + LIST_FIELDS:
+        if name not in fields:
+            continue
+        values = fields[name] if name in LIST_FIELDS else [fields[name]]
+        copies = max(1, round(FIELD_MATCH_WEIGHTS[name] * LSH_FIELD_SHINGLE_SCALE))
+        for value in values:
+            for copy in range(copies):
+                shingles.add(f"{name}={value!r}#{copy}")
+    return shingles
+
+
+def lsh_bands(shingles: Iterable[str]) -> List[str]:
+    """MinHash `shingles` and return one "<band>:<hash>" key per LSH band.
+
+    Two token sets with Jaccard similarity s share at least one band key with
+    probability 1 - (1 - s**LSH_ROWS)**LSH_BANDS. An empty set has no keys.
+    """
+    base_hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        for s in shingles
+    ]
+    if not base_hashes:
+        return []
+    signature = [
+        min((a * h + b) % _MERSENNE_PRIME for h in base_hashes)
+        for a, b in _MINHASH_PARAMS
+    ]
+    bands = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS : (band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(
+            ",".join(map(str, rows)).encode("ascii"), digest_size=6
+        ).hexdigest()
+        bands.append(f"{band}:{digest}")
+    return bands
+
+
+def features_to_quest(quest_id: str, features: Dict[str, Any]) -> Dict[str, Any]:
+    """Flattens a feature document into the quest-like dict the scorers accept."""
+    quest = dict(features.get("fields") or {})
+    quest["id"] = quest_id
+    quest["titleText"] = features.get("titleText", "")
+    quest["summaryText"] = features.get("summaryText", "")
+    if "lshBands" in features:
+        quest["lshBands"] = list(features["lshBands"] or [])
+    if "neighbors" in features:
+        quest["neighbors"] = dict(features["neighbors"] or {})
+    return quest
+
+
+def write_features(db, quest_id: str, quest_data: Dict[str, Any]) -> None:
+    """Write the feature document for a single quest.
+
+    Only the content fields are replaced; the `neighbors` map maintained by the
+    similarity calculator is left untouched.
+    """
+    feature_doc = build_feature_doc(quest_data)
+    db.collection(FEATURES_COLLECTION).document(quest_id).set(
+        feature_doc, merge=list(feature_doc)
+    )
+
+
+def delete_features(db, quest_id: str) -> None:
+    db.collection(FEATURES_COLLECTION).document(quest_id).delete()
+
+
+def stream_features(db, field_paths: List[str] | None = None) -> Iterable[Dict[str, Any]]:
+    """Yields quest-like dicts for every stored feature document.
+
+    `field_paths` limits the fields read from Firestore (a projection), which
+    keeps the streamed payload to what the caller actually scores on.
+    """
+    query = db.collection(FEATURES_COLLECTION)
+    if field_paths:
+        query = query.select(field_paths)
+    for doc in query.stream():
+        yield features_to_quest(doc.id, doc.to_dict() or {})
+
+
+def query_lsh_candidates(db, bands: List[str], limit: int) -> Iterable[Dict[str, Any]]:
+    """Yields quest-like dicts for feature documents sharing any LSH band key."""
+    if not bands:
+        return
+    query = (
+        db.collection(FEATURES_COLLECTION)
+        .where("lshBands", "array_contains_any", bands[:LSH_BANDS])
+        .limit(limit)
+    )
+    for doc in query.stream():
+        yield features_to_quest(doc.id, doc.to_dict() or {})
+
+
+def backfill_all(db, batch_size: int = 500) -> int:
+    """Backfill feature documents for all quests. Returns number processed."""
+    processed = 0
+    batch = db.batch()
+    count_in_batch = 0
+
+    for doc in db.collection("questCards").stream():
+        dest = db.collection(FEATURES_COLLECTION).document(doc.id)
+        feature_doc = build_feature_doc(doc.to_dict() or {})
+        batch.set(dest, feature_doc, merge=list(feature_doc))
+        count_in_batch += 1
+
+        if count_in_batch >= batch_size:
+            batch.commit()
+            processed += count_in_batch
+            batch = db.batch()
+            count_in_batch = 0
+
+    if count_in_batch > 0:
+        batch.commit()
+        processed += count_in_batch
+
+    return processed
@@ -0,0 +1,57 @@
+from autocomplete import PrefixIndex
+
+
+def _index():
+    index = PrefixIndex()
+    index.add("1", "Dragon Hunt", ["dragon", "hunt", "red"])
+    index.add("2", "The Dragon's Lair", ["dragon", "lair", "dread"])
+    index.add("3", "Dread Harbor", ["dread", "harbor", "dragon"])
+    index.add("4", "Goblin Cave", ["goblin", "cave"])
+    return index
+
+
+def test_tokens_ranked_by_document_frequency():
+    index = _index()
+    assert index.complete_tokens("dr") == [
+        {"token": "dragon", "df": 3},
+        {"token": "dread", "df": 2},
+    ]
+    assert index.complete_tokens("DRE", limit=1) == [{"token": "dread", "df": 2}]
+    assert index.complete_tokens("x") == []
+
+
+def test_titles_match_any_word_with_title_starts_first():
+    index = _index()
+    titles = [hit["title"] for hit in index.complete_titles("dr")]
+    assert titles == ["Dragon Hunt", "Dread Harbor", "The Dragon's Lair"]
+    assert index.complete_titles("dragon's l") == [
+        {"id": "2", "title": "The Dragon's Lair"}
+    ]
+
+
+def test_remove_and_replace_update_counts():
+    index = _index()
+    index.add("3", "Harbor", ["harbor"])
+    assert index.df["dragon"] == 2 and index.df["dread"] == 1
+    assert index.remove("1") and not index.remove("1")
+    assert index.complete_tokens("dr") == [
+        {"token": "dragon", "df": 1},
+        {"token": "dread", "df": 1},
+    ]
+    assert "hunt" not in index.df and index.complete_tokens("hu") == []
+    assert [hit["id"] for hit in index.complete_titles("d")] == ["2"]
+
+
+def test_bulk_additions_are_sorted_once():
+    index = PrefixIndex()
+    for i in range(200):
+        index.add(str(i), f"Quest {199 - i}", [f"t{199 - i:03d}"])
+    assert [t["token"] for t in index.complete_tokens("t00", 3)] == [
+        "t000",
+        "t001",
+        "t002",
+    ]
+    assert index.complete("quest 19")["titles"][0] == {
+        "id": "180",
+        "title": "Quest 19",
+    }
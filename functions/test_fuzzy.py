@@ -0,0 +1,58 @@
+from fuzzy import (
+    TrigramIndex,
+    closest,
+    doc_trigrams,
+    edit_distance,
+    query_trigrams,
+    trigrams,
+)
+from search import search_quests_core
+from search_index import SearchIndex
+
+
+def test_trigrams_and_edit_distance():
+    assert trigrams("cave") == ["$ca", "cav", "ave", "ve$"]
+    assert edit_distance("dargon", "dragon", 2) == 1  # transposition
+    assert edit_distance("goblin", "goblins", 1) == 1
+    assert edit_distance("vampire", "empire", 1) is None
+    assert edit_distance("vampire", "empire", 2) == 2
+    assert closest("lich", ["lick", "lichen"]) == ("lick", 1)
+    assert closest("orc", ["ore"]) is None  # too short to fuzz
+
+
+def test_query_and_doc_trigrams_are_bounded():
+    grams = query_trigrams(["dargon", "lair", "of"])
+    # Spread across terms, without boundary trigrams.
+    assert grams == ["dar", "lai", "arg", "air", "rgo", "gon"]
+    assert query_trigrams(["ogre"]) == ["ogr", "gre"]
+    assert len(query_trigrams(["dargonlairs", "wyrmlingss"])) == 10
+    assert len(doc_trigrams([f"token{i}" for i in range(100)], limit=50)) == 50
+
+
+def test_trigram_index_finds_close_terms():
+    index = TrigramIndex(["dragon", "dragons", "wagon", "goblin"])
+    assert index.similar("dargon") == [("dragon", 1)]
+    assert index.similar("dragonz") == [("dragon", 1), ("dragons", 1)]
+    index.remove("dragon")
+    assert index.similar("dargon") == []
+
+
+def test_fuzzy_search_matches_misspelled_terms_below_exact_scores():
+    quests = [
+        {"id": "1", "title": "Dragon Hunt", "summary": "Hunt the red dragon."},
+        {"id": "2", "title": "Goblin Cave", "summary": "Clear the goblins."},
+    ]
+    index = SearchIndex(quests)
+    assert index.text_scores("dargon") == {}
+    fuzzy = index.text_scores("dargon", fuzzy=True)
+    assert set(fuzzy) == {0}
+    assert fuzzy[0] < index.text_scores("dragon")[0]
+
+    out = search_quests_core(
+        "dargon hunt", {}, 1, 10, [], index=index, only_matching=True, fuzzy=True
+    )
+    assert [hit["id"] for hit in out["hits"]] == ["1"]
+
+    # New vocabulary is picked up once the trigram index exists.
+    index.add({"id": "3", "title": "Vampire Keep", "summary": ""})
+    assert set(index.text_scores("vampyre", fuzzy=True)) == {2}
@@ -1,3 +1,4 @@
+from fake_firestore import FakeFirestore
 from indexer import build_index_doc, _tokenize
 
 
@@ -21,3 +22,56 @@ def test_build_index_doc():
     assert "search_text" in idx
     assert isinstance(idx["tokens"], list)
     assert "goblins" in idx["tokens"]
+
+
+def test_build_index_doc_carries_search_fields():
+    from indexer import SEARCH_INDEX_SCHEMA_VERSION, index_doc_to_quest
+
+    quest = {
+        "title": " Lost Mines ",
+        "summary": "Goblins.",
+        "level": "1-4",
+        "players": None,
+        "tags": ["dungeon"],
+        "common_monsters": "goblins",
+        "environment": ["cave"],
+        "genre": "Fantasy",
+        "classification": None,
+        "publisher": "Ignored",
+    }
+    idx = build_index_doc(quest)
+    assert idx["schemaVersion"] == SEARCH_INDEX_SCHEMA_VERSION
+    assert index_doc_to_quest("q1", idx) == {
+        "id": "q1",
+        "title": "Lost Mines",
+        "summary": "Goblins.",
+        "level": "1-4",
+        "players": None,
+        "tags": ["dungeon"],
+        "environment": ["cave"],
+        "genre": "Fantasy",
+    }
+    # Documents from before the schema version carry no scoring fields.
+    assert index_doc_to_quest("q1", {"title": "Lost Mines"}) is None
+
+
+def test_index_quest_skips_writes_with_unchanged_content():
+    from indexer import INDEX_HASH_FIELD, index_quest, index_write_stats
+
+    quest = {"title": "Lost Mines", "summary": "Goblins.", "level": "1-4"}
+    first = build_index_doc(quest)
+    # Fields that are not indexed leave the hash alone.
+    same = build_index_doc(dict(quest, uploaderEmail="u@example.com"))
+    assert same[INDEX_HASH_FIELD] == first[INDEX_HASH_FIELD]
+    changed = build_index_doc(dict(quest, summary="Goblins and a dragon."))
+    assert changed[INDEX_HASH_FIELD] != first[INDEX_HASH_FIELD]
+
+    db = FakeFirestore()
+    before = index_write_stats()
+    assert index_quest(db, "q1", quest)
+    assert not index_quest(db, "q1", dict(quest, migrationStatus="done"))
+    assert index_quest(db, "q1", dict(quest, level="5-10"))
+    assert db.writes == 2
+    after = index_write_stats()
+    assert after["written"] - before["written"] == 2
+    assert after["skipped"] - before["skipped"] == 1
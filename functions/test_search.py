@@ -1,5 +1,6 @@
 import pytest
 
+from fake_firestore import FakeFirestore, FakeSnapshot
 from search import search_quests_core
 
 
@@ -32,3 +33,200 @@ def test_search_filters():
     out = search_quests_core("hunt", {"level": 5}, 1, 10, quests)
     assert out["total"] == 1
     assert out["hits"][0]["id"] == "2"
+
+
+def test_fetch_search_quests_batches_with_field_mask():
+    from search import SEARCH_QUEST_FIELDS, fetch_search_quests
+
+    docs = {str(i): {"title": f"Quest {i}"} for i in range(7)}
+    db = FakeFirestore({"questCards": docs})
+    ids = ["6", "missing", "0", "3", "1", "2", "4", "5"]
+    quests = fetch_search_quests(db, ids, chunk_size=3, max_workers=2)
+
+    assert [q["id"] for q in quests] == ["6", "0", "3", "1", "2", "4", "5"]
+    assert quests[0] == {"id": "6", "title": "Quest 6"}
+    assert sorted(len(c[0]) for c in db.get_all_calls) == [2, 3, 3]
+    assert all(c[1] == SEARCH_QUEST_FIELDS for c in db.get_all_calls)
+    assert fetch_search_quests(db, []) == []
+
+
+def test_quests_from_index_docs_reads_only_outdated_documents():
+    from search import quests_from_index_docs
+
+    db = FakeFirestore({"questCards": {"b": {"title": "Old B", "level": 2}}})
+    snaps = [
+        FakeSnapshot(
+            "a", {"title": "A", "summary": "", "level": 1, "schemaVersion": 2}
+        ),
+        FakeSnapshot("b", {"title": "Old B"}),
+        FakeSnapshot("c", {"title": "C", "summary": "", "schemaVersion": 2}),
+    ]
+    quests, fetched = quests_from_index_docs(db, snaps, {"level": 1})
+    assert [q["id"] for q in quests] == ["a", "b", "c"]
+    assert quests[1] == {"id": "b", "title": "Old B", "level": 2}
+    assert fetched == 1 and db.get_all_calls[0][0] == ["b"]
+
+    # A filter on a field the index lacks reads full quest documents.
+    db.get_all_calls.clear()
+    quests, fetched = quests_from_index_docs(db, snaps[:1], {"publisher": "x"})
+    assert fetched == 1 and db.get_all_calls == [(["a"], None)]
+
+
+def test_fetch_fuzzy_candidates_verifies_by_edit_distance():
+    from fuzzy import doc_trigrams
+    from search import fetch_fuzzy_candidates
+
+    def doc(*tokens):
+        return {"tokens": list(tokens), "trigrams": doc_trigrams(tokens)}
+
+    db = FakeFirestore(
+        {
+            "questSearchIndex": {
+                "a": doc("dragon", "hunt"),
+                "b": doc("wagon", "train"),
+                "c": doc("goblin"),
+            }
+        }
+    )
+    snaps = fetch_fuzzy_candidates(db, ["dargon"], 200)
+    # "wagon" shares trigrams with "dargon" but is two edits away.
+    assert [s.id for s in snaps] == ["a"]
+    assert db.where_calls[0][:2] == ("trigrams", "array_contains")
+    assert fetch_fuzzy_candidates(db, ["orc"], 200) == []
+
+
+def test_fuzzy_candidates_not_crowded_out_by_common_trigrams():
+    from fuzzy import doc_trigrams
+    from search import fetch_fuzzy_candidates
+
+    def doc(*tokens):
+        return {"tokens": list(tokens), "trigrams": doc_trigrams(tokens)}
+
+    # More distractors than the limit, all sorted ahead of the true matches
+    # and sharing the query's boundary and common trigrams.
+    docs = {f"a{i:04d}": doc("behemoth", "holder", "bold", "moon") for i in range(300)}
+    docs.update({f"z{i}": doc("beholder", "lair") for i in range(5)})
+    db = FakeFirestore({"questSearchIndex": docs})
+
+    snaps = fetch_fuzzy_candidates(db, ["beholdr"], 200)
+    assert sorted(s.id for s in snaps) == [f"z{i}" for i in range(5)]
+    assert all(call[1] == "array_contains" for call in db.where_calls)
+
+
+def test_token_candidates_split_long_queries_and_rank_by_matches():
+    from search import fetch_token_candidates
+
+    tokens = [f"t{i:02d}" for i in range(25)]
+    db = FakeFirestore(
+        {
+            "questSearchIndex": {
+                "first": {"tokens": ["t00", "x"]},
+                "both": {"tokens": ["t01", "t15"], "level": "1-4"},
+                "last": {"tokens": ["t24"]},
+                "three": {"tokens": ["t02", "t12", "t22"], "level": "5-10"},
+                "none": {"tokens": ["x"]},
+            }
+        }
+    )
+    snaps = fetch_token_candidates(db, tokens + ["t00"], 200)
+    groups = sorted(call[2] for call in db.where_calls)
+    assert groups == [tokens[:10], tokens[10:20], tokens[20:]]
+    assert [s.id for s in snaps] == ["three", "both", "first", "last"]
+    assert [s.id for s in fetch_token_candidates(db, tokens, 2)] == ["three", "both"]
+
+    db.where_calls.clear()
+    snaps = fetch_token_candidates(db, tokens, 200, [("level", "==", "1-4")])
+    assert [s.id for s in snaps] == ["both"]
+    assert len(db.where_calls) == 6
+
+
+def test_filters_pushed_down_within_query_limits():
+    from fuzzy import doc_trigrams
+    from search import fetch_fuzzy_candidates, plan_filter_pushdown
+
+    clauses, residual = plan_filter_pushdown(
+        {
+            "level": "1-4",
+            "genre": ["Horror", "Mystery"],
+            "classification": ["Adventure", "Setting"],
+            "tags": ["undead"],
+            "players": None,
+        }
+    )
+    # One `in` clause only, and 10 trigrams x 2 values stays under 30.
+    assert clauses == [
+        ("classification", "in", ["Adventure", "Setting"]),
+        ("level", "==", "1-4"),
+    ]
+    assert residual == {"genre": ["Horror", "Mystery"], "tags": ["undead"]}
+    clauses, residual = plan_filter_pushdown({"genre": ["a", "b", "c", "d"]})
+    assert clauses == [] and residual == {"genre": ["a", "b", "c", "d"]}
+
+    def doc(level, *tokens):
+        return {
+            "level": level,
+            "tokens": list(tokens),
+            "trigrams": doc_trigrams(tokens),
+        }
+
+    db = FakeFirestore(
+        {"questSearchIndex": {"a": doc("5-10", "dragon"), "b": doc("1-4", "dragon")}}
+    )
+    snaps = fetch_fuzzy_candidates(db, ["dargon"], 200, [("level", "==", "1-4")])
+    assert [s.id for s in snaps] == ["b"]
+
+
+def test_cursor_round_trip_and_resume():
+    from search import cursor_offset, decode_cursor, encode_cursor
+
+    hits = [{"id": str(i), "score": 1.0 - i / 10} for i in range(6)]
+    cursor = decode_cursor(encode_cursor("dragon|", 7, 2, hits[1]))
+    assert cursor == {"k": "dragon|", "g": 7, "o": 2, "i": "1", "s": 0.9}
+    assert cursor_offset(hits, cursor) == 2
+
+    # A quest was added above the cursor: resume after the last id.
+    shifted = [{"id": "new", "score": 2.0}] + hits
+    assert cursor_offset(shifted, cursor) == 3
+    # The last hit is gone: resume at the first lower score.
+    assert cursor_offset(hits[2:], cursor) == 0
+    assert cursor_offset([h for h in hits if h["id"] != "1"], cursor) == 1
+
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+    import base64
+    import json
+
+    def raw_cursor(payload):
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    coerced = decode_cursor(raw_cursor({"k": "dragon|", "o": "5", "s": "0.5"}))
+    assert coerced["o"] == 5 and coerced["s"] == 0.5
+    assert decode_cursor(raw_cursor({"k": "dragon|", "o": -3}))["o"] == 0
+    for payload in ({"k": 1, "o": 0}, {"k": "dragon|", "o": "x"}, [1]):
+        with pytest.raises(ValueError):
+            decode_cursor(raw_cursor(payload))
+
+
+def test_snippets_cover_query_terms_and_only_the_page():
+    from search import _snippet_for_query
+    from search_index import SearchIndex
+
+    summary = (
+        "A cave far from town. " * 4 + "The goblin chief waits in the cave below."
+    )
+    snippet = _snippet_for_query(summary, "goblin cave")
+    assert "goblin chief waits in the cave" in snippet
+    assert _snippet_for_query("Hunt the Dragon.", "the dragon") == "Hunt the Dragon."
+
+    quests = [
+        {"id": str(i), "title": f"Dragon {i}", "summary": "A dragon."}
+        for i in range(30)
+    ]
+    index = SearchIndex(quests)
+    calls = []
+    lowered = index.lowered
+    index.lowered = lambda doc, field: calls.append(doc) or lowered(doc, field)
+    out = search_quests_core("dragon", {}, 2, 5, [], index=index)
+    assert out["total"] == 30 and len(out["hits"]) == 5
+    assert len(calls) == 5
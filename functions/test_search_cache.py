@@ -0,0 +1,66 @@
+import search_cache
+from fake_firestore import FakeFirestore
+from search_cache import GenerationTracker, SearchResultCache, estimate_bytes
+
+
+def _hits(n):
+    return [{"id": str(i), "title": "t", "snippet": "s"} for i in range(n)]
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = SearchResultCache(max_entries=2, max_bytes=10_000, ttl=60)
+    cache.put("a", 1, "A", 100)
+    cache.put("b", 1, "B", 100)
+    assert cache.get("a", 1) == "A"  # a is now most recent
+    cache.put("c", 1, "C", 100)
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == "A" and cache.get("c", 1) == "C"
+    assert cache.counters["evictions"] == 1
+
+    cache.put("big", 1, "X", 9_800)
+    assert cache.get("a", 1) is None  # evicted to stay within max_bytes
+    assert len(cache) == 2 and cache.bytes == 9_900
+    cache.put("huge", 1, "Y", 20_000)  # larger than the budget: not cached
+    assert cache.get("huge", 1) is None
+    assert cache.stats()["bytes"] == 9_900
+
+
+def test_generation_change_and_ttl_invalidate(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(search_cache.time, "time", lambda: clock[0])
+    cache = SearchResultCache(ttl=30)
+    cache.put("q", 5, "v", 10)
+    assert cache.get("q", 5) == "v"
+    assert cache.get("q", 6) is None
+    assert cache.counters["invalidated"] == 1 and len(cache) == 0
+
+    cache.put("q", 6, "v", 10)
+    clock[0] += 31
+    assert cache.get("q", 6) is None
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "expired": 1,
+        "invalidated": 1,
+        "evictions": 0,
+        "entries": 0,
+        "bytes": 0,
+    }
+
+
+def test_estimate_bytes_grows_with_hits():
+    assert estimate_bytes(_hits(10)) > estimate_bytes(_hits(1)) > estimate_bytes([])
+
+
+def test_generation_tracker_reads_until_listener_delivers():
+    db = FakeFirestore({"searchIndexMeta": {"state": {"generation": 3}}})
+    tracker = GenerationTracker(db)
+    assert tracker.current() == 3 and db.reads == 1
+    db.push("searchIndexMeta", ("MODIFIED", "state", {"generation": 4}))
+    assert tracker.current() == 4 and db.reads == 1
+
+    # A stopped listener is restarted; reads resume until it delivers.
+    db.watches[-1].is_active = False
+    db.data["searchIndexMeta"]["state"] = {"generation": 5}
+    assert tracker.current() == 5 and db.reads == 2
+    assert len(db.watches) == 2
@@ -0,0 +1,117 @@
+from fake_firestore import FakeFirestore
+from search import search_quests_core
+from search_corpus import SearchCorpus
+
+
+def _doc(title, summary, **fields):
+    return {"title": title, "summary": summary, "schemaVersion": 2, **fields}
+
+
+def _primed_corpus(**kwargs):
+    db = FakeFirestore()
+    corpus = SearchCorpus(db, **kwargs)
+    corpus.ensure_started()
+    assert not corpus.ready()
+    db.push(
+        "questSearchIndex",
+        (
+            "ADDED",
+            "1",
+            _doc("Dragon Hunt", "Hunt the red dragon.", level="1-4", tags=["dragon"]),
+        ),
+        ("ADDED", "2", _doc("Goblin Cave", "Clear the goblins.", level="5-10")),
+    )
+    return db, corpus
+
+
+def test_corpus_primes_from_initial_snapshot():
+    _, corpus = _primed_corpus()
+    assert corpus.ready()
+    assert len(corpus.index) == 2
+    quests = {q["id"]: q for _, q in corpus.index.live_quests()}
+    assert quests["1"] == {
+        "id": "1",
+        "title": "Dragon Hunt",
+        "summary": "Hunt the red dragon.",
+        "level": "1-4",
+        "tags": ["dragon"],
+    }
+    out = search_quests_core(
+        "dragon", {"level": "1-4"}, 1, 10, [], index=corpus.index, only_matching=True
+    )
+    assert [hit["id"] for hit in out["hits"]] == ["1"]
+
+
+def test_incremental_changes_update_the_index():
+    db, corpus = _primed_corpus()
+    db.push(
+        "questSearchIndex",
+        ("MODIFIED", "2", _doc("Goblin Dragon", "Goblins.", level="1-4")),
+        ("ADDED", "3", _doc("Market Day", "Haggle.")),
+    )
+    db.push("questSearchIndex", ("REMOVED", "1", None))
+    assert sorted(q["id"] for _, q in corpus.index.live_quests()) == ["2", "3"]
+    ids = {corpus.index.quests[d]["id"] for d in corpus.index.text_scores("dragon")}
+    assert ids == {"2"}
+    quests = {q["id"]: q for _, q in corpus.index.live_quests()}
+    assert quests["2"]["level"] == "1-4"
+    assert corpus.prefixes.complete_titles("goblin") == [
+        {"id": "2", "title": "Goblin Dragon"}
+    ]
+    assert corpus.prefixes.complete_titles("dragon") == [
+        {"id": "2", "title": "Goblin Dragon"}
+    ]
+
+
+def test_outdated_index_documents_keep_the_corpus_unready():
+    db, corpus = _primed_corpus()
+    db.push("questSearchIndex", ("MODIFIED", "2", {"title": "Old", "summary": "x"}))
+    assert not corpus.ready()
+    assert corpus.can_complete()
+    assert corpus.status()["outdatedDocs"] == 1
+    assert "2" not in corpus.index
+    db.push("questSearchIndex", ("MODIFIED", "2", _doc("New", "x")))
+    assert corpus.ready()
+
+
+def test_corpus_over_budget_is_disabled():
+    db = FakeFirestore()
+    corpus = SearchCorpus(db, max_bytes=100)
+    corpus.ensure_started()
+    db.push("questSearchIndex", ("ADDED", "1", _doc("A", "B")))
+    assert not corpus.ready()
+    assert "budget" in corpus.status()["disabledReason"]
+    assert len(corpus.index) == 0
+    assert all(not watch.is_active for watch in db.watches)
+    corpus.ensure_started()  # stays off
+    assert len(db.watches) == 1
+
+
+def test_stopped_listener_marks_stale_and_restarts():
+    db, corpus = _primed_corpus()
+    db.watches[0].is_active = False
+    assert corpus.stale() and not corpus.ready()
+    assert corpus.status()["stale"] is True
+    corpus.ensure_started()
+    assert len(db.watches) == 2 and not corpus.ready()
+    db.push("questSearchIndex", ("ADDED", "1", _doc("T", "S")))
+    assert corpus.ready() and len(corpus.index) == 1
+
+
+def test_supports_only_indexed_fields_as_filters():
+    _, corpus = _primed_corpus()
+    assert corpus.supports_filters({"level": "1-4", "genre": "Horror", "tags": None})
+    assert corpus.supports_filters(None)
+    assert not corpus.supports_filters({"publisher": "WotC"})
+
+
+def test_corpus_search_reports_candidate_path():
+    _, corpus = _primed_corpus()
+    result, path = corpus.search("dragon", {})
+    assert path == "exact" and [h["id"] for h in result["hits"]] == ["1"]
+    result, path = corpus.search("dargon", {})
+    assert path == "fuzzy" and [h["id"] for h in result["hits"]] == ["1"]
+    result, path = corpus.search("unicorn", {})
+    assert path == "none" and result["hits"] == []
+    result, path = corpus.search("the of", {})
+    assert path == "fullScan" and result["total"] == 2
@@ -0,0 +1,149 @@
+import math
+
+from search import search_quests_core
+from search_index import SearchIndex
+
+
+def make_quest(id, title, summary, **fields):
+    q = {"id": id, "title": title, "summary": summary}
+    q.update(fields)
+    return q
+
+
+QUESTS = [
+    make_quest("1", "Dragon Hunt", "Hunt the red dragon in the mountains."),
+    make_quest("2", "Goblin Clearing", "Clear the goblin camp in the woods."),
+    make_quest("3", "Mountain Rescue", "Rescue the prince from a dragon lair."),
+    make_quest("4", "Market Day", "Haggle with merchants."),
+]
+
+
+def test_postings_cover_title_and_summary_terms():
+    index = SearchIndex(QUESTS)
+    # doc -> (title tf, summary tf)
+    assert index.postings["dragon"] == {0: (1, 1), 2: (0, 1)}
+    assert "the" not in index.postings  # stopword
+    assert index.idf("dragon") == math.log(1 + (4 - 2 + 0.5) / (2 + 0.5))
+
+
+def test_only_matching_documents_are_scored():
+    index = SearchIndex(QUESTS)
+    scores = index.text_scores("dragon mountains")
+    assert set(scores) == {0, 2}
+    assert all(0 < s < 1 for s in scores.values())
+    assert index.text_scores("the of and") == {}
+    assert index.text_scores("unicorn") == {}
+
+
+def test_title_match_outranks_summary_match():
+    quests = [
+        make_quest("a", "Tomb of Horrors", "A deadly dungeon crawl."),
+        make_quest("b", "Deadly Crawl", "Explore the tomb of a forgotten king."),
+    ]
+    scores = SearchIndex(quests).text_scores("tomb")
+    assert scores[0] > scores[1]
+
+
+def test_search_core_uses_prebuilt_index_and_keeps_shape():
+    index = SearchIndex(QUESTS)
+    out = search_quests_core("dragon", {}, 1, 2, [], index=index)
+    assert out["total"] == 4
+    assert out["page"] == 1 and out["pageSize"] == 2
+    assert [hit["id"] for hit in out["hits"]] == ["1", "3"]
+    assert set(out["hits"][0]) == {"id", "title", "snippet", "score"}
+
+    page2 = search_quests_core("dragon", {}, 2, 2, [], index=index)
+    assert [hit["id"] for hit in page2["hits"]] == ["2", "4"]
+    assert all(hit["score"] == 0.0 for hit in page2["hits"])
+
+
+def test_add_replace_and_remove_keep_postings_consistent():
+    index = SearchIndex(QUESTS)
+    index.add(make_quest("2", "Goblin Dragon", "Now with a dragon."))
+    assert len(index) == 4
+    assert set(index.text_scores("dragon")) == {0, 2, 4}
+    assert "clear" not in index.postings
+
+    assert index.remove("1") and not index.remove("1")
+    assert "1" not in index and len(index) == 3
+    assert index.idf("dragon") == math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+    # Compaction renumbers slots but keeps every live quest searchable.
+    assert sorted(
+        index.quests[doc]["id"] for doc in index.text_scores("dragon")
+    ) == ["2", "3"]
+    assert sorted(q["id"] for _, q in index.live_quests()) == ["2", "3", "4"]
+
+
+def test_search_core_only_matching():
+    index = SearchIndex(QUESTS)
+    out = search_quests_core("dragon", {}, 1, 10, [], index=index, only_matching=True)
+    assert out["total"] == 2
+    assert [hit["id"] for hit in out["hits"]] == ["1", "3"]
+
+
+def test_top_k_matches_the_full_ranking():
+    quests = [
+        make_quest(
+            str(i),
+            f"Quest {i} " + ("Dragon" if i % 3 == 0 else "Goblin"),
+            "The dragon waits. " * (i % 5) + "A goblin camp.",
+            level="1-4" if i % 2 else "5-10",
+            genre="Horror" if i % 4 == 0 else "Fantasy",
+        )
+        for i in range(40)
+    ]
+    index = SearchIndex(quests)
+    cases = [
+        ("dragon", {}, True, False),
+        ("dragon goblin", {}, False, False),
+        ("dargon", {}, True, True),
+        ("dragon", {"genre": "Fantasy"}, True, False),
+        ("dragon", {"level": "1-4"}, False, False),
+    ]
+    for query, filters, only_matching, fuzzy in cases:
+        kwargs = dict(index=index, only_matching=only_matching, fuzzy=fuzzy)
+        full = search_quests_core(query, filters, 1, 100, [], **kwargs)
+        for k in (1, 5, 12):
+            top = search_quests_core(query, filters, 1, k, [], top_k=k, **kwargs)
+            assert top["total"] == full["total"]
+            assert top["hits"] == full["hits"][:k]
+
+
+def test_facet_counts_follow_the_match_set_and_updates():
+    quests = [
+        make_quest("1", "Dragon Hunt", "", level="1-4", genre="Fantasy"),
+        make_quest("2", "Dragon Lair", "", level="5-10", genre="Fantasy"),
+        make_quest("3", "Goblin Cave", "", level="1-4", genre=["Horror", "Fantasy"]),
+        make_quest("4", "Dragon Tomb", "", standardizedGameSystem="D&D 5E"),
+    ]
+    index = SearchIndex(quests)
+    facets = index.facet_counts(index.doc_mask([0, 1, 2]))
+    assert facets["level"] == [
+        {"value": "1-4", "count": 2},
+        {"value": "5-10", "count": 1},
+    ]
+    assert facets["genre"] == [
+        {"value": "Fantasy", "count": 3},
+        {"value": "Horror", "count": 1},
+    ]
+    assert facets["standardizedGameSystem"] == [] and facets["classification"] == []
+
+    index.remove("1")
+    index.add(make_quest("5", "Dragon Keep", "", level="5-10"))
+    for top_k in (None, 1):
+        out = search_quests_core(
+            "dragon",
+            {},
+            1,
+            10,
+            [],
+            index=index,
+            only_matching=True,
+            top_k=top_k,
+            facets=True,
+        )
+        assert out["total"] == 3
+        assert out["facets"]["level"] == [{"value": "5-10", "count": 2}]
+        assert out["facets"]["standardizedGameSystem"] == [
+            {"value": "D&D 5E", "count": 1}
+        ]
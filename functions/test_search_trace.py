@@ -0,0 +1,106 @@
+import inspect
+import json
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+import main
+import search_cache
+import search_corpus
+from fake_firestore import FakeFirestore
+from indexer import build_index_doc
+from search_trace import SearchTrace
+
+
+def _fake_db(quests):
+    return FakeFirestore(
+        {
+            "questSearchIndex": {id: build_index_doc(q) for id, q in quests.items()},
+            "questCards": dict(quests),
+            "searchIndexMeta": {"state": {"generation": 1}},
+        }
+    )
+
+
+QUESTS = {
+    "1": {"title": "Dragon Hunt", "summary": "Hunt the red dragon.", "level": "1-4"},
+    "2": {"title": "Goblin Cave", "summary": "Clear the goblins.", "level": "5-10"},
+    "3": {"title": "Dragon Lair", "summary": "A lair in the hills.", "level": "5-10"},
+}
+
+
+@pytest.fixture
+def search(monkeypatch, capsys):
+    monkeypatch.setattr(search_corpus, "SEARCH_CORPUS_ENABLED", False)
+    monkeypatch.setattr(search_cache, "_tracker", None)
+    monkeypatch.setenv("SEARCH_DEBUG_TIMINGS", "1")
+    search_cache.get_cache().clear()
+    db = _fake_db(QUESTS)
+
+    def run(**data):
+        capsys.readouterr()
+        with patch("main.firestore") as firestore:
+            firestore.client.return_value = db
+            result = inspect.unwrap(main.search_quests)(
+                SimpleNamespace(data=data)
+            )
+        lines = capsys.readouterr().out.strip().splitlines()
+        return result, [json.loads(line) for line in lines]
+
+    yield run
+    search_cache.get_cache().clear()
+
+
+def test_trace_accumulates_stages_and_counts():
+    trace = SearchTrace()
+    for _ in range(2):
+        with trace.stage("fetch"):
+            pass
+    trace.count("reads", 3)
+    trace.set(cache="miss")
+    record = trace.record()
+    assert set(record["stagesMs"]) == {"fetch"}
+    assert record["counts"] == {"reads": 3} and record["cache"] == "miss"
+
+
+def test_search_quests_emits_one_record_per_request(search):
+    result, records = search(query="dragon", filters={"level": "5-10"})
+    assert [hit["id"] for hit in result["hits"]] == ["3"]
+    assert len(records) == 1
+    record = records[0]
+    assert record["event"] == "search_quests" and record["severity"] == "INFO"
+    assert result["_timings"]["counts"] == record["counts"]
+    assert record["cache"] == "miss" and record["source"] == "firestore"
+    assert record["path"] == "exact" and record["fallback"] is False
+    assert record["plan"] == {"where": ["level == '5-10'"], "python": []}
+    assert record["counts"]["candidates"] == 1
+    assert record["counts"]["indexReads"] == 1
+    assert record["counts"]["questCardReads"] == 0
+    assert {"generation", "tokenize", "candidates", "rank", "snippets"} <= set(
+        record["stagesMs"]
+    )
+
+    # The same search again is served from the result cache.
+    result, records = search(query="dragon", filters={"level": "5-10"})
+    assert records[0]["cache"] == "hit" and records[0]["source"] == "cache"
+    assert "candidates" not in records[0]["counts"]
+
+
+def test_full_scan_fallback_is_recorded(search, monkeypatch):
+    monkeypatch.delenv("SEARCH_DEBUG_TIMINGS")
+    result, records = search(query="the", filters={})
+    assert "_timings" not in result and result["total"] == 3
+    record = records[0]
+    assert record["path"] == "fullScan" and record["fallback"] is True
+    assert record["counts"]["indexReads"] == 3 and "fullScan" in record["stagesMs"]
+
+
+def test_firestore_path_marks_facets_partial(search):
+    result, _ = search(query="dragon", filters={}, facets=True)
+    assert result["facetsPartial"] is True
+    assert result["facets"]["level"]
+
+    # Served from the result cache, the facets are still marked partial.
+    result, records = search(query="dragon", filters={}, facets=True)
+    assert records[0]["cache"] == "hit" and result["facetsPartial"] is True
@@ -4,6 +4,7 @@ import unittest
 from unittest.mock import patch, MagicMock
 import nltk
 import similarity_calculator as sc # Corrected import statement
+from fake_firestore import FakeFirestore
 
 # Ensure NLTK data is available
 try:
@@ -86,20 +87,18 @@ class TestSimilarityCalculator(unittest.TestCase):
         score = sc._calculate_text_similarity(text1, text2)
         self.assertEqual(score, 1.0) # Expect 1.0 if both truly empty and processed are empty
 
-    @patch('similarity_calculator.nltk.download')
     @patch('similarity_calculator.word_tokenize')
-    @patch('similarity_calculator.stopwords.words')
-    def test_calculate_text_similarity_empty_strings(self, mock_stopwords, mock_word_tokenize, mock_nltk_download):
+    @patch('similarity_calculator.load_stopwords')
+    def test_calculate_text_similarity_empty_strings(self, mock_stopwords, mock_word_tokenize):
         mock_stopwords.return_value = []
         mock_word_tokenize.side_effect = lambda x: x.split() # simple split for testing
         # Test with two empty strings
         score = sc._calculate_text_similarity("", "")
         self.assertEqual(score, 1.0) # Should be 1.0 if both are empty
 
-    @patch('similarity_calculator.nltk.download')
     @patch('similarity_calculator.word_tokenize')
-    @patch('similarity_calculator.stopwords.words')
-    def test_calculate_text_similarity_one_empty_string(self, mock_stopwords, mock_word_tokenize, mock_nltk_download):
+    @patch('similarity_calculator.load_stopwords')
+    def test_calculate_text_similarity_one_empty_string(self, mock_stopwords, mock_word_tokenize):
         mock_stopwords.return_value = ['is', 'the', 'a', 'of', 'and', 'to']
         mock_word_tokenize.side_effect = lambda x: nltk.word_tokenize(x) # Use actual NLTK tokenizer for this
         # Test with one empty string and one non-empty
@@ -108,10 +107,9 @@ class TestSimilarityCalculator(unittest.TestCase):
         score2 = sc._calculate_text_similarity("", "hello world")
         self.assertEqual(score2, 0.0)
 
-    @patch('similarity_calculator.nltk.download')
     @patch('similarity_calculator.word_tokenize')
-    @patch('similarity_calculator.stopwords.words')
-    def test_calculate_text_similarity_stopwords_only(self, mock_stopwords, mock_word_tokenize, mock_nltk_download):
+    @patch('similarity_calculator.load_stopwords')
+    def test_calculate_text_similarity_stopwords_only(self, mock_stopwords, mock_word_tokenize):
         # Using a more complete list of stopwords for the mock, including 'an'
         mock_stopwords.return_value = ['is', 'the', 'a', 'of', 'and', 'to', 'an'] 
         mock_word_tokenize.side_effect = lambda x: nltk.word_tokenize(x) if x else []
@@ -122,10 +120,9 @@ class TestSimilarityCalculator(unittest.TestCase):
         score = sc._calculate_text_similarity(text1, text2)
         self.assertEqual(score, 1.0)
 
-    @patch('similarity_calculator.nltk.download')
     @patch('similarity_calculator.word_tokenize')
-    @patch('similarity_calculator.stopwords.words')
-    def test_calculate_text_similarity_mixed_content(self, mock_stopwords, mock_word_tokenize, mock_nltk_download):
+    @patch('similarity_calculator.load_stopwords')
+    def test_calculate_text_similarity_mixed_content(self, mock_stopwords, mock_word_tokenize):
         # This test might need adjustment if it's conflicting with non-mocked tests
         # For now, let's assume it uses the mocked versions correctly
         mock_stopwords.return_value = ['the', 'is', 'a']
@@ -136,10 +133,9 @@ class TestSimilarityCalculator(unittest.TestCase):
         score = sc._calculate_text_similarity(text1, text2)
         self.assertTrue(0.0 <= score < 1.0)
 
-    @patch('similarity_calculator.nltk.download')
     @patch('similarity_calculator.word_tokenize')
-    @patch('similarity_calculator.stopwords.words')
-    def test_calculate_text_similarity_case_insensitivity(self, mock_stopwords, mock_word_tokenize, mock_nltk_download):
+    @patch('similarity_calculator.load_stopwords')
+    def test_calculate_text_similarity_case_insensitivity(self, mock_stopwords, mock_word_tokenize):
         mock_stopwords.return_value = []
         mock_word_tokenize.side_effect = lambda x: nltk.word_tokenize(x.lower()) if x else []
 
@@ -171,6 +167,7 @@ class TestSimilarityCalculator(unittest.TestCase):
         mock_init_firebase.assert_called_once()
 
 
+    @patch('similarity_calculator.VECTORIZED_SCORING', False)
     @patch('similarity_calculator.firestore.client')
     @patch('similarity_calculator._initialize_firebase')
     @patch('similarity_calculator._calculate_field_match_score')
@@ -268,8 +265,354 @@ class TestSimilarityCalculator(unittest.TestCase):
 
         # Verify Firestore writes (batch commit)
         mock_db.batch.return_value.commit.assert_called_once()
-        # Check that set was called for each similar quest
-        self.assertEqual(mock_db.batch.return_value.set.call_count, 2)
+        # Check that set was called for each similar quest, plus the neighbor map
+        set_calls = mock_db.batch.return_value.set.call_args_list
+        self.assertEqual(len(set_calls), 3)
+        self.assertEqual(
+            set_calls[-1].args[1],
+            {"neighbors": {"quest3": results[0]["score"], "quest2": results[1]["score"]}},
+        )
+        self.assertEqual(set_calls[-1].kwargs, {"merge": ["neighbors"]})
+
+    def test_corpus_text_model_empty_text_rules(self):
+        quests = [
+            {"title": "Dragon Hunt", "summary": ""},
+            {"title": "Hunt the dragon", "summary": ""},
+            {"title": "", "summary": "Goblin caves"},
+            {"title": "the of and", "summary": "goblin caves"},
+        ]
+        model = sc.CorpusTextModel(quests)
+        block = model.block_scores(0, len(quests))
+        # Titles match after stopwords, both summaries empty -> 1.0 as well
+        self.assertAlmostEqual(block[0][1], 1.0)
+        # Titles empty after preprocessing on both sides, identical summaries
+        self.assertAlmostEqual(block[2][3], 1.0)
+        # One side empty for both title and summary
+        self.assertAlmostEqual(block[0][2], 0.0)
+        self.assertAlmostEqual(block[0][2], sc._pairwise_text_score(quests[0], quests[2]))
+        self.assertEqual(list(model.scores_for(1)), list(block[1]))
+
+    def test_rank_similar_quests_corpus_orders_by_text(self):
+        target = {"id": "t", "title": "Dragon Hunt", "summary": "Hunt the red dragon in the mountains."}
+        others = [
+            {"id": "goblin", "title": "Goblin Clearing", "summary": "Clear the goblin camp in the woods."},
+            {"id": "dragon", "title": "Dragon Lair", "summary": "Slay the red dragon in its mountain lair."},
+        ]
+        with patch('similarity_calculator.VECTORIZED_SCORING', True):
+            ranked = sc._rank_similar_quests(target, others)
+        self.assertEqual([r["id"] for r in ranked], ["dragon", "goblin"])
+        self.assertTrue(all(isinstance(r["score"], float) for r in ranked))
+
+    def test_compute_all_similarities_matches_per_quest_ranking(self):
+        from benchmarks import make_corpus
+
+        quests = make_corpus(40)
+        quests[3].pop("level")  # missing scalar field must never match
+        quests[4]["tags"] = "not-a-list"
+        bulk = dict(sc.compute_all_similarities(quests, top_n=5, block_rows=7))
+        self.assertEqual(len(bulk), len(quests))
+
+        model = sc.CorpusTextModel(quests)
+        for i, quest in enumerate(quests):
+            text_scores = model.scores_for(i)
+            expected = sorted(
+                (
+                    sc._hybrid_score(
+                        _calculate_field_match_score(quest, other, FIELD_MATCH_WEIGHTS),
+                        text_scores[j],
+                    )
+                    for j, other in enumerate(quests)
+                    if j != i
+                ),
+                reverse=True,
+            )[:5]
+            got = bulk[quest["id"]]
+            self.assertNotIn(quest["id"], [item["id"] for item in got])
+            for item, score in zip(got, expected):
+                self.assertAlmostEqual(item["score"], score)
+
+    @patch.object(sc, "VECTORIZED_SCORING", False)
+    @patch("similarity_calculator._commit_ops", side_effect=RuntimeError("commit failed"))
+    @patch("similarity_calculator._score_against", return_value=[0.5])
+    @patch("similarity_calculator._initialize_firebase")
+    def test_calculate_similarity_raises_when_results_not_stored(self, *_):
+        sc.fb_db = FakeFirestore(
+            {"questCards": {"q1": {"title": "A"}, "q2": {"title": "B"}}}
+        )
+        with self.assertRaises(RuntimeError):
+            calculate_similarity_for_quest("q1")
+
+    def test_store_similar_quests_bulk_writes_only_changes(self):
+        mock_db = MagicMock()
+
+        def doc(id, score):
+            snapshot = MagicMock(id=id)
+            snapshot.to_dict.return_value = {"score": score}
+            return snapshot
+
+        subcollection = mock_db.collection.return_value.document.return_value.collection.return_value
+        subcollection.stream.side_effect = [
+            [doc("old", 0.3), doc("b", 0.9)],
+            [doc("y", 0.7)],
+            [doc("y", 0.7), doc("orphan", 0.2)],
+            [doc("y", 0.7)],
+        ]
+
+        stats = sc.store_similar_quests_bulk(
+            mock_db,
+            [
+                ("a", [{"id": "b", "score": 0.9004}, {"id": "c", "score": 0.5}]),
+                ("z", [{"id": "y", "score": 0.7}]),
+                ("o", [{"id": "y", "score": 0.7}]),
+                ("m", [{"id": "y", "score": 0.7}]),
+            ],
+            existing={
+                "z": {"y": 0.7},
+                "o": {"y": 0.7},
+                "m": {"y": 0.7, "gone": 0.1},
+            },
+        )
+
+        batch = mock_db.batch.return_value
+        features_ref = mock_db.collection.return_value.document.return_value
+        # "a": insert c, delete old, keep b (within tolerance), update the map
+        # "z": unchanged and in sync with its map, so no writes
+        # "o": the orphan doc missing from the map is deleted
+        # "m": subcollection matches, but the drifted map is rewritten
+        self.assertEqual(batch.delete.call_count, 2)
+        maps = [
+            c[0][1]["neighbors"]
+            for c in batch.set.call_args_list
+            if c[1].get("merge") == ["neighbors"]
+        ]
+        self.assertEqual(maps, [{"b": 0.9, "c": 0.5}, {"y": 0.7}, {"y": 0.7}])
+        batch.set.assert_called_with(
+            features_ref, {"neighbors": {"y": 0.7}}, merge=["neighbors"]
+        )
+        self.assertEqual(batch.set.call_count, 4)
+        batch.commit.assert_called_once()
+        self.assertEqual(subcollection.stream.call_count, 4)
+        self.assertEqual(stats["quests"], 4)
+        self.assertEqual(stats["writes"], 6)
+        self.assertEqual(stats["fullRewriteWrites"], 15)
+        self.assertEqual(
+            (stats["inserted"], stats["updated"], stats["deleted"], stats["unchanged"]),
+            (1, 0, 2, 4),
+        )
+
+    def test_similar_quests_diff_updates_moved_scores(self):
+        ops, stats = sc._similar_quests_diff_ops(
+            MagicMock(), "a", {"b": 0.5, "c": 0.4}, [{"id": "b", "score": 0.6}, {"id": "c", "score": 0.4}]
+        )
+        self.assertEqual(stats["updated"], 1)
+        self.assertEqual([op for op, _, _ in ops], ["set", "merge"])
+        self.assertEqual(ops[-1][2], {"neighbors": {"b": 0.6, "c": 0.4}})
+
+        ops, stats = sc._similar_quests_diff_ops(MagicMock(), "a", {"b": 0.5}, [{"id": "b", "score": 0.5}])
+        self.assertEqual(ops, [])
+        self.assertEqual(stats["writes"], 0)
+
+    def test_reciprocal_updates_only_where_new_quest_beats_floor(self):
+        full = {f"n{i}": 0.1 * i for i in range(1, 11)}  # floor is n1 at 0.1
+        others = [
+            {"id": "beaten", "neighbors": dict(full)},
+            {"id": "not-beaten", "neighbors": dict(full)},
+            {"id": "room-left", "neighbors": {"n1": 0.9}},
+            {"id": "never-computed"},
+            {"id": "already-listed", "neighbors": {"new": 0.2}},
+        ]
+        scores = [0.35, 0.05, 0.01, 0.99, 0.99]
+
+        updates = sc._reciprocal_updates("new", others, scores)
+
+        # "already-listed" holds a stale score for "new", so it is rescored first.
+        self.assertEqual(
+            [u[0] for u in updates], ["already-listed", "beaten", "room-left"]
+        )
+        self.assertEqual(updates[0][2], {"new": 0.99})
+        updates = updates[1:]
+        quest_id, score, neighbors, evicted = updates[0]
+        self.assertEqual(score, 0.35)
+        self.assertEqual(evicted, "n1")
+        self.assertEqual(len(neighbors), 10)
+        self.assertEqual(neighbors["new"], 0.35)
+        self.assertNotIn("n1", neighbors)
+        self.assertIsNone(updates[1][3])
+        self.assertEqual(
+            [u[0] for u in sc._reciprocal_updates("new", others, scores, limit=1)],
+            ["already-listed"],
+        )
+
+    def test_reciprocal_update_rescores_or_evicts_edited_quest(self):
+        full = {f"n{i}": 0.1 * i for i in range(1, 10)}  # floor is n1 at 0.1
+        full["edited"] = 0.5
+        quest = {"id": "q", "neighbors": full}
+
+        self.assertIsNone(sc._reciprocal_update("edited", quest, 0.5004, 10))
+        neighbors, evicted = sc._reciprocal_update("edited", quest, 0.3, 10)
+        self.assertIsNone(evicted)
+        self.assertEqual(neighbors["edited"], 0.3)
+        self.assertEqual(len(neighbors), 10)
+        # Below the list's floor: the edited quest leaves the list.
+        neighbors, evicted = sc._reciprocal_update("edited", quest, 0.05, 10)
+        self.assertEqual(evicted, "edited")
+        self.assertNotIn("edited", neighbors)
+        self.assertEqual(len(neighbors), 9)
+
+    def test_store_reciprocal_updates_evicts_edited_quest_without_insert(self):
+        neighbors = {f"n{i}": 0.1 * i for i in range(1, 10)}
+        neighbors["edited"] = 0.5
+        mock_db, transaction = self._transaction_db(neighbors)
+        updated = sc._store_reciprocal_updates(
+            mock_db, "edited", [("q1", 0.05, {}, "edited")]
+        )
+        self.assertEqual(updated, 1)
+        transaction.delete.assert_called_once()
+        self.assertEqual(transaction.set.call_count, 1)
+        self.assertNotIn(
+            "edited", transaction.set.call_args[0][1]["neighbors"]
+        )
+
+    def _transaction_db(self, neighbors):
+        mock_db = MagicMock()
+        transaction = mock_db.transaction.return_value
+        transaction._max_attempts = 1
+        transaction._read_only = False
+        snapshot = mock_db.collection.return_value.document.return_value.get.return_value
+        snapshot.exists = True
+        snapshot.to_dict.return_value = {"neighbors": neighbors}
+        return mock_db, transaction
+
+    def test_store_reciprocal_updates_writes_insert_evict_and_map(self):
+        full = {f"n{i}": 0.1 * i for i in range(1, 11)}
+        mock_db, transaction = self._transaction_db(full)
+        updated = sc._store_reciprocal_updates(
+            mock_db, "new", [("q1", 0.5, {"new": 0.5}, None)]
+        )
+        self.assertEqual(updated, 1)
+        # The map is re-read inside the transaction, so n1 (its current floor)
+        # is evicted even though the caller's snapshot had room left.
+        mock_db.collection.return_value.document.return_value.get.assert_called_with(
+            field_paths=["neighbors"], transaction=transaction
+        )
+        self.assertEqual(transaction.set.call_count, 2)
+        transaction.delete.assert_called_once()
+        neighbors = transaction.set.call_args_list[-1][0][1]["neighbors"]
+        self.assertNotIn("n1", neighbors)
+        self.assertEqual(neighbors["new"], 0.5)
+        transaction._commit.assert_called_once()
+        mock_db.batch.assert_not_called()
+
+    def test_store_reciprocal_updates_skips_when_floor_rose(self):
+        mock_db, transaction = self._transaction_db(
+            {f"n{i}": 0.9 for i in range(10)}
+        )
+        updated = sc._store_reciprocal_updates(
+            mock_db, "new", [("q1", 0.5, {"new": 0.5}, None)]
+        )
+        self.assertEqual(updated, 0)
+        transaction.set.assert_not_called()
+        transaction.delete.assert_not_called()
+
+    def test_vectorized_field_match_parity(self):
+        from benchmarks import make_corpus
+
+        quests = make_corpus(30)
+        quests += [
+            {},
+            {"level": None, "players": None},
+            {"level": None, "players": 4, "duration": 1},
+            {"level": 1.0, "players": "4", "duration": True},
+            {"level": True, "common_monsters": ["Goblin", "Goblin"], "tags": "combat"},
+            {"level": [1, 2], "environment": ["Forest"], "tags": []},
+            {"level": [1, 2], "environment": set(["Forest", "Cave"]), "tags": None},
+            {"common_monsters": ["goblin"], "environment": ["Cave"], "tags": ["combat"]},
+        ]
+        encoded = sc._encode_match_fields(quests)
+        for i, target in enumerate(quests):
+            scores = sc._field_match_scores(encoded, i)
+            for j, other in enumerate(quests):
+                self.assertAlmostEqual(
+                    scores[j],
+                    _calculate_field_match_score(target, other, FIELD_MATCH_WEIGHTS),
+                    msg=f"pair {i},{j}",
+                )
+
+    def test_stream_top_similar_matches_in_memory_ranking(self):
+        from benchmarks import make_corpus
+        from similarity_features import build_feature_doc, features_to_quest
+
+        quests = make_corpus(60)
+        quests[5]["summary"] = ""
+        quests[6]["title"] = "the of"
+        features = [features_to_quest(q["id"], build_feature_doc(q)) for q in quests]
+        features[7]["neighbors"] = {f"x{i}": 0.0 for i in range(10)}
+        stats = sc.build_text_stats(features)
+
+        target = features[0]
+        expected = sc._rank_similar_quests(target, features[1:])
+        streamed, reciprocal, scanned = sc._stream_top_similar(
+            target, iter(features), stats
+        )
+
+        self.assertEqual(scanned, len(features) - 1)
+        self.assertEqual([r["id"] for r in streamed], [r["id"] for r in expected])
+        for got, want in zip(streamed, expected):
+            self.assertAlmostEqual(got["score"], want["score"])
+        self.assertEqual([u[0] for u in reciprocal], [features[7]["id"]])
+
+    @patch.object(sc, "_text_stats_cache", None)
+    @patch.object(sc, "TEXT_STATS_TERMS_PER_SHARD", 2)
+    def test_text_stats_are_sharded_and_round_trip(self):
+        db = FakeFirestore()
+        stats = {
+            "documentCount": 8,
+            "df": {"a": 2, "b": 3, "c": 2, "d": 4, "e": 2},
+            "computedAt": sc.time.time(),
+        }
+        self.assertTrue(sc.save_text_stats(db, stats))
+
+        meta = db.data["similarityModel"]["textStats"]
+        shards = db.data["similarityModel/textStats/dfShards"]
+        self.assertNotIn("df", meta)
+        self.assertEqual(meta["shardCount"], 3)
+        self.assertEqual(shards["2"]["df"], {"e": 2})
+        self.assertEqual(sc._read_text_stats(db)["df"], stats["df"])
+
+        # Shards left by a different build are not joined.
+        shards["1"]["computedAt"] = 0
+        self.assertIsNone(sc._read_text_stats(db))
+
+    @patch.object(sc, "_text_stats_cache", None)
+    @patch("similarity_calculator.stream_features")
+    def test_rebuilt_text_stats_are_cached_when_save_fails(self, mock_stream):
+        db = MagicMock()
+        db.collection.return_value.document.return_value.get.return_value.exists = False
+        db.collection.return_value.document.return_value.set.side_effect = (
+            RuntimeError("too many index entries")
+        )
+        mock_stream.return_value = [
+            {"titleText": "dragon hunt", "summaryText": "red dragon"}
+        ]
+
+        with self.assertLogs(level="ERROR") as logs:
+            stats = sc._load_text_stats(db)
+        self.assertEqual(stats["df"], {"dragon": 2})
+        self.assertTrue(any("Error saving text stats" in m for m in logs.output))
+
+        # The next call reuses this instance's copy instead of rebuilding.
+        self.assertIs(sc._load_text_stats(db), stats)
+        mock_stream.assert_called_once()
+
+    def test_build_text_stats_prunes_singletons(self):
+        stats = sc.build_text_stats(
+            [
+                {"titleText": "dragon hunt", "summaryText": "red dragon"},
+                {"titleText": "goblin", "summaryText": ""},
+            ]
+        )
+        self.assertEqual(stats["documentCount"], 4)
+        self.assertEqual(stats["df"], {"dragon": 2})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+from unittest.mock import MagicMock
+
+import similarity_calculator as sc
+from benchmarks import make_corpus
+from similarity_features import (
+    build_feature_doc,
+    feature_source,
+    features_to_quest,
+    stream_features,
+)
+
+
+def test_feature_docs_score_like_full_quests():
+    quests = make_corpus(25)
+    quests[1].pop("players")
+    quests[2]["tags"] = "not-a-list"
+    features = [features_to_quest(q["id"], build_feature_doc(q)) for q in quests]
+
+    assert "title" not in features[0]
+    for raw, feat in zip(
+        sc._rank_similar_quests(quests[0], quests[1:]),
+        sc._rank_similar_quests(features[0], features[1:]),
+    ):
+        assert raw["id"] == feat["id"]
+        assert abs(raw["score"] - feat["score"]) < 1e-9
+
+
+def test_feature_source_ignores_unscored_fields():
+    quest = {"title": "Dragon Hunt", "summary": "Hunt it.", "level": 3}
+    synced = dict(quest, uploaderEmail="u@example.com", systemMigrationStatus="completed")
+    assert feature_source(quest) == feature_source(synced)
+    assert feature_source(quest) != feature_source(dict(quest, level=4))
+
+
+def test_stream_features_flattens_documents():
+    doc = MagicMock(id="q1")
+    doc.to_dict.return_value = {
+        "titleText": "dragon hunt",
+        "summaryText": "",
+        "fields": {"level": 3, "tags": ["combat"]},
+    }
+    db = MagicMock()
+    db.collection.return_value.stream.return_value = [doc]
+
+    assert list(stream_features(db)) == [
+        {
+            "id": "q1",
+            "titleText": "dragon hunt",
+            "summaryText": "",
+            "level": 3,
+            "tags": ["combat"],
+        }
+    ]
+    db.collection.assert_called_with("questSimilarityFeatures")
+
+
+def test_lsh_bands_are_stable_and_discriminative():
+    quest = {
+        "title": "Dragon Hunt",
+        "summary": "Hunt the red dragon in the mountains.",
+        "level": 3,
+        "tags": ["combat"],
+    }
+    bands = build_feature_doc(quest)["lshBands"]
+    assert len(bands) == 10
+    assert bands == build_feature_doc(dict(quest))["lshBands"]
+    assert build_feature_doc({})["lshBands"] == []
+
+    unrelated = build_feature_doc(
+        {"title": "Court Intrigue", "summary": "Masked ball politics.", "level": 9}
+    )["lshBands"]
+    assert not set(bands) & set(unrelated)
+
+
+def test_lsh_candidate_mode_scores_only_candidates():
+    import similarity_calculator as sc
+    from unittest.mock import patch
+
+    target_doc = MagicMock(exists=True)
+    target_doc.to_dict.return_value = {"title": "Dragon Hunt", "summary": "Red dragon."}
+    candidates = []
+    for i in range(12):
+        doc = MagicMock(id=f"c{i}")
+        doc.to_dict.return_value = {"titleText": "dragon", "summaryText": "red dragon", "fields": {}}
+        candidates.append(doc)
+
+    db = MagicMock()
+    db.collection.return_value.document.return_value.get.return_value = target_doc
+    query = db.collection.return_value.where.return_value.limit.return_value
+    query.stream.return_value = candidates
+
+    with patch.object(sc, "SIMILARITY_CANDIDATE_MODE", "lsh"), patch.object(
+        sc, "_initialize_firebase"
+    ), patch.object(sc, "fb_db", db):
+        results = sc.calculate_similarity_for_quest("target")
+
+    assert len(results) == sc.TOP_N_SIMILAR_QUESTS
+    db.collection.return_value.where.assert_called_once()
+    assert db.collection.return_value.where.call_args.args[:2] == (
+        "lshBands",
+        "array_contains_any",
+    )
+    db.collection.return_value.stream.assert_not_called()
+
+
+def test_similarity_fingerprint_tracks_scored_fields_only():
+    from similarity_features import similarity_fingerprint
+
+    quest = {"title": "Dragon Hunt", "summary": "Hunt it.", "tags": ["combat"]}
+    fp = similarity_fingerprint(quest)
+    assert fp == similarity_fingerprint(dict(quest))
+    assert fp == similarity_fingerprint(
+        dict(quest, uploaderEmail="u@example.com", similarityFingerprint=fp)
+    )
+    assert fp != similarity_fingerprint(dict(quest, tags=["combat", "horror"]))
+    assert fp != similarity_fingerprint(dict(quest, summary="Hunt it now."))
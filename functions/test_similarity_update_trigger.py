@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import main
+from similarity_features import similarity_fingerprint
+
+
+def _event(quest_id, before, after):
+    change = MagicMock()
+    change.before = MagicMock()
+    change.before.to_dict.return_value = before
+    change.after = MagicMock()
+    change.after.to_dict.return_value = after
+    event = MagicMock()
+    event.params = {'questId': quest_id}
+    event.data = change
+    return event
+
+
+class TestQuestUpdatedSimilarity(unittest.TestCase):
+
+    @patch('similarity_calculator.calculate_similarity_for_quest')
+    @patch('main.firestore')
+    def test_skips_when_fingerprint_matches(self, mock_firestore, mock_calculate):
+        quest = {'title': 'Dragon Hunt', 'summary': 'Hunt it.'}
+        after = dict(quest, uploaderEmail='u@example.com',
+                     similarityFingerprint=similarity_fingerprint(quest))
+
+        main.on_quest_card_updated_similarity.__wrapped__(_event('q1', quest, after))
+
+        mock_calculate.assert_not_called()
+        mock_firestore.client.assert_not_called()
+
+    @patch('similarity_calculator.calculate_similarity_for_quest')
+    @patch('main.firestore')
+    def test_recomputes_and_stamps_when_scored_fields_change(self, mock_firestore, mock_calculate):
+        before = {'title': 'Dragon Hunt', 'summary': 'Hunt it.'}
+        before['similarityFingerprint'] = similarity_fingerprint(before)
+        after = dict(before, summary='Hunt the red dragon.')
+
+        main.on_quest_card_updated_similarity.__wrapped__(_event('q1', before, after))
+
+        mock_calculate.assert_called_once_with('q1')
+        quest_ref = mock_firestore.client.return_value.collection.return_value.document.return_value
+        quest_ref.update.assert_called_once_with(
+            {'similarityFingerprint': similarity_fingerprint(after)}
+        )
+
+    @patch('similarity_calculator.calculate_similarity_for_quest')
+    @patch('main.firestore')
+    def test_legacy_quest_unrelated_write_only_stamps(self, mock_firestore, mock_calculate):
+        before = {'title': 'Dragon Hunt', 'summary': 'Hunt it.'}
+        after = dict(before, systemMigrationStatus='completed')
+
+        main.on_quest_card_updated_similarity.__wrapped__(_event('q1', before, after))
+
+        mock_calculate.assert_not_called()
+        quest_ref = mock_firestore.client.return_value.collection.return_value.document.return_value
+        quest_ref.update.assert_called_once_with(
+            {'similarityFingerprint': similarity_fingerprint(after)}
+        )
+
+    @patch('similarity_calculator.calculate_similarity_for_quest')
+    @patch('main.firestore')
+    def test_failed_recompute_does_not_stamp(self, mock_firestore, mock_calculate):
+        before = {'title': 'Dragon Hunt', 'summary': 'Hunt it.'}
+        before['similarityFingerprint'] = similarity_fingerprint(before)
+        after = dict(before, summary='Hunt the red dragon.')
+        mock_calculate.side_effect = RuntimeError('commit failed')
+
+        main.on_quest_card_updated_similarity.__wrapped__(_event('q1', before, after))
+
+        mock_calculate.assert_called_once_with('q1')
+        quest_ref = mock_firestore.client.return_value.collection.return_value.document.return_value
+        quest_ref.update.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
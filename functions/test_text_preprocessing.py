@@ -0,0 +1,75 @@
+import random
+
+import nltk
+from nltk.tokenize import word_tokenize
+
+import text_preprocessing as tp
+from benchmarks import make_corpus
+
+nltk.data.path.insert(0, tp.NLTK_DATA_PATH)
+
+# Quest-like prose covering the punctuation NLTK's tokenizer treats specially:
+# abbreviations, initials, numbers before periods, contractions, quotes,
+# brackets, ellipses, dashes and symbols.
+FIXTURE_TEXTS = [
+    "The party descends into the Sunless Citadel, an ancient fortress swallowed "
+    "by the earth. Goblins and kobolds fight over a magical fruit; Belak the "
+    "Outcast, a twisted druid, tends the Gulthias Tree.",
+    "Dr. Meepo (a kobold) needs help! Levels 1-3, approx. 4 sessions.",
+    '"Don\'t trust the dragon," warns the sage. It\'s 5. Players can\'t rest...',
+    "Mr. Smith vs. the U.S. Navy at 10 p.m. on St. Cuthbert's day, e.g. in Jan. or Feb.",
+    "J. R. R. Tolkien-inspired: a 3.5 edition one-shot for 4-6 PCs (level 5).",
+    "Chapter 5. the descent. Chapter 10. the ascent. No. 7 is cursed.",
+    "Rock'n'roll bards? 'Tis the season -- gonna wanna gimme lemme gotta cannot!",
+    "Mary's tomb... O'Brien's map [torn] {faded} <sealed> costs $5, 50% off & #1 @ the inn.",
+    "An “ancient” evil — the ‘lich’ – stirs «below».\n\nThe end.)",
+    "fire-breathing wyrms, 10.5km of tunnels, 3,000 gp, 1:30 hours, a.b.c. etc.",
+    "Heroes' rest.' Dogs' den.\" The villagers' plea: save us!",
+    "Café naïve über-boss fight. Ends with a TPK?! Maybe.",
+    "they're we'll you've he'd i'm d'ye more'n 'twas whaddya whatcha",
+    "Inc. Ltd. Co. Jr. Sr. Vol. Fig. ca. ft. lbs. i.e. etc.,",
+    "",
+    "   ",
+    "...",
+    "a.",
+    "Hunt the dragon.",
+]
+
+
+def _expected(text):
+    return [t for t in word_tokenize(text) if t.isalnum()]
+
+
+def test_alnum_tokens_match_nltk_on_fixture_corpus():
+    texts = FIXTURE_TEXTS + [q["summary"] for q in make_corpus(200)]
+    for text in texts:
+        lowered = text.lower()
+        assert tp.alnum_tokens(lowered) == _expected(lowered), text
+
+
+def test_alnum_tokens_match_nltk_on_random_punctuation():
+    rng = random.Random(3)
+    alphabet = "abcxyz019     ..,,''\"\"()[]{}<>-;:!?$%&#@*`\n’”“‘«»—"
+    for _ in range(2000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 30)))
+        assert tp.alnum_tokens(text) == _expected(text), repr(text)
+
+
+def test_preprocess_text_drops_stopwords_and_is_memoized():
+    tp.clear_cache()
+    text = "The Dragon of the North hunts in the mountains."
+    assert tp.preprocess_text(text) == "dragon north hunts mountains"
+    assert tp.preprocess_text(text) == "dragon north hunts mountains"
+    assert tp.cache_stats == {"hits": 1, "misses": 1}
+
+
+def test_preprocess_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(tp, "PREPROCESS_CACHE_SIZE", 3)
+    tp.clear_cache()
+    for i in range(5):
+        tp.preprocess_text(f"quest {i}")
+    assert len(tp._cache) == 3
+    tp.preprocess_text("quest 4")
+    assert tp.cache_stats["hits"] == 1
+    tp.preprocess_text("quest 0")
+    assert tp.cache_stats["misses"] == 6
@@ -0,0 +1,452 @@
+"""NLTK-free text preprocessing for similarity scoring and search.
+
+`preprocess_text` returns the same token string as the original NLTK pipeline
+(`word_tokenize(text.lower())`, keep `isalnum()` tokens, drop English
+stopwords) without importing NLTK:
+
+- `alnum_tokens` reproduces the alphanumeric tokens of `nltk.word_tokenize`
+  for lowercased text. NLTK's tokenizer is a Punkt sentence split followed by
+  ~20 Treebank regex passes over every sentence. Here the sentence split only
+  runs at `.?!` characters, and the Treebank regexes only run on
+  whitespace-separated chunks that contain punctuation; plain words (the vast
+  majority) are taken as-is.
+- Punkt's English model (abbreviations, collocations, orthographic context)
+  and the stopword list are read straight from the packaged `nltk_data`
+  files, so NLTK itself is only needed to download that data at packaging
+  time.
+- Results are memoized in a bounded LRU cache keyed by a hash of the input,
+  since the same quest titles and summaries are preprocessed over and over
+  by similarity triggers and search requests.
+
+Input is expected to be lowercased already, as `preprocess_text` does: Punkt's
+orthographic heuristics for capitalised words are not reproduced.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+NLTK_DATA_PATH = os.path.join(os.path.dirname(__file__), "nltk_data")
+PUNKT_MODEL_DIR = os.path.join(NLTK_DATA_PATH, "tokenizers", "punkt_tab", "english")
+STOPWORDS_FILE = os.path.join(NLTK_DATA_PATH, "corpora", "stopwords", "english")
+
+# Number of preprocessed strings kept per process. Entries are roughly the size
+# of the input text, so 20k entries stay within a few MiB for quest summaries.
+PREPROCESS_CACHE_SIZE = int(os.environ.get("PREPROCESS_CACHE_SIZE", "20000"))
+
+# --- Punkt sentence boundaries (nltk.tokenize.punkt, English parameters) ---
+
+_ORTHO_BEG_UC = 1 << 1
+_ORTHO_MID_UC = 1 << 2
+_ORTHO_UNK_UC = 1 << 3
+_ORTHO_BEG_LC = 1 << 4
+_ORTHO_UC = _ORTHO_BEG_UC + _ORTHO_MID_UC + _ORTHO_UNK_UC
+_PUNKT_PUNCTUATION = tuple(";:,.!?")
+
+_NON_WORD = r"(?:[)\";}\]\*:@\'\({\[\u2018\u2019\u201c\u201d\xab\xbb?!])"
+_MULTI_CHAR = r"(?:\-{2,}|\.{2,}|(?:\.\s){2,}\.)"
+_PUNKT_WORD_RE = re.compile(
+    r"""(
+        %(MultiChar)s
+        |
+        (?=%(WordStart)s)\S+?
+        (?=
+            \s|
+            $|
+            %(NonWord)s|%(MultiChar)s|
+            ,(?=$|\s|%(NonWord)s|%(MultiChar)s)
+        )
+        |
+        \S
+    )"""
+    % {
+        "NonWord": _NON_WORD,
+        "MultiChar": _MULTI_CHAR,
+        "WordStart": r"[^\(\"\`{\[:;&\#\*@\)}\]\-,]",
+    },
+    re.UNICODE | re.VERBOSE,
+)
+_PERIOD_CONTEXT_RE = re.compile(
+    r"[\.\?!](?=(?P<after_tok>%s|\s+(?P<next_tok>\S+)))" % _NON_WORD, re.UNICODE
+)
+_BOUNDARY_REALIGNMENT_RE = re.compile(
+    r'["\')\]}\u2018\u2019\u201c\u201d\xab\xbb]+?(?:\s+|(?=--)|$)', re.MULTILINE
+)
+_NUMERIC_RE = re.compile(r"^-?[\.,]?\d[\d,\.-]*\.?$")
+_INITIAL_RE = re.compile(r"[^\W\d]\.$", re.UNICODE)
+_ELLIPSIS_RE = re.compile(r"\.\.+$")
+
+
+class _PunktModel:
+    """The parts of Punkt's trained English model the boundary heuristics use."""
+
+    def __init__(self, model_dir: str):
+        self.abbrev_types = set(_read_lines(os.path.join(model_dir, "abbrev_types.txt")))
+        self.collocations = {
+            tuple(line.split("\t"))
+            for line in _read_lines(os.path.join(model_dir, "collocations.tab"))
+        }
+        self.collocation_starts = {first for first, _ in self.collocations}
+        self.ortho_context: Dict[str, int] = {}
+        for line in _read_lines(os.path.join(model_dir, "ortho_context.tab")):
+            word, flags = line.rsplit("\t", 1)
+            self.ortho_context[word] = int(flags)
+
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+_punkt_model: Optional[_PunktModel] = None
+_stopwords: Optional[Set[str]] = None
+_load_lock = threading.Lock()
+
+
+def _model() -> _PunktModel:
+    global _punkt_model
+    if _punkt_model is None:
+        with _load_lock:
+            if _punkt_model is None:
+                _punkt_model = _PunktModel(PUNKT_MODEL_DIR)
+    return _punkt_model
+
+
+def load_stopwords() -> Set[str]:
+    """The English stopword list from the packaged NLTK stopwords corpus."""
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = set(_read_lines(STOPWORDS_FILE))
+    return _stopwords
+
+
+class _Token:
+    __slots__ = ("tok", "type", "period_final", "sentbreak", "abbr", "ellipsis")
+
+    def __init__(self, tok: str):
+        self.tok = tok
+        self.type = _NUMERIC_RE.sub("##number##", tok.lower())
+        self.period_final = tok.endswith(".")
+        self.sentbreak = self.abbr = self.ellipsis = False
+
+    @property
+    def type_no_period(self) -> str:
+        if len(self.type) > 1 and self.type[-1] == ".":
+            return self.type[:-1]
+        return self.type
+
+    @property
+    def type_no_sentperiod(self) -> str:
+        return self.type_no_period if self.sentbreak else self.type
+
+
+def _first_pass(token: _Token, model: _PunktModel) -> None:
+    tok = token.tok
+    if tok in (".", "?", "!"):
+        token.sentbreak = True
+    elif _ELLIPSIS_RE.match(tok):
+        token.ellipsis = True
+    elif token.period_final and not tok.endswith(".."):
+        word = tok[:-1].lower()
+        if word in model.abbrev_types or word.split("-")[-1] in model.abbrev_types:
+            token.abbr = True
+        else:
+            token.sentbreak = True
+
+
+def _ortho_heuristic(token: _Token, model: _PunktModel):
+    if token.tok in _PUNKT_PUNCTUATION:
+        return False
+    ortho = model.ortho_context.get(token.type_no_sentperiod, 0)
+    if token.tok[0].islower() and ((ortho & _ORTHO_UC) or not (ortho & _ORTHO_BEG_LC)):
+        return False
+    # Lowercased input: the capitalised-word branches never apply.
+    return "unknown"
+
+
+def _second_pass(token: _Token, following: _Token, model: _PunktModel) -> None:
+    if not token.period_final:
+        return
+    typ = token.type_no_period
+    if (typ, following.type_no_sentperiod) in model.collocations:
+        token.sentbreak = False
+        token.abbr = True
+        return
+    if _INITIAL_RE.match(token.tok) or typ == "##number##":
+        if _ortho_heuristic(following, model) is False:
+            token.sentbreak = False
+            token.abbr = True
+
+
+def _contains_sentbreak(context: str, model: _PunktModel) -> bool:
+    """Punkt's text_contains_sentbreak: a sentence break followed by any token."""
+    tokens = [
+        _Token(tok)
+        for line in context.split("\n")
+        if line.strip()
+        for tok in _PUNKT_WORD_RE.findall(line)
+    ]
+    for token in tokens:
+        _first_pass(token, model)
+    for i, token in enumerate(tokens[:-1]):
+        _second_pass(token, tokens[i + 1], model)
+        if token.sentbreak:
+            return True
+    return False
+
+
+def _sentences(text: str) -> List[str]:
+    """Punkt sentence segmentation of (lowercased) `text`."""
+    # Candidate boundaries with the word before each one, skipping candidates
+    # whose word overlaps the previous candidate (punkt's
+    # _match_potential_end_contexts).
+    matches = []
+    previous_start = previous_stop = 0
+    previous_match = None
+    for match in _PERIOD_CONTEXT_RE.finditer(text):
+        last_space = _get_last_whitespace_index(text[previous_stop : match.start()])
+        word_start = previous_stop + last_space + 1 if last_space else previous_start
+        if previous_match and previous_stop <= word_start:
+            matches.append((previous_match, text[previous_start:previous_stop]))
+        previous_match = match
+        previous_start, previous_stop = word_start, match.start()
+    if previous_match:
+        matches.append((previous_match, text[previous_start:previous_stop]))
+
+    if not matches:
+        stripped = text.rstrip()
+        return [stripped] if stripped else []
+
+    model = _model()
+    slices: List[Tuple[int, int]] = []
+    last_break = 0
+    for match, word in matches:
+        if (
+            match.group() == "."
+            and len(word) > 1
+            and word.isalpha()
+            and word not in model.abbrev_types
+            and word not in model.collocation_starts
+        ):
+            # An ordinary word before a period is always a break.
+            is_break = True
+        else:
+            context = word + match.group() + match.group("after_tok")
+            is_break = _contains_sentbreak(context, model)
+        if is_break:
+            slices.append((last_break, match.end()))
+            last_break = (
+                match.start("next_tok") if match.group("next_tok") else match.end()
+            )
+    slices.append((last_break, len(text.rstrip())))
+
+    sentences = []
+    realign = 0
+    for i, (start, stop) in enumerate(slices):
+        start += realign
+        if i + 1 == len(slices):
+            if text[start:stop]:
+                sentences.append(text[start:stop])
+            continue
+        next_start = slices[i + 1][0]
+        m = _BOUNDARY_REALIGNMENT_RE.match(text, next_start, slices[i + 1][1])
+        if m:
+            sentences.append(text[start : next_start + len(m.group(0).rstrip())])
+            realign = m.end() - next_start
+        else:
+            realign = 0
+            if text[start:stop]:
+                sentences.append(text[start:stop])
+    return sentences
+
+
+def _get_last_whitespace_index(text: str) -> int:
+    for i in range(len(text) - 1, -1, -1):
+        if text[i].isspace():
+            return i
+    return 0
+
+
+# --- Treebank word splitting (nltk.tokenize.destructive.NLTKWordTokenizer) ---
+
+_FINAL_PERIOD_CLOSERS = "])}>\"'»”’ "
+_CHUNK_RE = re.compile(r"\S+")
+_ALNUM_CHAR_RE = re.compile(r"[^\W_]")
+# A word wrapped only in punctuation that Treebank always pads with spaces,
+# e.g. `(dragon),` or `"don't`, optionally with a clitic that is split off
+# (`n't`, `'s`, ...) and/or trailing periods.
+_PUNCTUATED_WORD_RE = re.compile(
+    r"[(\[{<\"`\u201c\u2018\xab$#@&%*;!?]*"
+    r"(\w+?)(n't|'s|'m|'d|'ll|'re|'ve)?(\.*)"
+    r"[)\]}>\"\u201d\u2019\xbb,:;!?$#@&%*]*$"
+)
+_OPENING_QUOTE_RE = re.compile(r" (?:\"|'')")
+_STARTING_QUOTES = [
+    (re.compile("([«“‘„]|[`]+)", re.U), r" \1 "),
+    (re.compile(r"^\""), r"``"),
+    (re.compile(r"(``)"), r" \1 "),
+    (re.compile(r"([ \(\[{<])(\"|\'{2})"), r"\1 `` "),
+    (re.compile(r"(?i)(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)", re.U), r"\1 "),
+]
+_PUNCTUATION = [
+    (re.compile(r"([:,])([^\d])"), r" \1 \2"),
+    (re.compile(r"([:,])$"), r" \1 "),
+    (re.compile(r"\.{2,}", re.U), r" \g<0> "),
+    (re.compile(r"[;@#$%&]"), r" \g<0> "),
+    (re.compile(r"[\u2012-\u2015]", re.U), r" \g<0> "),
+    (re.compile(r"[?!]"), r" \g<0> "),
+    (re.compile(r"([^'])' "), r"\1 ' "),
+    (re.compile(r"[*]", re.U), r" \g<0> "),
+    (re.compile(r"[\]\[\(\)\{\}\<\>]"), r" \g<0> "),
+    (re.compile(r"--"), r" -- "),
+]
+_ENDING_QUOTES = [
+    (re.compile("([»”’])", re.U), r" \1 "),
+    (re.compile(r"''"), " '' "),
+    (re.compile(r'"'), " '' "),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+    (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 "),
+]
+_CONTRACTIONS = [
+    re.compile(pattern)
+    for pattern in (
+        r"(?i)\b(can)(?#X)(not)\b",
+        r"(?i)\b(d)(?#X)('ye)\b",
+        r"(?i)\b(gim)(?#X)(me)\b",
+        r"(?i)\b(gon)(?#X)(na)\b",
+        r"(?i)\b(got)(?#X)(ta)\b",
+        r"(?i)\b(lem)(?#X)(me)\b",
+        r"(?i)\b(more)(?#X)('n)\b",
+        r"(?i)\b(wan)(?#X)(na)(?=\s)",
+        r"(?i) ('t)(?#X)(is)\b",
+        r"(?i) ('t)(?#X)(was)\b",
+    )
+]
+# Plain words the contraction rules split in two.
+_SPLIT_WORDS = {
+    "cannot": ("can", "not"),
+    "gimme": ("gim", "me"),
+    "gonna": ("gon", "na"),
+    "gotta": ("got", "ta"),
+    "lemme": ("lem", "me"),
+    "wanna": ("wan", "na"),
+}
+
+
+def _split_chunk(chunk: str, space_follows: bool) -> List[str]:
+    """Treebank tokens of one whitespace-free chunk that contains punctuation.
+
+    Apart from the sentence-final period, the Treebank rules only look at
+    characters within a chunk plus whether a literal space follows it, so the
+    regexes can run per chunk instead of over the whole sentence.
+    """
+    text = chunk
+    for regexp, substitution in _STARTING_QUOTES:
+        text = regexp.sub(substitution, text)
+    if space_follows:
+        text += " "
+    for regexp, substitution in _PUNCTUATION:
+        text = regexp.sub(substitution, text)
+    text = " " + text + " "
+    for regexp, substitution in _ENDING_QUOTES:
+        text = regexp.sub(substitution, text)
+    for regexp in _CONTRACTIONS:
+        text = regexp.sub(r" \1 \2 ", text)
+    return text.split()
+
+
+def _sentence_tokens(sentence: str, out: List[str]) -> None:
+    # The Treebank final-period rule: the sentence's last period is split off
+    # when only closing brackets/quotes follow it. A `"` or `''` after a space
+    # has already become an opening quote by then, which blocks the rule.
+    tail = sentence.rstrip()
+    end = len(tail.rstrip(_FINAL_PERIOD_CLOSERS))
+    if (
+        end > 1
+        and tail[end - 1] == "."
+        and tail[end - 2] != "."
+        and not _OPENING_QUOTE_RE.search(tail, end)
+    ):
+        sentence = sentence[: end - 1] + " . " + sentence[end:]
+    for match in _CHUNK_RE.finditer(sentence):
+        chunk = match.group()
+        if chunk.isalnum():
+            out.extend(_SPLIT_WORDS.get(chunk, (chunk,)))
+            continue
+        if not _ALNUM_CHAR_RE.search(chunk):
+            continue
+        simple = _PUNCTUATED_WORD_RE.match(chunk)
+        word = simple.group(1) if simple else ""
+        if word.isalnum() and simple.group(3) != ".":
+            out.extend(_SPLIT_WORDS.get(word, (word,)))
+        elif word.isalnum() and not simple.group(2):
+            # `word.` inside a sentence stays one (non-alphanumeric) token
+            # unless a contraction rule splits the word in front of the period.
+            if word != "wanna":
+                out.extend(_SPLIT_WORDS.get(word, ()))
+        else:
+            space_follows = sentence[match.end() : match.end() + 1] == " "
+            out.extend(
+                tok for tok in _split_chunk(chunk, space_follows) if tok.isalnum()
+            )
+
+
+def alnum_tokens(text: str) -> List[str]:
+    """The `isalnum()` tokens of `nltk.word_tokenize(text)`, in order.
+
+    `text` should be lowercase.
+    """
+    out: List[str] = []
+    if any(c in text for c in ".?!"):
+        for sentence in _sentences(text):
+            _sentence_tokens(sentence, out)
+    else:
+        _sentence_tokens(text, out)
+    return out
+
+
+# --- Memoized preprocessing ---
+
+_cache: "OrderedDict[bytes, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0}
+
+
+def _cache_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def preprocess_text(text_content: str) -> str:
+    """Lowercased, stopword-free alphanumeric tokens of `text_content`, space-joined."""
+    key = _cache_key(text_content)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            cache_stats["hits"] += 1
+            return cached
+        cache_stats["misses"] += 1
+
+    stop_words = load_stopwords()
+    processed = " ".join(
+        token
+        for token in alnum_tokens(text_content.lower())
+        if token not in stop_words
+    )
+
+    with _cache_lock:
+        _cache[key] = processed
+        _cache.move_to_end(key)
+        while len(_cache) > PREPROCESS_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return processed
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+        cache_stats["hits"] = cache_stats["misses"] = 0
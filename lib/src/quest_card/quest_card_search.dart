@@ -90,14 +90,15 @@ class _QuestCardSearchState extends State<QuestCardSearch> {
   Future<List<String>> _suggestionsFor(String pattern) async {
     if (pattern.trim().isEmpty) return [];
     try {
-      final callable = FirebaseFunctions.instance.httpsCallable('search_quests');
-      final resp = await callable.call({'query': pattern, 'page': 1, 'pageSize': 5});
+      final callable =
+          FirebaseFunctions.instance.httpsCallable('autocomplete_quests');
+      final resp = await callable.call({'prefix': pattern, 'limit': 5});
       final data = Map<String, dynamic>.from(resp.data);
-      final hits = (data['hits'] as List<dynamic>?)
+      final titles = (data['titles'] as List<dynamic>?)
               ?.map((e) => Map<String, dynamic>.from(e))
               .toList() ??
           [];
-      return hits.map((h) => h['title']?.toString() ?? '').toList();
+      return titles.map((t) => t['title']?.toString() ?? '').toList();
     } catch (e) {
       debugPrint('Suggestion fetch error: $e');
       return [];